@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import csv
+import io
+import random
+from email.message import EmailMessage
+from email.utils import formatdate
+from typing import Any, Dict, List, Tuple
+
+
+# name -> (weight, attachment count range, attachment size range in bytes)
+PROFILES: Dict[str, Tuple[float, Tuple[int, int], Tuple[int, int]]] = {
+    "text": (0.35, (0, 0), (0, 0)),
+    "html": (0.25, (0, 0), (0, 0)),
+    "attachments": (0.30, (1, 4), (20_000, 1_500_000)),
+    "large": (0.10, (1, 1), (4_000_000, 8_000_000)),
+}
+
+_WORDS = (
+    "invoice payment order delivery contract meeting report schedule quarterly budget "
+    "счёт оплата договор поставка отчёт встреча support ticket access request review "
+    "deadline project update summary please attached see regards thanks"
+).split()
+
+_SENDERS = [
+    "billing@vendor.example",
+    "noreply@newsletter.example",
+    "ivan.petrov@partner.example",
+    "support@saas.example",
+    "hr@corp.example",
+]
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _text(rng: random.Random, paragraphs: int) -> str:
+    return "\n\n".join(" ".join(_sentence(rng, rng.randint(6, 16)) for _ in range(rng.randint(2, 6))) for _ in range(paragraphs))
+
+
+def _csv_bytes(rng: random.Random, size: int) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["date", "item", "qty", "amount"])
+    while buf.tell() < size:
+        writer.writerow([f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}", rng.choice(_WORDS), rng.randint(1, 99), f"{rng.uniform(1, 9999):.2f}"])
+    return buf.getvalue().encode("utf-8")
+
+
+def _pdf_bytes(rng: random.Random, size: int) -> bytes:
+    """A small valid one-page PDF padded to about `size` bytes with an incompressible stream."""
+    text = _sentence(rng, 8).replace("(", "").replace(")", "")
+    content = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1", "replace")
+    pad = rng.randbytes(max(0, size - 900))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length %d >>\nstream\n" % len(pad) + pad + b"\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _attachment(rng: random.Random, index: int, size: int) -> Tuple[bytes, str, str, str]:
+    kind = rng.choice(("pdf", "csv", "txt", "bin"))
+    if kind == "pdf":
+        return _pdf_bytes(rng, size), "application", "pdf", f"document_{index}.pdf"
+    if kind == "csv":
+        return _csv_bytes(rng, size), "text", "csv", f"table_{index}.csv"
+    if kind == "txt":
+        data = _text(rng, max(1, size // 600)).encode("utf-8")
+        return data[:size] if len(data) > size else data, "text", "plain", f"notes_{index}.txt"
+    return rng.randbytes(size), "application", "octet-stream", f"blob_{index}.bin"
+
+
+def build_message(rng: random.Random, index: int, profile: str) -> bytes:
+    _, count_range, size_range = PROFILES[profile]
+    msg = EmailMessage()
+    msg["From"] = rng.choice(_SENDERS)
+    msg["To"] = "inbox@bench.example"
+    msg["Subject"] = f"{_sentence(rng, rng.randint(3, 7))[:-1]} #{index}"
+    msg["Date"] = formatdate(localtime=True)
+    msg["Message-ID"] = f"<bench-{index}-{rng.getrandbits(48):x}@bench.example>"
+    body = _text(rng, rng.randint(1, 5))
+    msg.set_content(body)
+    if profile == "html":
+        links = "".join(f'<li><a href="https://site{n}.example/path/{index}">link {n}</a></li>' for n in range(rng.randint(1, 6)))
+        html_body = "".join(f"<p>{p}</p>" for p in body.split("\n\n"))
+        msg.add_alternative(f"<html><body>{html_body}<ul>{links}</ul></body></html>", subtype="html")
+    for n in range(rng.randint(*count_range) if count_range[1] else 0):
+        data, maintype, subtype, filename = _attachment(rng, n, rng.randint(*size_range))
+        if maintype == "text":
+            msg.add_attachment(data.decode("utf-8"), subtype=subtype, filename=filename)
+        else:
+            msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
+    return msg.as_bytes()
+
+
+def build_corpus(count: int, seed: int = 1) -> Tuple[List[bytes], Dict[str, Any]]:
+    """`count` synthetic messages mixed by PROFILES weights; identical for the same seed."""
+    rng = random.Random(seed)
+    names = list(PROFILES)
+    weights = [PROFILES[n][0] for n in names]
+    messages: List[bytes] = []
+    mix: Dict[str, int] = {n: 0 for n in names}
+    for i in range(count):
+        profile = rng.choices(names, weights)[0]
+        mix[profile] += 1
+        messages.append(build_message(rng, i, profile))
+    sizes = sorted(len(m) for m in messages)
+    summary = {
+        "count": count,
+        "seed": seed,
+        "profiles": mix,
+        "total_bytes": sum(sizes),
+        "median_bytes": sizes[len(sizes) // 2] if sizes else 0,
+        "max_bytes": sizes[-1] if sizes else 0,
+    }
+    return messages, summary
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import re
+import select
+import socketserver
+import threading
+from email import policy
+from email.message import Message
+from email.parser import BytesParser
+from typing import Any, Dict, List, Optional, Set
+
+
+_ITEM_RE = re.compile(r"BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|\S+", re.I)
+_SECTION_RE = re.compile(r"BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", re.I)
+
+
+def _quote(value: Optional[str]) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _body_bytes(part: Message) -> bytes:
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, list):
+        return b""
+    if isinstance(payload, bytes):
+        return payload
+    return str(payload).encode("utf-8", "surrogateescape")
+
+
+def _structure(part: Message) -> str:
+    """BODYSTRUCTURE of a parsed message (RFC 3501 §7.4.2, the fields imapclient reads)."""
+    if part.is_multipart():
+        children = "".join(_structure(p) for p in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype())} ({_quote('boundary')} {_quote(part.get_boundary())}) NIL NIL NIL)"
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    params: List[str] = []
+    for key, value in part.get_params() or []:
+        if key.lower() == part.get_content_type() or "/" in key:
+            continue
+        params += [_quote(key), _quote(value)]
+    params_s = "(" + " ".join(params) + ")" if params else "NIL"
+    encoding = part.get("Content-Transfer-Encoding", "7bit")
+    body = _body_bytes(part)
+    disposition = part.get_content_disposition()
+    filename = part.get_filename()
+    disposition_s = "NIL"
+    if disposition:
+        disposition_s = f"({_quote(disposition)} " + (f"({_quote('filename')} {_quote(filename)})" if filename else "NIL") + ")"
+    lines = " %d" % body.count(b"\n") if maintype == "text" else ""
+    return f"({_quote(maintype)} {_quote(subtype)} {params_s} NIL NIL {_quote(encoding)} {len(body)}{lines} NIL {disposition_s} NIL NIL)"
+
+
+def _section(msg: Message, raw: bytes, spec: str) -> bytes:
+    if spec == "":
+        return raw
+    if spec == "HEADER":
+        idx = raw.find(b"\r\n\r\n")
+        if idx < 0:
+            return raw[: raw.find(b"\n\n") + 2]
+        return raw[: idx + 4]
+    if spec.startswith("HEADER.FIELDS"):
+        names = spec[spec.index("(") + 1 : spec.rindex(")")].split()
+        out = b""
+        for name in names:
+            for value in msg.get_all(name) or []:
+                out += f"{name.title()}: {value}\r\n".encode("utf-8", "surrogateescape")
+        return out + b"\r\n"
+    part = msg
+    for n in spec.split("."):
+        index = int(n)
+        if part.is_multipart():
+            part = part.get_payload()[index - 1]
+        elif index != 1:
+            return b""
+    return _body_bytes(part)
+
+
+class Mailbox:
+    """In-memory INBOX shared by every connection of a FakeImapServer."""
+
+    def __init__(self, messages: Optional[List[bytes]] = None, uidvalidity: int = 1, idle: bool = True):
+        self.lock = threading.Lock()
+        self.uidvalidity = uidvalidity
+        self.idle = idle
+        self.messages: Dict[int, bytes] = {}
+        self.parsed: Dict[int, Message] = {}
+        self.flags: Dict[int, Set[str]] = {}
+        self.next_uid = 1
+        self.fetch_bytes = 0
+        self.logins = 0
+        self.commands = 0
+        self._waiters: List[threading.Event] = []
+        for raw in messages or []:
+            self.add(raw)
+
+    def add(self, raw: bytes) -> int:
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = raw
+            self.flags[uid] = set()
+            waiters, self._waiters = self._waiters, []
+        for event in waiters:
+            event.set()
+        return uid
+
+    def message(self, uid: int) -> Message:
+        with self.lock:
+            msg = self.parsed.get(uid)
+        if msg is None:
+            msg = BytesParser(policy=policy.compat32).parsebytes(self.messages[uid])
+            with self.lock:
+                self.parsed[uid] = msg
+        return msg
+
+    def wait(self) -> threading.Event:
+        event = threading.Event()
+        with self.lock:
+            self._waiters.append(event)
+        return event
+
+    def uids(self, sequence: str) -> List[int]:
+        with self.lock:
+            known = sorted(self.messages)
+        out: List[int] = []
+        for piece in sequence.split(","):
+            if ":" in piece:
+                a, b = piece.split(":")
+                lo = int(a)
+                hi = known[-1] if b == "*" and known else (0 if b == "*" else int(b))
+                if b == "*" and known and lo > hi:
+                    lo = hi  # RFC 3501: n:* always includes the highest UID
+                out += [u for u in known if lo <= u <= hi]
+            elif int(piece) in self.messages:
+                out.append(int(piece))
+        return out
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Responses go out in several writes; Nagle plus delayed ACKs would add ~40 ms to each
+    disable_nagle_algorithm = True
+
+    def send(self, data: bytes) -> None:
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        box: Mailbox = self.server.mailbox  # type: ignore[attr-defined]
+        caps = "IMAP4rev1 UIDPLUS" + (" IDLE" if box.idle else "")
+        self.send(f"* OK [CAPABILITY {caps}] fake ready\r\n".encode())
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            m = re.match(r"(\S+) (\S+)(?: (.*))?$", line.decode("utf-8", "replace").rstrip("\r\n"))
+            if not m:
+                continue
+            box.commands += 1
+            tag, cmd, args = m.group(1), m.group(2).upper(), m.group(3) or ""
+            if cmd == "UID":
+                cmd, _, args = args.partition(" ")
+                cmd = cmd.upper()
+            if cmd == "CAPABILITY":
+                self.send(f"* CAPABILITY {caps}\r\n{tag} OK done\r\n".encode())
+            elif cmd == "LOGIN":
+                box.logins += 1
+                self.send(f"{tag} OK logged in\r\n".encode())
+            elif cmd in ("SELECT", "EXAMINE"):
+                with box.lock:
+                    n = len(box.messages)
+                self.send(
+                    f"* {n} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen)\r\n* OK [UIDVALIDITY {box.uidvalidity}] ok\r\n"
+                    f"* OK [UIDNEXT {box.next_uid}] ok\r\n{tag} OK [READ-WRITE] selected\r\n".encode()
+                )
+            elif cmd == "NOOP":
+                self.send(f"{tag} OK noop\r\n".encode())
+            elif cmd == "LOGOUT":
+                self.send(f"* BYE bye\r\n{tag} OK logout\r\n".encode())
+                return
+            elif cmd == "IDLE":
+                if not self._idle(box, tag):
+                    return
+            elif cmd == "SEARCH":
+                self._search(box, tag, args.upper())
+            elif cmd == "STORE":
+                sequence, _, rest = args.partition(" ")
+                for u in box.uids(sequence):
+                    if "+FLAGS" in rest.upper() and "\\SEEN" in rest.upper():
+                        box.flags[u].add("\\Seen")
+                    self.send(f"* {u} FETCH (UID {u} FLAGS ({' '.join(box.flags[u])}))\r\n".encode())
+                self.send(f"{tag} OK store\r\n".encode())
+            elif cmd == "FETCH":
+                sequence, _, items = args.partition(" ")
+                items = items.strip()
+                if items.startswith("("):
+                    items = items[1:-1]
+                for u in box.uids(sequence):
+                    self.send(self._fetch(box, u, items))
+                self.send(f"{tag} OK fetch\r\n".encode())
+            else:
+                self.send(f"{tag} BAD unknown {cmd}\r\n".encode())
+
+    def _idle(self, box: Mailbox, tag: str) -> bool:
+        event = box.wait()
+        self.send(b"+ idling\r\n")
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if event.is_set():
+                with box.lock:
+                    n = len(box.messages)
+                self.send(f"* {n} EXISTS\r\n".encode())
+                event = box.wait()
+            if readable:
+                if not self.rfile.readline():
+                    return False
+                break
+        self.send(f"{tag} OK idle done\r\n".encode())
+        return True
+
+    def _search(self, box: Mailbox, tag: str, criteria: str) -> None:
+        with box.lock:
+            uids = sorted(box.messages)
+            if "UNSEEN" in criteria:
+                uids = [u for u in uids if "\\Seen" not in box.flags[u]]
+        m = re.search(r"UID (\d+):\*", criteria)
+        if m:
+            selected = [u for u in uids if u >= int(m.group(1))]
+            uids = selected or uids[-1:]
+        self.send(f"* SEARCH {' '.join(map(str, uids))}\r\n{tag} OK search\r\n".encode())
+
+    def _fetch(self, box: Mailbox, uid: int, items: str) -> bytes:
+        raw = box.messages[uid]
+        msg = box.message(uid)
+        chunks: List[bytes] = [f"* {uid} FETCH (UID {uid}".encode()]
+        for item in _ITEM_RE.findall(items):
+            name = item.upper()
+            if name == "UID":
+                continue
+            if name == "BODYSTRUCTURE":
+                chunks.append(b" BODYSTRUCTURE " + _structure(msg).encode("utf-8", "surrogateescape"))
+                continue
+            if name == "FLAGS":
+                chunks.append(f" FLAGS ({' '.join(box.flags[uid])})".encode())
+                continue
+            if name == "RFC822.SIZE":
+                chunks.append(f" RFC822.SIZE {len(raw)}".encode())
+                continue
+            if name == "RFC822":
+                data, key = raw, "RFC822"
+                box.flags[uid].add("\\Seen")
+            else:
+                m = _SECTION_RE.match(item)
+                if not m:
+                    continue
+                spec = m.group(2).upper()
+                data, key = _section(msg, raw, spec), f"BODY[{spec}]"
+                if m.group(3) is not None:
+                    offset, length = int(m.group(3)), int(m.group(4))
+                    data = data[offset : offset + length]
+                    key += f"<{offset}>"
+                if not m.group(1):
+                    box.flags[uid].add("\\Seen")
+            box.fetch_bytes += len(data)
+            chunks.append(f" {key} {{{len(data)}}}\r\n".encode() + data)
+        chunks.append(b")\r\n")
+        return b"".join(chunks)
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """Plain-text IMAP server on 127.0.0.1 with just enough of RFC 3501 for imapclient.
+
+    Covers LOGIN, SELECT, SEARCH (UNSEEN, UID n:*), UID FETCH (RFC822, BODYSTRUCTURE,
+    BODY[...] sections and partials, HEADER.FIELDS), STORE +FLAGS \\Seen and IDLE.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: Mailbox):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.mailbox = mailbox
+
+    def start(self) -> "FakeImapServer":
+        threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def port(self) -> int:
+        return int(self.server_address[1])
+
+    def stats(self) -> Dict[str, Any]:
+        return {"logins": self.mailbox.logins, "commands": self.mailbox.commands, "fetch_bytes": self.mailbox.fetch_bytes}
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+
+DEFAULT_DECISION: Dict[str, Any] = {
+    "is_relevant": True,
+    "reason": "benchmark stub",
+    "task_markdown": "- forward to the benchmark route",
+    "compose": {
+        "to": ["bench-route@example.com"],
+        "subject": "[Bench] forwarded",
+        "body_text": "Forwarded by the benchmark stub.",
+        "attach_paths": [],
+        "include_raw_eml": False,
+    },
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        server: "FakeLlmServer" = self.server  # type: ignore[assignment]
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._reply(404, {"error": {"message": f"unsupported path {self.path}", "type": "invalid_request_error"}})
+            return
+        prompt_chars = sum(len(str(m.get("content") or "")) for m in request.get("messages") or [])
+        server.requests += 1
+        server.prompt_chars += prompt_chars
+        time.sleep(server.delay())
+        content = json.dumps(server.decision, ensure_ascii=False)
+        self._reply(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model") or "bench",
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                ],
+                "usage": {
+                    # Rough 4-characters-per-token estimate, enough for relative comparisons
+                    "prompt_tokens": prompt_chars // 4,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": (prompt_chars + len(content)) // 4,
+                },
+            },
+        )
+
+    def _reply(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeLlmServer(ThreadingHTTPServer):
+    """OpenAI-compatible Chat Completions endpoint that answers with a fixed decision.
+
+    Each request sleeps `latency` seconds ± `jitter` (fraction), standing in for model time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.3, jitter: float = 0.2, decision: Optional[Dict[str, Any]] = None, seed: int = 0):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.decision = decision or DEFAULT_DECISION
+        self.requests = 0
+        self.prompt_chars = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency * (1.0 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def start(self) -> "FakeLlmServer":
+        threading.Thread(target=self.serve_forever, name="fake-llm", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "prompt_chars": self.prompt_chars}
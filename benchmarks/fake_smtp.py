@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+
+
+class SmtpSink:
+    """asyncio SMTP server that accepts and discards mail, in the spirit of aiosmtpd's Sink.
+
+    Runs its own event loop in a daemon thread. Only counts and the last message are
+    kept, so large benchmark runs do not grow memory.
+    """
+
+    def __init__(self, fail_next: int = 0):
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self.commands: Dict[str, int] = {}
+        self.last_message: Optional[bytes] = None
+        self.fail_next = fail_next
+        self.port = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SmtpSink":
+        self._thread = threading.Thread(target=self._run, name="fake-smtp", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.port = int(self._server.sockets[0].getsockname()[1])
+        self._ready.set()
+        self._loop.run_forever()
+        # Sessions still open (e.g. pooled by the client) are cancelled before the loop closes
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self._loop.run_until_complete(asyncio.wait(tasks))
+        self._loop.close()
+
+    def stop(self) -> None:
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            if self._thread is not None:
+                self._thread.join(timeout=5)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+
+        async def reply(line: str) -> None:
+            writer.write(line.encode("ascii") + b"\r\n")
+            await writer.drain()
+
+        await reply("220 fake ESMTP ready")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                verb = line.decode("utf-8", "replace").strip().split(" ", 1)[0].upper()
+                self.commands[verb] = self.commands.get(verb, 0) + 1
+                if verb in ("EHLO", "HELO"):
+                    writer.write(b"250-fake\r\n250-8BITMIME\r\n250 SIZE 104857600\r\n")
+                    await writer.drain()
+                elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                    await reply("250 ok")
+                elif verb == "QUIT":
+                    await reply("221 bye")
+                    return
+                elif verb == "DATA":
+                    await reply("354 end with <CRLF>.<CRLF>")
+                    await self._data(reader, reply)
+                else:
+                    await reply("502 not implemented")
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            return
+        finally:
+            writer.close()
+
+    async def _data(self, reader: asyncio.StreamReader, reply: Any) -> None:
+        lines: List[bytes] = []
+        size = 0
+        while True:
+            line = await reader.readline()
+            if not line or line in (b".\r\n", b".\n"):
+                break
+            if line.startswith(b".."):
+                line = line[1:]
+            size += len(line)
+            lines.append(line)
+        if self.fail_next:
+            self.fail_next -= 1
+            await reply("451 try again later")
+            return
+        self.messages += 1
+        self.bytes += size
+        self.last_message = b"".join(lines)
+        await reply("250 queued")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"messages": self.messages, "bytes": self.bytes, "connections": self.connections, "commands": dict(self.commands)}
@@ -0,0 +1,428 @@
+"""Benchmark the mail path against local IMAP, SMTP and model stand-ins.
+
+    python -m benchmarks.run --messages 50 --llm-latency 0.3
+    python -m benchmarks.run --concurrency 4 --fetch-mode full --label full-fetch
+    python -m benchmarks.run --compare latest --fail-on-regression
+
+Each stage runs over the whole corpus before the next one starts, so latency
+percentiles, throughput and peak RSS are per stage. The `pipeline` stage runs every
+mail end to end the way the monitor does: MessageScheduler workers calling
+process_message, deliver and finish. Results are written as JSON to
+benchmarks/results/ and can be compared against an earlier run.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.corpus import build_corpus
+from benchmarks.fake_imap import FakeImapServer, Mailbox
+from benchmarks.fake_llm import FakeLlmServer
+from benchmarks.fake_smtp import SmtpSink
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+STAGES = ["read_message", "save_attachments", "process_files", "triage", "resolve", "send", "pipeline"]
+ACCOUNT_ID = "bench"
+
+BENCH_SETTINGS = """\
+routing_rules:
+  - category: invoices
+    to: ["billing@bench.example"]
+    subject_prefix: "[Billing]"
+    aliases: ["billing"]
+  - category: support
+    to: ["helpdesk@bench.example"]
+    subject_prefix: "[Support]"
+  - category: hr
+    to: ["hr@bench.example"]
+"""
+RESOLVE_QUERIES = ["invoices", "Billing", " SUPPORT ", "hr", "unknown"]
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the kernel's peak-RSS counter (Linux); False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # Lifetime peak; KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def _summarize(latencies: List[float], errors: int, wall: float, peak_rss_mb: float, rss_reset: bool) -> Dict[str, Any]:
+    ordered = sorted(latencies)
+    ms = [v * 1000.0 for v in ordered]
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "wall_s": round(wall, 4),
+        "per_minute": round(len(latencies) / wall * 60.0, 2) if wall > 0 else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": round(_percentile(ms, 0.50), 3),
+        "p95_ms": round(_percentile(ms, 0.95), 3),
+        "p99_ms": round(_percentile(ms, 0.99), 3),
+        "max_ms": round(ms[-1], 3) if ms else 0.0,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        # Without a reset the value is the process peak so far, not this stage's
+        "peak_rss_scope": "stage" if rss_reset else "process",
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+class Bench:
+    """Fake servers, an isolated data directory and the environment pointing the app at them."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.work = tempfile.mkdtemp(prefix="mail2mail-bench-")
+        messages, self.corpus = build_corpus(args.messages, seed=args.seed)
+        self.mailbox = Mailbox(messages)
+        self.imap = FakeImapServer(self.mailbox).start()
+        self.smtp = SmtpSink().start()
+        self.llm = FakeLlmServer(latency=args.llm_latency, jitter=args.llm_jitter, seed=args.seed).start()
+        self._configure_env()
+
+    def _configure_env(self) -> None:
+        settings_path = os.path.join(self.work, "settings.yaml")
+        with open(settings_path, "w", encoding="utf-8") as f:
+            f.write(BENCH_SETTINGS)
+        smtp_path = os.path.join(self.work, "admin_smtp.json")
+        with open(smtp_path, "w", encoding="utf-8") as f:
+            json.dump({"host": "127.0.0.1", "port": self.smtp.port, "starttls": False, "from": "bench@bench.example"}, f)
+        os.environ.update(
+            {
+                "SETTINGS_YAML": settings_path,
+                "ADMIN_SMTP_PATH": smtp_path,
+                "ADMIN_MAILBOXES_PATH": os.path.join(self.work, "admin_mailboxes.json"),
+                "ADMIN_QUEUE_PATH": os.path.join(self.work, "admin_queue.json"),
+                "DATA_DIR": os.path.join(self.work, "data"),
+                "TMP_ROOT": os.path.join(self.work, "tmp"),
+                "IMAP_HOST": "127.0.0.1",
+                "IMAP_PORT": str(self.imap.port),
+                "IMAP_SSL": "false",
+                "IMAP_USERNAME": "bench@bench.example",
+                "IMAP_PASSWORD": "bench",
+                "IMAP_MAILBOX": "INBOX",
+                "IMAP_FETCH_MODE": self.args.fetch_mode,
+                "OPENAI_API_KEY": "sk-bench",
+                "OPENAI_BASE_URL": self.llm.base_url,
+                "SMTP_SEND_MODE": "direct",
+                # Measure the work itself, not replays
+                "DECISION_CACHE_ENABLED": "false",
+                "DOCPROC_CACHE_ENABLED": "false",
+            }
+        )
+        os.makedirs(os.environ["DATA_DIR"], exist_ok=True)
+
+    def close(self) -> None:
+        for server in (self.imap, self.smtp, self.llm):
+            try:
+                server.stop()
+            except Exception:
+                pass
+        if not self.args.keep:
+            shutil.rmtree(self.work, ignore_errors=True)
+
+
+def _stage_functions(args: argparse.Namespace) -> Dict[str, Callable[[Dict[str, Any]], None]]:
+    # Imported only after Bench has pointed the environment at the fake servers
+    from agents import set_default_openai_api, set_default_openai_client, set_tracing_disabled
+    from openai import AsyncOpenAI
+
+    from mail2mail.agents.triage_compose import TRIAGE_COMPOSE_INSTRUCTIONS, build_triage_compose_agent
+    from mail2mail.services.pipeline import _run_agent, build_analysis_text
+    from mail2mail.services.prefilter import evaluate
+    from mail2mail.tools.docproc_tools import process_file_paths
+    from mail2mail.tools.email_tools import read_email_message, send_email_smtp
+    from mail2mail.tools.routing_tools import resolve_route
+    from mail2mail.tools.storage_tools import save_message_attachments
+
+    set_default_openai_client(AsyncOpenAI(base_url=os.environ["OPENAI_BASE_URL"], api_key="sk-bench"), use_for_tracing=False)
+    set_default_openai_api("chat_completions")
+    set_tracing_disabled(True)
+    agent = build_triage_compose_agent(TRIAGE_COMPOSE_INSTRUCTIONS, args.model)
+
+    def read_stage(ctx: Dict[str, Any]) -> None:
+        ctx["message"] = read_email_message(ACCOUNT_ID, f"imap:{ctx['uid']}")
+
+    def save_stage(ctx: Dict[str, Any]) -> None:
+        target = os.path.join(os.environ["TMP_ROOT"], "work", str(ctx["uid"]))
+        ctx["saved"] = save_message_attachments(ACCOUNT_ID, f"imap:{ctx['uid']}", target).get("saved_paths", [])
+
+    def process_stage(ctx: Dict[str, Any]) -> None:
+        ctx["attachments_text"] = process_file_paths(ctx.get("saved") or []).get("extracted_text", "")
+
+    def triage_stage(ctx: Dict[str, Any]) -> None:
+        message = ctx.get("message") or read_email_message(ACCOUNT_ID, f"imap:{ctx['uid']}")
+        text = build_analysis_text(message, ctx.get("saved") or [], ctx.get("attachments_text") or "", evaluate(message))
+        # Same call path as the workers: a per-message loop, the model call on the shared one
+        result = asyncio.run(_run_agent(agent, text))
+        ctx["decision"] = result.final_output
+
+    def resolve_stage(ctx: Dict[str, Any]) -> None:
+        ctx["route"] = resolve_route(RESOLVE_QUERIES[ctx["uid"] % len(RESOLVE_QUERIES)])
+
+    def send_stage(ctx: Dict[str, Any]) -> None:
+        decision = ctx.get("decision")
+        compose = decision.compose if decision is not None else None
+        to = (ctx.get("route") or {}).get("to") or (compose.to if compose is not None else []) or ["bench-route@example.com"]
+        subject = compose.subject if compose is not None else f"[Bench] message {ctx['uid']}"
+        body = compose.body_text if compose is not None else "benchmark"
+        send_email_smtp("__default__", to, subject, body, ctx.get("saved") or [])
+
+    return {
+        "read_message": read_stage,
+        "save_attachments": save_stage,
+        "process_files": process_stage,
+        "triage": triage_stage,
+        "resolve": resolve_stage,
+        "send": send_stage,
+    }
+
+
+def run_pipeline_stage(contexts: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    """Every mail through MessageScheduler + process_and_deliver, as the IDLE monitor runs it."""
+    from mail2mail.services.idle_monitor import process_and_deliver
+    from mail2mail.services.scheduler import MessageScheduler
+
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def handler(account_id: str, message_id: str) -> None:
+        t0 = time.perf_counter()
+        try:
+            process_and_deliver(account_id, message_id)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    workers = max(1, concurrency)
+    # One mailbox in the corpus: let it use every worker
+    scheduler = MessageScheduler(handler, workers=workers, per_account=workers, max_queue=len(contexts) + 1).start()
+    rss_reset = _reset_peak_rss()
+    started = time.perf_counter()
+    try:
+        for ctx in contexts:
+            scheduler.submit(ACCOUNT_ID, f"imap:{ctx['uid']}")
+        scheduler.join()
+    finally:
+        scheduler.stop()
+    wall = time.perf_counter() - started
+    stats = _summarize(latencies, len(errors), wall, _peak_rss_mb(), rss_reset)
+    if errors:
+        stats["first_error"] = errors[0][:500]
+    return stats
+
+
+def run_stage(fn: Callable[[Dict[str, Any]], None], contexts: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    first_error: Optional[str] = None
+
+    def timed(ctx: Dict[str, Any]) -> Optional[str]:
+        t0 = time.perf_counter()
+        try:
+            fn(ctx)
+            return None
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        finally:
+            latencies.append(time.perf_counter() - t0)
+
+    rss_reset = _reset_peak_rss()
+    started = time.perf_counter()
+    if concurrency <= 1:
+        outcomes = [timed(ctx) for ctx in contexts]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(timed, contexts))
+    wall = time.perf_counter() - started
+    for outcome in outcomes:
+        if outcome is not None:
+            errors += 1
+            first_error = first_error or outcome
+    stats = _summarize(latencies, errors, wall, _peak_rss_mb(), rss_reset)
+    if first_error:
+        stats["first_error"] = first_error[:500]
+    return stats
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    bench = Bench(args)
+    try:
+        stages = _stage_functions(args)
+        selected = [s for s in STAGES if s in set(args.stages)]
+        contexts: List[Dict[str, Any]] = [{"uid": uid} for uid in sorted(bench.mailbox.messages)]
+        results: Dict[str, Any] = {}
+        for name in selected:
+            if name == "pipeline":
+                results[name] = run_pipeline_stage(contexts, args.concurrency)
+            else:
+                results[name] = run_stage(stages[name], contexts, args.concurrency)
+            print(_format_stage(name, results[name]), flush=True)
+        # The pipeline stage is the end-to-end run; otherwise the stages add up to one
+        total_wall = results["pipeline"]["wall_s"] if "pipeline" in results else sum(r["wall_s"] for r in results.values())
+        return {
+            "label": args.label,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "messages": args.messages,
+                "seed": args.seed,
+                "concurrency": args.concurrency,
+                "fetch_mode": args.fetch_mode,
+                "llm_latency_s": args.llm_latency,
+                "llm_jitter": args.llm_jitter,
+                "model": args.model,
+                "stages": selected,
+            },
+            "corpus": bench.corpus,
+            "stages": results,
+            "end_to_end": {
+                "wall_s": round(total_wall, 4),
+                "mails_per_minute": round(args.messages / total_wall * 60.0, 2) if total_wall > 0 else 0.0,
+            },
+            "servers": {"imap": bench.imap.stats(), "smtp": bench.smtp.stats(), "llm": bench.llm.stats()},
+        }
+    finally:
+        bench.close()
+
+
+def _format_stage(name: str, s: Dict[str, Any]) -> str:
+    line = (
+        f"{name:<17} n={s['count']:<5} err={s['errors']:<3} {s['per_minute']:>10.1f}/min  "
+        f"p50={s['p50_ms']:>9.2f}ms p95={s['p95_ms']:>9.2f}ms p99={s['p99_ms']:>9.2f}ms  rss={s['peak_rss_mb']:.0f}MB"
+    )
+    if s.get("first_error"):
+        line += f"\n    first error: {s['first_error']}"
+    return line
+
+
+def save_result(result: Dict[str, Any], out_dir: str) -> str:
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    name = "-".join(p for p in (stamp, result.get("label") or result.get("git") or "run") if p)
+    path = os.path.join(out_dir, f"{name}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def _resolve_baseline(spec: str, out_dir: str) -> Optional[str]:
+    if spec != "latest":
+        return spec
+    runs = sorted(glob.glob(os.path.join(out_dir, "*.json")))
+    return runs[-1] if runs else None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Print per-stage deltas; return the regressions (p95 up or throughput down by more than `threshold`)."""
+    regressions: List[str] = []
+    print(f"\ncompared with {baseline.get('label') or baseline.get('git') or '?'} ({baseline.get('created_at')})")
+    for name, now in current.get("stages", {}).items():
+        before = (baseline.get("stages") or {}).get(name)
+        if not before:
+            continue
+        parts = []
+        for metric, worse_if_higher in (("per_minute", False), ("p50_ms", True), ("p95_ms", True), ("p99_ms", True), ("peak_rss_mb", True)):
+            old, new = float(before.get(metric) or 0), float(now.get(metric) or 0)
+            change = (new - old) / old if old else 0.0
+            parts.append(f"{metric}={new:g} ({change:+.1%})")
+            regressed = change > threshold if worse_if_higher else change < -threshold
+            if regressed and metric in ("per_minute", "p95_ms"):
+                regressions.append(f"{name}.{metric} {old:g} -> {new:g} ({change:+.1%})")
+        print(f"  {name:<17} " + "  ".join(parts))
+    for line in regressions:
+        print(f"  REGRESSION {line}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="mail2mail benchmark with local IMAP/SMTP/LLM stand-ins")
+    parser.add_argument("--messages", type=int, default=50, help="corpus size")
+    parser.add_argument("--seed", type=int, default=1, help="corpus seed (same seed, same corpus)")
+    parser.add_argument("--concurrency", type=int, default=1, help="messages in flight per stage")
+    parser.add_argument("--fetch-mode", choices=["lazy", "full"], default=os.getenv("IMAP_FETCH_MODE", "lazy"))
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub model latency, seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="± fraction of the latency")
+    parser.add_argument("--model", default=os.getenv("AGENT_MODEL", "gpt-4o-mini"), help="model name sent to the stub")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--label", default=None, help="name stored with the results")
+    parser.add_argument("--out", default=RESULTS_DIR, help="results directory")
+    parser.add_argument("--no-save", action="store_true", help="do not write a results file")
+    parser.add_argument("--compare", default=None, help="baseline results file, or 'latest'")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit 1 when a regression is found")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data directory")
+    args = parser.parse_args(argv)
+
+    baseline_path = _resolve_baseline(args.compare, args.out) if args.compare else None
+    result = run(args)
+    print(f"end-to-end: {result['end_to_end']['mails_per_minute']:.1f} mails/min over {result['end_to_end']['wall_s']:.2f}s")
+    if not args.no_save:
+        print(f"saved {save_result(result, args.out)}")
+    if args.compare:
+        if not baseline_path or not os.path.exists(baseline_path):
+            print("no baseline to compare with")
+            return 0
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+from mail2mail.services.metrics import CONTENT_TYPE, render_metrics
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    """Prometheus scrape endpoint for the admin process (include with app.include_router(router))."""
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
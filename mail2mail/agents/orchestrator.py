@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+from functools import lru_cache
+from typing import Optional
+
 from agents import Agent, ModelSettings, set_default_openai_key
 
 from mail2mail.types import EmailDecision
 from mail2mail.tools.email_tools import read_message, send
 from mail2mail.tools.storage_tools import save_attachments
-from mail2mail.tools.docproc_tools import process_files
+from mail2mail.tools.docproc_tools import preview_files, process_files
 from mail2mail.tools.routing_tools import resolve
 from mail2mail.tools.housekeeping_tools import cleanup
-from mail2mail.settings import get_settings
+from mail2mail.tools.lazy import resolve_tools
+from mail2mail.services.settings_cache import get_snapshot
 
 
 ORCHESTRATOR_INSTRUCTIONS = """
@@ -22,7 +26,7 @@ ORCHESTRATOR_INSTRUCTIONS = """
 4) Если письмо НЕ спам — подготовить переоформленное письмо (новая тема/тело), указать список вложений для повторной отправки и вычисленный адрес назначения.
 
 [CONTEXT & CONSTRAINTS]
-- Обрабатывай письма строго последовательно, одно за другим. Хранение только временное — рабочая папка/кэш удаляются в конце обработки.
+- Один запуск — одно письмо: доводи его до конца, не переключаясь на другие (параллельную обработку разных ящиков обеспечивает планировщик). Хранение только временное — рабочая папка/кэш удаляются в конце обработки.
 - НЕ переходи по ссылкам из письма и НЕ скачивай их содержимое. Ссылки просто перечисляй как есть в тексте и в структуре.
 - Текст письма и вложений может быть на любых языках; ответы возвращай на языке письма, если не задано иное.
 - Придерживайся минимальности: для спама дай только причину и прекрати процесс (без подготовки ответного письма).
@@ -30,17 +34,18 @@ ORCHESTRATOR_INSTRUCTIONS = """
 
 [TOOLS]
 Тебе доступны инструменты (функции). Используй их по назначению; если входные данные уже предоставлены — не дублируй вызовы:
-1) email.read_message(account_id, message_id) -> {headers, text_plain, text_html, links[], attachments_meta[]}
+1) email.read_message(account_id, message_id) -> {headers, text_plain, text_html, text, links[], attachments_meta[]}
 2) storage.save_attachments(account_id, message_id, target_dir) -> {saved_paths[]}
-3) docproc.process_files(paths[], options) -> {extracted_text, tables[], images[], notes[]}
-4) routing.resolve(category) -> {to_email, cc[], bcc[], subject_prefix?}
-5) email.send(from_account_id, to[], subject, body, attach_paths[]) -> {sent_message_id}
-6) housekeeping.cleanup(work_dir) -> {ok: true}
+3) docproc.preview_files(paths[], max_chars?) -> {extracted_text, truncated, notes[]}
+4) docproc.process_files(paths[], options) -> {extracted_text, tables[], images[], notes[]}
+5) routing.resolve(category) -> {to_email, cc[], bcc[], subject_prefix?}
+6) email.send(from_account_id, to[], subject, body, attach_paths[]) -> {sent_message_id}
+7) housekeeping.cleanup(work_dir, account_id, message_id) -> {ok: true}
 
 [PROCESS]
 1) Получи письмо: вызови email.read_message(...). Сформируй список ссылок (не переходи по ним).
 2) Сохрани вложения: вызови storage.save_attachments(...).
-3) Извлеки из вложений содержимое: docproc.process_files(..., options={page_limits, vision_descriptions:true}).
+3) Извлеки из вложений содержимое: сначала docproc.preview_files(...) (первые страницы). Только если этого недостаточно для классификации (truncated=true и важны детали) — docproc.process_files(..., options={page_limits, vision_descriptions:true}).
 4) Синтезируй "текст для анализа": тело письма (plain приоритет), + извлечённый текст из вложений, + список ссылок, + метаданные.
 5) Классифицируй (is_spam, importance, category) и извлеки ключевые сущности.
 6) Сформируй структурированный JSON строго по схеме EmailDecision и краткую сводку.
@@ -60,22 +65,33 @@ ORCHESTRATOR_INSTRUCTIONS = """
 """
 
 
-def build_orchestrator_agent():
-    settings = get_settings()
-    if settings.openai_api_key:
-        set_default_openai_key(settings.openai_api_key)
-    agent = Agent(
+@lru_cache(maxsize=8)
+def _orchestrator_agent(model: str) -> Agent:
+    return Agent(
         name="Mail Orchestrator",
         instructions=ORCHESTRATOR_INSTRUCTIONS,
-        model=settings.orchestrator_model or settings.model,
+        model=model,
         output_type=EmailDecision,
-        tools=[
-            read_message,
-            save_attachments,
-            process_files,
-            resolve,
-            send,
-            cleanup,
-        ],
+        tools=resolve_tools(
+            [
+                read_message,
+                save_attachments,
+                preview_files,
+                process_files,
+                resolve,
+                send,
+                cleanup,
+            ]
+        ),
     )
-    return agent
+
+
+def build_orchestrator_agent(model: Optional[str] = None):
+    """Tool-calling agent; `model` overrides orchestrator_model/model (see model_router tiers).
+
+    One instance per model is built and reused: the agent holds no per-run state.
+    """
+    settings = get_snapshot().settings
+    if settings.openai_api_key:
+        set_default_openai_key(settings.openai_api_key)
+    return _orchestrator_agent(model or settings.orchestrator_model or settings.model)
@@ -1,8 +1,34 @@
 from __future__ import annotations
 
-from typing import List, Optional
+from functools import lru_cache
+from typing import Any, List, Optional
+
 from pydantic import BaseModel, Field
-from agents import Agent, ModelSettings
+
+
+TRIAGE_COMPOSE_INSTRUCTIONS = """
+[ROLE]
+Ты — классификатор и составитель писем. На вход уже подан готовый "текст для анализа": заголовки, тело письма, ссылки, список вложений с путями и извлечённый из вложений текст, а также таблица маршрутизации. Инструменты не нужны — всё необходимое уже в запросе.
+
+[TASK]
+1) Определи, релевантно ли письмо (не спам, не рассылка, требует действий/внимания).
+2) Если нерелевантно — is_relevant=false, кратко reason, пустой task_markdown, compose=null.
+3) Если релевантно — выбери категорию из таблицы маршрутизации и сформируй compose: to = адреса категории, subject = subject_prefix категории + суть письма, body_text = сжатое изложение задачи, attach_paths — только пути из списка вложений, которые нужно переслать. task_markdown — краткая постановка задачи в Markdown.
+4) confidence — твоя уверенность в решении от 0 до 1 (ниже 0.6, если данных не хватает или письмо неоднозначно).
+
+[GUARDRAILS]
+- НЕ переходи по ссылкам; не добавляй новых вложений и путей.
+- Не выдумывай факты; маскируй платёжные реквизиты (XXXX‑последние 4).
+- Отвечай на языке письма.
+- Если текст вложений обрезан и для решения не хватает данных — отметь это в reason.
+"""
+
+
+TRIAGE_COMPOSE_BATCH_SUFFIX = """
+[BATCH]
+В запросе несколько независимых писем. Таблица маршрутизации дана один раз в начале, каждое письмо начинается с заголовка "=== MESSAGE <index> ===".
+Реши каждое письмо отдельно по правилам выше, не смешивая их содержимое. Верни decisions — по одному элементу на каждое письмо, с тем же index.
+"""
 
 
 class ComposeEnvelope(BaseModel):
@@ -18,12 +44,41 @@ class ComposeDecision(BaseModel):
     reason: str
     task_markdown: str
     compose: Optional[ComposeEnvelope] = None
+    # Self-reported certainty (0..1); low values from the small model trigger escalation
+    confidence: Optional[float] = None
+
+
+class IndexedDecision(BaseModel):
+    index: int
+    decision: ComposeDecision
 
 
-def build_triage_compose_agent(instructions: str, model: str) -> Agent:
+class ComposeDecisionBatch(BaseModel):
+    decisions: List[IndexedDecision]
+
+
+# Agents are stateless between runs: one instance per (instructions, model) serves every message.
+# The SDK is imported on first build so that importing the decision models stays cheap.
+@lru_cache(maxsize=32)
+def build_triage_compose_agent(instructions: str, model: str) -> Any:
+    from agents import Agent
+
     return Agent(
         name="Triage & Composer",
         instructions=instructions,
         output_type=ComposeDecision,
         model=model,
     )
+
+
+@lru_cache(maxsize=32)
+def build_triage_compose_batch_agent(instructions: str, model: str) -> Any:
+    """Same prompt over several messages in one request; answers ComposeDecisionBatch."""
+    from agents import Agent
+
+    return Agent(
+        name="Triage & Composer (batch)",
+        instructions=instructions + TRIAGE_COMPOSE_BATCH_SUFFIX,
+        output_type=ComposeDecisionBatch,
+        model=model,
+    )
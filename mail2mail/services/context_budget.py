@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import os
+import re
+from typing import List, Optional, Sequence, Set, Tuple
+
+
+_BLOCK_SPLIT_RE = re.compile(r"\n[ \t]*\n+")
+_NORMALIZE_RE = re.compile(r"\W+")
+_TERM_RE = re.compile(r"\w{4,}")
+_DIGIT_RE = re.compile(r"\d")
+_TABLE_SEPARATORS = ("|", "\t", ";")
+_TABLE_KEEP_ROWS = 5
+_GAP = "[…]"
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token), enough for budgeting prompts."""
+    return len(text) // 4 + 1
+
+
+def attachments_max_tokens() -> int:
+    return int(os.getenv("TRIAGE_ATTACHMENTS_MAX_TOKENS", "2000"))
+
+
+def _blocks(text: str) -> List[str]:
+    return [b.strip() for b in _BLOCK_SPLIT_RE.split(text or "") if b.strip()]
+
+
+def _fingerprint(block: str) -> str:
+    return _NORMALIZE_RE.sub(" ", block.lower()).strip()
+
+
+def _table_separator(lines: Sequence[str]) -> Optional[str]:
+    """Column separator if most lines split into the same number of cells, else None."""
+    if len(lines) < 3:
+        return None
+    for sep in _TABLE_SEPARATORS:
+        counts = [line.count(sep) for line in lines]
+        common = max(set(counts), key=counts.count)
+        if common >= 1 and counts.count(common) >= 0.8 * len(lines):
+            return sep
+    return None
+
+
+def summarize_table(block: str, keep_rows: int = _TABLE_KEEP_ROWS) -> str:
+    """Header and first rows of a table-like block, with a note on what was left out."""
+    lines = block.splitlines()
+    sep = _table_separator(lines)
+    if sep is None or len(lines) <= keep_rows + 1:
+        return block
+    columns = lines[0].count(sep) + 1
+    return "\n".join(lines[: keep_rows + 1] + [f"[table: {len(lines) - 1} rows x {columns} columns, {len(lines) - 1 - keep_rows} rows omitted]"])
+
+
+def _score(block: str, position: int, query_terms: Set[str]) -> float:
+    """Earlier blocks, blocks sharing words with the message and blocks with figures rank higher."""
+    score = 1.0 / (1.0 + 0.25 * position)
+    terms = {t.lower() for t in _TERM_RE.findall(block)}
+    if terms and query_terms:
+        score += len(terms & query_terms) / len(terms)
+    score += min(len(_DIGIT_RE.findall(block)) / max(len(block), 1) * 5, 0.5)
+    if position == 0:
+        # Every attachment keeps at least its opening if the budget allows
+        score += 1.0
+    return score
+
+
+def fit_attachment_text(
+    sections: Sequence[Tuple[str, str]],
+    max_tokens: int,
+    query: str = "",
+) -> Tuple[str, bool]:
+    """Attachment text for the prompt within `max_tokens`; returns (text, trimmed).
+
+    `sections` are (name, extracted text) per attachment. Text is cut into blank-line
+    separated blocks; tables are shortened to their first rows, blocks repeated across
+    attachments or already in `query` (the message body) are dropped, and the best-ranked
+    blocks are kept in their original order.
+    """
+    seen: Set[str] = {_fingerprint(b) for b in _blocks(query)}
+    query_terms = {t.lower() for t in _TERM_RE.findall(query or "")}
+    candidates: List[Tuple[float, int, int, str]] = []
+    trimmed = False
+    for s_index, (_, text) in enumerate(sections):
+        position = 0
+        for block in _blocks(text):
+            key = _fingerprint(block)
+            if not key or key in seen:
+                trimmed = True
+                continue
+            seen.add(key)
+            short = summarize_table(block)
+            trimmed = trimmed or short is not block
+            candidates.append((_score(short, position, query_terms), s_index, position, short))
+            position += 1
+
+    budget = max(0, max_tokens)
+    chosen: List[Tuple[int, int, str]] = []
+    for _rank, s_index, position, block in sorted(candidates, key=lambda c: -c[0]):
+        cost = estimate_tokens(block)
+        if cost > budget:
+            trimmed = True
+            if budget < 64:
+                continue
+            block = block[: budget * 4].rstrip() + " …"
+            cost = budget
+        chosen.append((s_index, position, block))
+        budget -= cost
+
+    out: List[str] = []
+    chosen.sort()
+    for s_index, (name, _) in enumerate(sections):
+        blocks = [(p, b) for i, p, b in chosen if i == s_index]
+        if not blocks:
+            continue
+        out.append(f"--- {os.path.basename(name)} ---")
+        previous = -1
+        for position, block in blocks:
+            if position != previous + 1:
+                out.append(_GAP)
+            out.append(block)
+            previous = position
+    return "\n\n".join(out), trimmed
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from email.utils import parseaddr
+from typing import Any, Dict, List, Optional
+
+from mail2mail.services.metrics import count_cache
+
+
+_SUBJECT_PREFIX_RE = re.compile(r"^\s*((re|fw|fwd|aw|wg|ответ|пересл)\s*(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+_VOLATILE_RE = re.compile(r"\b[0-9a-f]{8,}\b|\d+", re.IGNORECASE)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def subject_template(subject: str) -> str:
+    """Subject with reply/forward prefixes dropped and numbers/ids replaced by '#'."""
+    s = _SUBJECT_PREFIX_RE.sub("", subject or "")
+    s = _VOLATILE_RE.sub("#", s.lower())
+    return " ".join(s.split())
+
+
+def simhash(text: str, shingle: int = 3) -> int:
+    """64-bit SimHash over word shingles; numbers are normalized so counters don't matter."""
+    words = [_VOLATILE_RE.sub("#", w) for w in _WORD_RE.findall((text or "").lower())]
+    if not words:
+        return 0
+    grams = [" ".join(words[i : i + shingle]) for i in range(max(1, len(words) - shingle + 1))]
+    weights = [0] * 64
+    for gram in grams:
+        h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return value
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+class Fingerprint:
+    def __init__(self, sender: str, template: str, body_hash: int):
+        self.sender = sender
+        self.template = template
+        self.body_hash = body_hash
+
+    @property
+    def bucket(self) -> str:
+        return hashlib.sha256(f"{self.sender}\x00{self.template}".encode("utf-8")).hexdigest()
+
+    @property
+    def exact(self) -> str:
+        return hashlib.sha256(f"{self.bucket}\x00{self.body_hash}".encode("utf-8")).hexdigest()
+
+
+def fingerprint(message: Dict[str, Any]) -> Fingerprint:
+    headers = {str(k).lower(): str(v) for k, v in (message.get("headers") or {}).items()}
+    sender = parseaddr(headers.get("from", ""))[1].lower()
+    body = message.get("text_plain") or _TAG_RE.sub(" ", message.get("text_html") or "")
+    return Fingerprint(sender, subject_template(headers.get("subject", "")), simhash(body[:20000]))
+
+
+def config_version(instructions: str, model: str, route: Optional[Dict[str, Any]]) -> str:
+    """Version tag for cached decisions: changes when the prompt, model or the category's rule changes."""
+    data = json.dumps({"i": instructions, "m": model, "r": route}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+class DecisionCache:
+    """SQLite-backed cache of triage decisions keyed by normalized message fingerprints.
+
+    Lookups try the exact fingerprint first, then near-duplicates from the same
+    sender/subject-template bucket within `max_distance` SimHash bits.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, max_distance: int = 3):
+        self.path = path
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS decisions ("
+                " exact TEXT PRIMARY KEY, bucket TEXT NOT NULL, body_hash INTEGER NOT NULL,"
+                " kind TEXT NOT NULL, category TEXT, version TEXT NOT NULL,"
+                " payload TEXT NOT NULL, created_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS decisions_bucket ON decisions (bucket, kind)")
+            conn.execute("CREATE INDEX IF NOT EXISTS decisions_category ON decisions (category)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, reused; `with conn` only commits or rolls back
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def lookup(
+        self,
+        fp: Fingerprint,
+        kind: str,
+        version_for: Any,
+    ) -> Optional[Dict[str, Any]]:
+        """Return {"payload", "category", "near"} or None.
+
+        `version_for(category)` yields the current config version for a category; entries
+        stored under another version are stale and dropped.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT exact, body_hash, category, version, payload, created_at FROM decisions"
+                " WHERE bucket = ? AND kind = ? ORDER BY created_at DESC LIMIT 50",
+                (fp.bucket, kind),
+            ).fetchall()
+            best = None
+            stale: List[str] = []
+            for exact, body_hash, category, version, payload, created_at in rows:
+                if now - created_at > self.ttl or version != version_for(category):
+                    stale.append(exact)
+                    continue
+                if exact == fp.exact:
+                    best = (exact, category, payload, False)
+                    break
+                if best is None and _hamming(int(body_hash), _to_signed(fp.body_hash)) <= self.max_distance:
+                    best = (exact, category, payload, True)
+            if stale:
+                conn.executemany("DELETE FROM decisions WHERE exact = ?", [(e,) for e in stale])
+                self.invalidations += len(stale)
+            if best is None:
+                self.misses += 1
+                count_cache("decision", "miss")
+                return None
+            conn.execute("UPDATE decisions SET hits = hits + 1 WHERE exact = ?", (best[0],))
+            if best[3]:
+                self.near_hits += 1
+            else:
+                self.exact_hits += 1
+            count_cache("decision", "near_hit" if best[3] else "hit")
+        return {"payload": json.loads(best[2]), "category": best[1], "near": best[3]}
+
+    def store(self, fp: Fingerprint, kind: str, payload: Dict[str, Any], category: Optional[str], version: str) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO decisions (exact, bucket, body_hash, kind, category, version, payload, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    fp.exact,
+                    fp.bucket,
+                    _to_signed(fp.body_hash),
+                    kind,
+                    category,
+                    version,
+                    json.dumps(payload, ensure_ascii=False),
+                    time.time(),
+                ),
+            )
+            self.stores += 1
+
+    def invalidate(self, category: Optional[str] = None) -> int:
+        """Drop cached decisions for one category, or everything when `category` is None."""
+        with self._lock, self._connect() as conn:
+            if category is None:
+                cur = conn.execute("DELETE FROM decisions")
+            else:
+                cur = conn.execute("DELETE FROM decisions WHERE category = ?", (category,))
+            self.invalidations += cur.rowcount
+            return cur.rowcount
+
+    def purge_expired(self) -> int:
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM decisions WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.exact_hits + self.near_hits + self.misses
+            out: Dict[str, Any] = {
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+                "hit_rate": (self.exact_hits + self.near_hits) / lookups if lookups else 0.0,
+            }
+            with self._connect() as conn:
+                entries, total_hits = conn.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM decisions").fetchone()
+        out["entries"] = entries
+        out["lifetime_hits"] = total_hits
+        return out
+
+
+_CACHE: Optional[DecisionCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_decision_cache() -> Optional[DecisionCache]:
+    """Process-wide cache, or None when DECISION_CACHE_ENABLED=false."""
+    global _CACHE
+    if os.getenv("DECISION_CACHE_ENABLED", "true").strip().lower() in ("0", "false", "no"):
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            data_dir = os.getenv("DATA_DIR") or os.getcwd()
+            _CACHE = DecisionCache(
+                os.getenv("DECISION_CACHE_DB", os.path.join(data_dir, "decision_cache.sqlite3")),
+                ttl=float(os.getenv("DECISION_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+                max_distance=int(os.getenv("DECISION_CACHE_MAX_DISTANCE", "3")),
+            )
+        return _CACHE
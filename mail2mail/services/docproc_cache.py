@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from mail2mail.services.metrics import count_cache
+
+
+class DocprocCache:
+    """On-disk, content-addressed cache of Documents_processor results.
+
+    Keys are SHA-256 of the file bytes plus the processing options and the vision model,
+    so a re-sent invoice hits the cache regardless of its filename. Entries are evicted
+    oldest-access first once the directory exceeds `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max(1, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._total: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(path: str, options: Optional[Dict[str, Any]] = None) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        variant = {
+            "options": options or {},
+            "vision_model": os.getenv("DOCS_VISION_MODEL") or "",
+        }
+        h.update(json.dumps(variant, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def _path_for(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path_for(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            os.utime(path)  # recency for eviction
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            count_cache("docproc", "miss")
+            return None
+        with self._lock:
+            self.hits += 1
+        count_cache("docproc", "hit")
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]) -> bool:
+        try:
+            payload = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        except (TypeError, ValueError):
+            return False
+        path = self._path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.stores += 1
+            if self._total is None:
+                self._total = sum(size for _, _, size in self._scan())
+            else:
+                self._total += len(payload)
+            if self._total > self.max_bytes:
+                self._evict_locked()
+        return True
+
+    def _scan(self) -> List[Tuple[float, str, int]]:
+        entries: List[Tuple[float, str, int]] = []
+        if not os.path.isdir(self.root):
+            return entries
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(".json"):
+                    continue
+                full = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, full, st.st_size))
+        return entries
+
+    def _evict_locked(self) -> None:
+        entries = sorted(self._scan())
+        total = sum(size for _, _, size in entries)
+        # Evict down to 90% so we don't rescan on every put near the limit
+        target = int(self.max_bytes * 0.9)
+        for _, full, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(full)
+                total -= size
+                self.evictions += 1
+            except OSError:
+                pass
+        self._total = total
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "bytes": self._total or 0,
+            }
+
+
+_CACHE: Optional[DocprocCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_docproc_cache() -> Optional[DocprocCache]:
+    """Process-wide cache, or None when DOCPROC_CACHE_ENABLED=false."""
+    global _CACHE
+    if os.getenv("DOCPROC_CACHE_ENABLED", "true").strip().lower() in ("0", "false", "no"):
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            data_dir = os.getenv("DATA_DIR") or os.path.join(os.getcwd(), "cache")
+            _CACHE = DocprocCache(
+                root=os.getenv("DOCPROC_CACHE_DIR", os.path.join(data_dir, "docproc_cache")),
+                max_bytes=int(os.getenv("DOCPROC_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))),
+            )
+        return _CACHE
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing.connection import wait
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def processor_env(page_limits: Optional[int], vision_descriptions: Optional[bool]) -> Dict[str, str]:
+    """Environment overrides understood by Documents_processor for one call."""
+    env: Dict[str, str] = {}
+    if page_limits is not None:
+        env["MAX_DOCUMENT_PAGES"] = str(page_limits)
+        env["DISABLE_PAGE_LIMIT"] = "false"
+    if vision_descriptions is not None:
+        env["MAX_VISION_CALLS_PER_PAGE"] = "50" if vision_descriptions else "0"
+    docs_vision_model = os.getenv("DOCS_VISION_MODEL")
+    if docs_vision_model:
+        env["DOCS_VISION_MODEL"] = docs_vision_model
+    return env
+
+
+def execution_mode() -> str:
+    """DOCPROC_EXECUTION: "inline" (default, in this process) or "process" (isolated children)."""
+    return os.getenv("DOCPROC_EXECUTION", "inline").strip().lower()
+
+
+def error_result(message: str) -> Dict[str, Any]:
+    return {
+        "extracted_text": f"[documents_processor error] {message}",
+        "tables": [],
+        "images": [],
+        "notes": [f"documents_processor failure: {message}"],
+    }
+
+
+_EXT_DIR = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")), "external", "Documents_processor")
+_DOCUMENT_CLASS: Any = None
+_DOCUMENT_LOCK = threading.Lock()
+
+
+def _ensure_ext_path() -> None:
+    if _EXT_DIR not in sys.path:
+        sys.path.insert(0, _EXT_DIR)
+
+
+def document_class() -> Any:
+    """documents_processor.Document, imported once per process rather than once per file."""
+    global _DOCUMENT_CLASS
+    if _DOCUMENT_CLASS is None:
+        with _DOCUMENT_LOCK:
+            if _DOCUMENT_CLASS is None:
+                _ensure_ext_path()
+                from documents_processor import Document  # type: ignore
+
+                _DOCUMENT_CLASS = Document
+    return _DOCUMENT_CLASS
+
+
+def preload() -> None:
+    """Pay the Documents_processor import before the first file: in this process for inline
+    calls, or in the forkserver that DOCPROC_EXECUTION=process children fork from."""
+    if execution_mode() != "process":
+        document_class()
+        return
+    if _mp_context().get_start_method() == "forkserver":
+        from multiprocessing import forkserver
+
+        forkserver.ensure_running()
+
+
+def process_document(path: str) -> Dict[str, Any]:
+    """Run Documents_processor on `path` with whatever environment is already in place."""
+    doc = document_class()(path)
+    doc.process()
+    return {
+        "extracted_text": getattr(doc, "text_content", "") or "",
+        "tables": getattr(doc, "tables", []) or [],
+        "images": getattr(doc, "images", []) or [],
+        "notes": [],
+    }
+
+
+def _child_main(conn: Any, path: str, env: Dict[str, str], memory_limit_mb: int) -> None:
+    # Options travel explicitly; the environment mutated here is this child's only
+    os.environ.update(env)
+    if memory_limit_mb > 0:
+        try:
+            import resource
+
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+    try:
+        result = process_document(path)
+    except MemoryError:
+        result = error_result(f"memory limit of {memory_limit_mb} MB exceeded")
+    except Exception as e:
+        result = error_result(str(e))
+    try:
+        conn.send(result)
+    except Exception as e:  # unpicklable payload from the library
+        conn.send(error_result(f"result transfer failed: {e}"))
+    finally:
+        conn.close()
+
+
+def _mp_context() -> Any:
+    method = os.getenv("DOCPROC_MP_START")
+    if not method:
+        # forkserver children don't inherit the parent's threads/locks (IMAP keepalive, SDK clients)
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    ctx = multiprocessing.get_context(method)
+    if method == "forkserver":
+        # Children fork from a server that already imported Documents_processor (unavailable
+        # modules are skipped); only takes effect before the server first starts
+        _ensure_ext_path()
+        ctx.set_forkserver_preload(["mail2mail.services.docproc_pool", "documents_processor"])
+    return ctx
+
+
+def run_isolated(
+    paths: List[str],
+    env: Dict[str, str],
+    workers: int,
+    timeout: float,
+    memory_limit_mb: int = 0,
+) -> List[Dict[str, Any]]:
+    """Process each path in its own child process, at most `workers` at a time.
+
+    A child that exceeds `timeout` seconds is killed and reported as a failure; results
+    come back in the order of `paths`.
+    """
+    ctx = _mp_context()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(paths)
+    pending: List[Tuple[int, str]] = list(enumerate(paths))
+    running: Dict[int, Tuple[Any, Any, float]] = {}
+    workers = max(1, workers)
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                idx, path = pending.pop(0)
+                recv_conn, send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(
+                    target=_child_main,
+                    args=(send_conn, path, env, memory_limit_mb),
+                    name=f"docproc-{idx}",
+                    daemon=True,
+                )
+                proc.start()
+                send_conn.close()
+                running[idx] = (proc, recv_conn, time.monotonic())
+
+            ready = wait([conn for _, conn, _ in running.values()], timeout=0.5)
+            now = time.monotonic()
+            for idx, (proc, conn, started) in list(running.items()):
+                if conn in ready:
+                    try:
+                        results[idx] = conn.recv()
+                    except (EOFError, OSError):
+                        proc.join(1)
+                        results[idx] = error_result(f"worker exited with code {proc.exitcode}")
+                elif now - started > timeout:
+                    proc.kill()
+                    results[idx] = error_result(f"timed out after {timeout:.0f}s")
+                else:
+                    continue
+                conn.close()
+                proc.join(5)
+                del running[idx]
+    finally:
+        for proc, conn, _ in running.values():
+            proc.kill()
+            conn.close()
+
+    return [r if r is not None else error_result("no result") for r in results]
@@ -0,0 +1,535 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import socket
+import ssl
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from imapclient import imap_utf7
+
+from mail2mail.services.ledger import get_ledger
+from mail2mail.services.metrics import REGISTRY, Collector, MetricFamily, message_scope, serve_metrics
+from mail2mail.services.queue_db import get_queue_db
+from mail2mail.services.scheduler import MessageScheduler, scheduler_from_env
+from mail2mail.services.warmup import mark, mark_ready, start_warmup, startup_metrics
+from mail2mail.settings import get_imap_config
+
+
+logger = logging.getLogger(__name__)
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+_UIDVALIDITY_RE = re.compile(rb"\[UIDVALIDITY (\d+)\]", re.IGNORECASE)
+_UIDNEXT_RE = re.compile(rb"\[UIDNEXT (\d+)\]", re.IGNORECASE)
+_FETCH_UID_RE = re.compile(rb"\bUID (\d+)", re.IGNORECASE)
+_MESSAGE_ID_RE = re.compile(rb"^Message-ID:\s*(.+?)\s*$", re.IGNORECASE | re.MULTILINE)
+_CAPABILITY_RE = re.compile(rb"\[CAPABILITY ([^\]]*)\]", re.IGNORECASE)
+
+
+class ImapProtocolError(Exception):
+    pass
+
+
+def _astring(value: str) -> Any:
+    """Quoted string when it is plain ASCII, otherwise a literal (bytes)."""
+    if value.isascii() and value.isprintable():
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return value.encode("utf-8")
+
+
+class AsyncImapClient:
+    """Just enough IMAP4rev1 over asyncio streams to SELECT, SEARCH and IDLE."""
+
+    def __init__(self, host: str, port: int, use_ssl: bool = True, timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.capabilities: Set[str] = set()
+        self.uidvalidity: Optional[int] = None
+        self.uidnext: Optional[int] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tag = 0
+
+    async def connect(self) -> None:
+        ctx = ssl.create_default_context() if self.use_ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ctx, limit=1024 * 1024), self.timeout
+        )
+        greeting = await self._read_response(self.timeout)
+        if not greeting.startswith(b"* OK") and not greeting.startswith(b"* PREAUTH"):
+            raise ImapProtocolError(f"unexpected greeting: {greeting[:200]!r}")
+        self._parse_capabilities(greeting)
+
+    async def _read_response(self, timeout: Optional[float]) -> bytes:
+        """One response line with any literals inlined."""
+        assert self._reader is not None
+        line = await asyncio.wait_for(self._reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("IMAP connection closed")
+        while True:
+            m = _LITERAL_RE.search(line)
+            if not m:
+                return line
+            line += await asyncio.wait_for(self._reader.readexactly(int(m.group(1))), self.timeout)
+            more = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            if not more:
+                raise ConnectionError("IMAP connection closed")
+            line += more
+
+    def _parse_capabilities(self, line: bytes) -> None:
+        m = _CAPABILITY_RE.search(line)
+        if m:
+            self.capabilities = {c.upper() for c in m.group(1).decode("ascii", "replace").split()}
+        elif line.upper().startswith(b"* CAPABILITY "):
+            self.capabilities = {c.upper() for c in line[13:].decode("ascii", "replace").split()}
+
+    def _next_tag(self) -> bytes:
+        self._tag += 1
+        return b"M%04d" % self._tag
+
+    async def _send(self, data: bytes) -> None:
+        assert self._writer is not None
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _continuation(self) -> None:
+        line = await self._read_response(self.timeout)
+        if not line.startswith(b"+"):
+            raise ImapProtocolError(f"expected continuation, got {line[:200]!r}")
+
+    async def command(self, *args: Any) -> List[bytes]:
+        """Run a tagged command; returns untagged lines. bytes args go out as literals."""
+        tag = self._next_tag()
+        head = tag
+        for arg in args:
+            if isinstance(arg, bytes):
+                await self._send(head + b" {%d}\r\n" % len(arg))
+                await self._continuation()
+                head = arg
+            else:
+                head += b" " + str(arg).encode("ascii")
+        await self._send(head + b"\r\n")
+        untagged: List[bytes] = []
+        while True:
+            line = await self._read_response(self.timeout)
+            if line.startswith(tag + b" "):
+                status = line[len(tag) + 1 :]
+                if not status.upper().startswith(b"OK"):
+                    raise ImapProtocolError(line.decode("utf-8", "replace").strip())
+                self._parse_capabilities(line)
+                return untagged
+            self._parse_capabilities(line)
+            untagged.append(line)
+
+    async def login(self, username: str, password: str) -> None:
+        await self.command("LOGIN", _astring(username), _astring(password))
+        if not self.capabilities or "IMAP4REV1" not in self.capabilities:
+            await self.command("CAPABILITY")
+
+    async def select(self, mailbox: str) -> None:
+        for line in await self.command("SELECT", _astring(imap_utf7.encode(mailbox).decode("ascii"))):
+            m = _UIDVALIDITY_RE.search(line)
+            if m:
+                self.uidvalidity = int(m.group(1))
+            m = _UIDNEXT_RE.search(line)
+            if m:
+                self.uidnext = int(m.group(1))
+
+    async def search_unseen(self) -> List[int]:
+        uids: List[int] = []
+        for line in await self.command("UID", "SEARCH", "UNSEEN"):
+            if line.upper().startswith(b"* SEARCH"):
+                uids.extend(int(x) for x in line[8:].split() if x.isdigit())
+        return uids
+
+    async def fetch_message_ids(self, uid_set: str) -> List[Tuple[int, Optional[str]]]:
+        """(uid, Message-ID) for a UID set such as "42:*" or "3,7,9", headers only."""
+        out: List[Tuple[int, Optional[str]]] = []
+        for line in await self.command("UID", "FETCH", uid_set, "(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])"):
+            if b" FETCH " not in line.upper():
+                continue
+            m = _FETCH_UID_RE.search(line)
+            if not m:
+                continue
+            mid = _MESSAGE_ID_RE.search(line)
+            out.append((int(m.group(1)), mid.group(1).decode("utf-8", "replace") if mid else None))
+        return out
+
+    @property
+    def supports_idle(self) -> bool:
+        return "IDLE" in self.capabilities
+
+    async def idle(self, timeout: float) -> bool:
+        """IDLE until the server reports new mail or `timeout` passes; True on new mail."""
+        tag = self._next_tag()
+        await self._send(tag + b" IDLE\r\n")
+        await self._continuation()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        new_mail = False
+        try:
+            while not new_mail:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    line = await self._read_response(remaining)
+                except asyncio.TimeoutError:
+                    break
+                parts = line.upper().split()
+                if len(parts) >= 3 and parts[0] == b"*" and parts[2] in (b"EXISTS", b"RECENT"):
+                    new_mail = True
+        finally:
+            await self._send(b"DONE\r\n")
+            while True:
+                line = await self._read_response(self.timeout)
+                if line.startswith(tag + b" "):
+                    break
+        return new_mail
+
+    async def logout(self) -> None:
+        if self._writer is None:
+            return
+        try:
+            await asyncio.wait_for(self.command("LOGOUT"), 5)
+        except Exception:
+            pass
+        finally:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+            self._writer = None
+
+
+def _mailboxes_path() -> str:
+    base = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    return os.getenv("ADMIN_MAILBOXES_PATH", os.path.join(base, "admin_mailboxes.json"))
+
+
+def load_mailbox_ids(path: Optional[str] = None) -> List[str]:
+    """Enabled account ids from admin_mailboxes.json (list, {"mailboxes": [...]} or {id: {...}})."""
+    path = path or _mailboxes_path()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if isinstance(data, dict) and isinstance(data.get("mailboxes"), list):
+        data = data["mailboxes"]
+    entries: List[Tuple[str, Dict[str, Any]]] = []
+    if isinstance(data, dict):
+        entries = [(str(k), v if isinstance(v, dict) else {}) for k, v in data.items()]
+    elif isinstance(data, list):
+        for item in data:
+            if isinstance(item, dict):
+                ident = item.get("id") or item.get("account_id") or item.get("name")
+                if ident:
+                    entries.append((str(ident), item))
+            elif isinstance(item, str):
+                entries.append((item, {}))
+    return [ident for ident, cfg in entries if cfg.get("enabled", cfg.get("active", True))]
+
+
+def _worker_prefix() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:"
+
+
+def _claim(account_id: str, message_id: str, worker: str) -> Optional[int]:
+    """Claim the message's queue item under a lease; enqueues it first for direct callers."""
+    db = get_queue_db()
+    lease = float(os.getenv("QUEUE_LEASE_SECONDS", "900"))
+    items = db.claim(worker, lease, account_id=account_id, message_id=message_id)
+    if not items and db.find(account_id, message_id) is None:
+        db.enqueue(account_id, message_id)
+        items = db.claim(worker, lease, account_id=account_id, message_id=message_id)
+    return int(items[0]["id"]) if items else None
+
+
+def _deliver_and_record(
+    account_id: str,
+    message_id: str,
+    run: Callable[[], Any],
+    item_id: Optional[int] = None,
+    worker: Optional[str] = None,
+) -> None:
+    from mail2mail.services.pipeline import deliver, finish
+
+    db = get_queue_db()
+    try:
+        with message_scope(account_id, message_id):
+            # Blocking I/O stays on this worker thread; model calls inside go to the shared
+            # model loop (scheduler.get_model_loop), never to this short-lived one
+            result = asyncio.run(run())
+            try:
+                sent = deliver(result)
+            finally:
+                finish(result)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if item_id is None:
+            db.record(account_id, message_id, "failed", error=error)
+        else:
+            # Back to the queue until the ledger gives the message up as well
+            db.nack(item_id, error, max_attempts=int(os.getenv("LEDGER_MAX_ATTEMPTS", "3")), worker=worker)
+        raise
+    status, payload = "sent" if sent else result.status, {**result.model_dump(), "sent": sent}
+    if item_id is None:
+        db.record(account_id, message_id, status, result=payload)
+    else:
+        db.ack(item_id, status, payload, worker=worker)
+
+
+def process_and_deliver(account_id: str, message_id: str) -> None:
+    """Default handler: run the pipeline for one message, send the result, log it and clean up."""
+    from mail2mail.services.pipeline import process_message
+
+    worker = _worker_prefix() + threading.current_thread().name
+    item_id = _claim(account_id, message_id, worker)
+    if item_id is None:
+        # Held by another worker under a live lease: that worker delivers it
+        logger.info("%s %s is claimed by another worker; skipping", account_id, message_id)
+        return
+    _deliver_and_record(account_id, message_id, lambda: process_message(account_id, message_id), item_id, worker)
+
+
+def deliver_deferred(item: Dict[str, Any], decision: Optional[Any]) -> None:
+    """OfflineTriage handler: finish a message whose triage came back from the Batch API."""
+    from mail2mail.services.pipeline import complete_deferred
+
+    _deliver_and_record(item["account_id"], item["message_id"], lambda: complete_deferred(item, decision))
+
+
+Handler = Callable[[str, str], Any]
+
+
+class IdleMonitor:
+    """Watch many mailboxes from one event loop.
+
+    Each mailbox holds one IDLE connection (or polls with jittered backoff when the
+    server lacks IDLE). New UIDs go to a MessageScheduler with bounded queues and a
+    fixed number of workers, so memory and processing concurrency don't grow with the
+    mailbox count.
+    """
+
+    def __init__(
+        self,
+        handler: Optional[Handler] = None,
+        scheduler: Optional[MessageScheduler] = None,
+        poll_interval: float = 60.0,
+        idle_timeout: float = 1500.0,
+        backoff_max: float = 300.0,
+        reload_interval: float = 30.0,
+    ):
+        self.scheduler = scheduler or scheduler_from_env(handler or process_and_deliver)
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.backoff_max = backoff_max
+        self.reload_interval = reload_interval
+        self._inflight: Set[Tuple[str, int]] = set()
+        self._watchers: Dict[str, asyncio.Task] = {}
+        self._modes: Dict[str, str] = {}
+
+    def _backoff(self, failures: int) -> float:
+        delay = min(self.backoff_max, 2.0 ** min(failures, 16))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _candidates(self, client: AsyncImapClient, account_id: str, mailbox: str) -> List[Tuple[int, Optional[str]]]:
+        """UIDs (with Message-ID) that may need processing, from the ledger's high-water mark on."""
+        ledger = get_ledger()
+        uidvalidity = client.uidvalidity
+        high = ledger.sync(account_id, mailbox, uidvalidity)
+        if uidvalidity is None:
+            # No UIDVALIDITY, no stable UIDs: plain UNSEEN scan (Message-ID dedupe still applies)
+            return await self._fetch_ids(client, await client.search_unseen())
+        if high is None:
+            # First run or UIDVALIDITY reset: take what is unread now, then track by UID
+            unseen = await client.search_unseen()
+            top = (client.uidnext - 1) if client.uidnext else max(unseen, default=0)
+            ledger.bootstrap(account_id, mailbox, uidvalidity, top)
+            return await self._fetch_ids(client, unseen)
+        found = [(u, m) for u, m in await client.fetch_message_ids(f"{high + 1}:*") if u > high]
+        retry = set(ledger.pending(account_id, mailbox, uidvalidity)) - {u for u, _ in found}
+        return found + await self._fetch_ids(client, sorted(retry))
+
+    @staticmethod
+    async def _fetch_ids(client: AsyncImapClient, uids: List[int]) -> List[Tuple[int, Optional[str]]]:
+        out: List[Tuple[int, Optional[str]]] = []
+        for i in range(0, len(uids), 500):
+            out += await client.fetch_message_ids(",".join(str(u) for u in uids[i : i + 500]))
+        return out
+
+    async def _dispatch(self, account_id: str, mailbox: str, uidvalidity: Optional[int], found: List[Tuple[int, Optional[str]]]) -> None:
+        loop = asyncio.get_running_loop()
+        ledger = get_ledger()
+        for uid, message_id in sorted(found):
+            key = (account_id, uid)
+            if key in self._inflight:
+                continue
+            if uidvalidity is not None and ledger.begin(account_id, mailbox, uidvalidity, uid, message_id) != "process":
+                continue
+            # Visible as queued in the store; the worker claims it by message id
+            get_queue_db().enqueue(account_id, f"imap:{uid}", mailbox, uid, uidvalidity, requeue=True)
+            self._inflight.add(key)
+
+            def done(error: Optional[BaseException], key: Tuple[str, int] = key) -> None:
+                if uidvalidity is not None:
+                    if error is None:
+                        ledger.complete(account_id, mailbox, uidvalidity, key[1])
+                    else:
+                        # Not on every IDLE wake: wait before the next attempt
+                        delay = ledger.retry_later(account_id, mailbox, uidvalidity, key[1])
+                        logger.warning("mailbox %s: UID %d failed (%s); retrying in %.0fs", account_id, key[1], error, delay)
+                try:
+                    loop.call_soon_threadsafe(self._inflight.discard, key)
+                except RuntimeError:  # loop already closed
+                    pass
+
+            # Blocks while the scheduler is full: backpressure on the watcher, not unbounded memory
+            await asyncio.to_thread(self.scheduler.submit, account_id, f"imap:{uid}", done)
+
+    async def _session(self, account_id: str, cfg: Any, on_ready: Callable[[], None]) -> None:
+        client = AsyncImapClient(cfg.host, int(cfg.port), bool(cfg.use_ssl))
+        try:
+            await client.connect()
+            await client.login(cfg.username, cfg.password)
+            await client.select(cfg.mailbox)
+            self._modes[account_id] = "idle" if client.supports_idle else "poll"
+            on_ready()
+            get_ledger().prune()
+            while True:
+                found = await self._candidates(client, account_id, cfg.mailbox)
+                await self._dispatch(account_id, cfg.mailbox, client.uidvalidity, found)
+                if client.supports_idle:
+                    await client.idle(self.idle_timeout)
+                else:
+                    await asyncio.sleep(self.poll_interval * random.uniform(0.8, 1.2))
+        finally:
+            await client.logout()
+
+    async def _watch(self, account_id: str) -> None:
+        failures = 0
+
+        def reset() -> None:
+            nonlocal failures
+            failures = 0
+
+        while True:
+            try:
+                cfg = get_imap_config(account_id)
+                if not cfg:
+                    raise ValueError("IMAP config not found for account")
+                await self._session(account_id, cfg, reset)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                delay = self._backoff(failures)
+                self._modes[account_id] = "backoff"
+                logger.warning("mailbox %s: %s; retrying in %.0fs", account_id, e, delay)
+                await asyncio.sleep(delay)
+
+    def _reconcile(self, account_ids: List[str]) -> None:
+        wanted = set(account_ids)
+        for account_id in list(self._watchers):
+            if account_id not in wanted:
+                self._watchers.pop(account_id).cancel()
+                self._modes.pop(account_id, None)
+        for account_id in account_ids:
+            if account_id not in self._watchers:
+                self._watchers[account_id] = asyncio.create_task(self._watch(account_id), name=f"watch-{account_id}")
+
+    async def run(self, account_ids: Optional[List[str]] = None) -> None:
+        """Run until cancelled. Without `account_ids`, follow admin_mailboxes.json as it changes."""
+        from mail2mail.services.triage_batch import get_offline_triage, offline_triage_accounts
+
+        # Claims of an earlier run of the monitor on this host died with it
+        get_queue_db().requeue(f"{socket.gethostname()}:", keep_prefix=_worker_prefix())
+        self.scheduler.start()
+        if offline_triage_accounts():
+            get_offline_triage().start(deliver_deferred)
+        try:
+            if account_ids is not None:
+                self._reconcile(account_ids)
+                mark_ready()
+                await asyncio.gather(*self._watchers.values())
+                return
+            path = _mailboxes_path()
+            mtime: Optional[float] = None
+            while True:
+                try:
+                    current = os.path.getmtime(path)
+                except OSError:
+                    current = None
+                if current != mtime:
+                    mtime = current
+                    self._reconcile(load_mailbox_ids(path))
+                    mark_ready()
+                await asyncio.sleep(self.reload_interval)
+        finally:
+            for task in self._watchers.values():
+                task.cancel()
+            await asyncio.gather(*self._watchers.values(), return_exceptions=True)
+            self._watchers.clear()
+            self.scheduler.stop(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mailboxes": len(self._watchers),
+            "modes": dict(self._modes),
+            "in_flight": len(self._inflight),
+            **self.scheduler.stats(),
+        }
+
+
+def monitor_metrics(monitor: IdleMonitor) -> Collector:
+    """Scrape-time collector for watcher and scheduler state (see MetricsRegistry.add_collector)."""
+
+    def collect() -> List[MetricFamily]:
+        stats = monitor.stats()
+        modes: Dict[str, int] = {}
+        for mode in stats["modes"].values():
+            modes[mode] = modes.get(mode, 0) + 1
+        return [
+            ("mail2mail_monitor_mailboxes", "gauge", "Watched mailboxes by mode.", [({"mode": m}, n) for m, n in sorted(modes.items())]),
+            ("mail2mail_scheduler_queued", "gauge", "Messages waiting for a worker.", [({}, stats["queued"])]),
+            ("mail2mail_scheduler_running", "gauge", "Messages being processed.", [({}, stats["running"])]),
+            ("mail2mail_scheduler_processed_total", "counter", "Messages processed.", [({}, stats["processed"])]),
+            ("mail2mail_scheduler_failed_total", "counter", "Messages whose handler raised.", [({}, stats["failed"])]),
+        ]
+
+    return collect
+
+
+def monitor_from_env(handler: Optional[Handler] = None) -> IdleMonitor:
+    return IdleMonitor(
+        handler=handler,
+        poll_interval=float(os.getenv("MONITOR_POLL_SECONDS", "60")),
+        idle_timeout=float(os.getenv("MONITOR_IDLE_SECONDS", "1500")),
+        backoff_max=float(os.getenv("MONITOR_BACKOFF_MAX_SECONDS", "300")),
+        reload_interval=float(os.getenv("MONITOR_RELOAD_SECONDS", "30")),
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    mark("imports")
+    # Agents, SDK and Documents_processor load in the background; watching starts right away
+    start_warmup()
+    monitor = monitor_from_env()
+    if os.getenv("METRICS_PORT"):
+        REGISTRY.add_collector(monitor_metrics(monitor))
+        REGISTRY.add_collector(startup_metrics())
+        serve_metrics(int(os.getenv("METRICS_PORT", "0")))
+    try:
+        asyncio.run(monitor.run())
+    except KeyboardInterrupt:
+        pass
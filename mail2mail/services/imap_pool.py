@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import imaplib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from imapclient import IMAPClient
+
+from mail2mail.services.settings_cache import imap_config
+
+
+PoolKey = Tuple[str, int, bool, str, str]
+
+# Errors that mean the connection itself is unusable and must be dropped.
+_CONNECTION_ERRORS = (imaplib.IMAP4.error, OSError, EOFError)
+
+
+class ImapSession:
+    """A logged-in IMAP connection with its mailbox already selected."""
+
+    def __init__(self, key: PoolKey, client: IMAPClient, mailbox: str, uidvalidity: Optional[int]):
+        self.key = key
+        self.client = client
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def close(self) -> None:
+        try:
+            self.client.logout()
+        except Exception:
+            try:
+                self.client.shutdown()
+            except Exception:
+                pass
+
+
+class ImapPool:
+    """Per-account pool of IMAP sessions.
+
+    Sessions are keyed by the `imap_config` result (host, port, ssl, user, mailbox),
+    so every tool touching the same mailbox shares one login. Idle sessions are probed with
+    NOOP before reuse and transparently reconnected when the probe or an operation fails.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 2,
+        noop_after: float = 60.0,
+        max_idle: float = 600.0,
+        acquire_timeout: float = 120.0,
+    ):
+        self.max_sessions = max(1, max_sessions)
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self.acquire_timeout = acquire_timeout
+        self._lock = threading.Lock()
+        self._idle: Dict[PoolKey, List[ImapSession]] = {}
+        self._slots: Dict[PoolKey, threading.BoundedSemaphore] = {}
+        self._keepalive_thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _key_for(cfg: Any) -> PoolKey:
+        return (str(cfg.host), int(cfg.port), bool(cfg.use_ssl), str(cfg.username), str(cfg.mailbox))
+
+    def _slot(self, key: PoolKey) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._slots.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_sessions)
+                self._slots[key] = sem
+            return sem
+
+    def _connect(self, key: PoolKey, cfg: Any) -> ImapSession:
+        client = IMAPClient(cfg.host, port=cfg.port, ssl=cfg.use_ssl)
+        try:
+            client.login(cfg.username, cfg.password)
+            selected = client.select_folder(cfg.mailbox)
+        except Exception:
+            try:
+                client.shutdown()
+            except Exception:
+                pass
+            raise
+        uidvalidity = selected.get(b"UIDVALIDITY") if isinstance(selected, dict) else None
+        return ImapSession(key, client, cfg.mailbox, int(uidvalidity) if uidvalidity is not None else None)
+
+    def _checkout(self, key: PoolKey, cfg: Any) -> ImapSession:
+        while True:
+            with self._lock:
+                bucket = self._idle.get(key) or []
+                session = bucket.pop() if bucket else None
+            if session is None:
+                return self._connect(key, cfg)
+            idle_for = time.monotonic() - session.last_used
+            if idle_for > self.max_idle:
+                session.close()
+                continue
+            if idle_for > self.noop_after:
+                try:
+                    session.client.noop()
+                except _CONNECTION_ERRORS:
+                    session.close()
+                    continue
+            return session
+
+    def _checkin(self, session: ImapSession) -> None:
+        session.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(session.key, []).append(session)
+
+    @contextmanager
+    def session(self, account_id: str) -> Iterator[ImapSession]:
+        cfg = imap_config(account_id)
+        if not cfg:
+            raise ValueError("IMAP config not found for account")
+        key = self._key_for(cfg)
+        slot = self._slot(key)
+        if not slot.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"IMAP pool exhausted for {cfg.username}@{cfg.host}")
+        try:
+            session = self._checkout(key, cfg)
+            try:
+                yield session
+            except _CONNECTION_ERRORS:
+                # Broken socket or protocol state: drop it, the next checkout reconnects.
+                session.close()
+                raise
+            except BaseException:
+                self._checkin(session)
+                raise
+            else:
+                self._checkin(session)
+        finally:
+            slot.release()
+
+    def keepalive(self) -> None:
+        """NOOP idle sessions that are due and drop the ones that are stale or broken."""
+        now = time.monotonic()
+        with self._lock:
+            buckets = {k: list(v) for k, v in self._idle.items()}
+            self._idle.clear()
+        alive: Dict[PoolKey, List[ImapSession]] = {}
+        for key, sessions in buckets.items():
+            for session in sessions:
+                idle_for = now - session.last_used
+                if idle_for > self.max_idle:
+                    session.close()
+                    continue
+                if idle_for > self.noop_after:
+                    try:
+                        session.client.noop()
+                        session.last_used = time.monotonic()
+                    except _CONNECTION_ERRORS:
+                        session.close()
+                        continue
+                alive.setdefault(key, []).append(session)
+        with self._lock:
+            for key, sessions in alive.items():
+                self._idle.setdefault(key, []).extend(sessions)
+
+    def start_keepalive(self, interval: float) -> None:
+        """Run `keepalive` from a daemon thread every `interval` seconds."""
+        if interval <= 0 or self._keepalive_thread is not None:
+            return
+
+        def _loop() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    self.keepalive()
+                except Exception:
+                    pass
+
+        self._keepalive_thread = threading.Thread(target=_loop, name="imap-pool-keepalive", daemon=True)
+        self._keepalive_thread.start()
+
+    def close_all(self) -> None:
+        with self._lock:
+            sessions = [s for bucket in self._idle.values() for s in bucket]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+
+_POOL: Optional[ImapPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_imap_pool() -> ImapPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ImapPool(
+                max_sessions=int(os.getenv("IMAP_POOL_MAX_SESSIONS", "2")),
+                noop_after=float(os.getenv("IMAP_POOL_NOOP_SECONDS", "60")),
+                max_idle=float(os.getenv("IMAP_POOL_MAX_IDLE_SECONDS", "600")),
+                acquire_timeout=float(os.getenv("IMAP_POOL_ACQUIRE_TIMEOUT", "120")),
+            )
+            _POOL.start_keepalive(float(os.getenv("IMAP_POOL_KEEPALIVE_SECONDS", "30")))
+        return _POOL
+
+
+@contextmanager
+def imap_session(account_id: str) -> Iterator[ImapSession]:
+    """Borrow a pooled, logged-in session for `account_id` with its mailbox selected."""
+    with get_imap_pool().session(account_id) as session:
+        yield session
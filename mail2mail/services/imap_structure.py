@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import os
+import quopri
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from mail2mail.services.metrics import count_bytes, stage
+
+
+def lazy_fetch_enabled() -> bool:
+    """IMAP_FETCH_MODE=lazy (default) fetches BODYSTRUCTURE + needed sections; `full` pulls RFC822."""
+    return os.getenv("IMAP_FETCH_MODE", "lazy").strip().lower() != "full"
+
+
+class MessagePart:
+    """Leaf MIME part as described by IMAP BODYSTRUCTURE (nothing downloaded yet)."""
+
+    def __init__(
+        self,
+        section: str,
+        mime: str,
+        params: Dict[str, str],
+        encoding: str,
+        size: int,
+        disposition: Optional[str],
+        filename: Optional[str],
+    ):
+        self.section = section
+        self.mime = mime
+        self.params = params
+        self.encoding = encoding
+        self.size = size
+        self.disposition = disposition
+        self.filename = filename
+
+    @property
+    def is_attachment(self) -> bool:
+        return self.disposition == "attachment"
+
+    @property
+    def charset(self) -> str:
+        return self.params.get("charset") or "utf-8"
+
+    @property
+    def decoded_size(self) -> int:
+        """Approximate payload size after transfer decoding, derived from the encoded size."""
+        if self.encoding == "base64":
+            # 76 chars + CRLF per encoded line carry 57 payload bytes
+            lines = self.size // 78
+            return max(0, (self.size - 2 * lines) * 3 // 4)
+        return self.size
+
+
+def _s(value: Any) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return "" if value is None else str(value)
+
+
+def _decode_words(value: str) -> str:
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def _params(raw: Any) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    if not isinstance(raw, (tuple, list)):
+        return out
+    items = list(raw)
+    for i in range(0, len(items) - 1, 2):
+        key = _s(items[i]).lower()
+        value = _s(items[i + 1])
+        if key.endswith("*"):
+            # RFC 2231 extended value: charset'lang'percent-encoded
+            key = key.rstrip("*")
+            try:
+                value = collapse_rfc2231_value(decode_rfc2231(value))
+            except Exception:
+                pass
+        else:
+            value = _decode_words(value)
+        out[key] = value
+    return out
+
+
+def _disposition(raw: Any) -> tuple:
+    if not isinstance(raw, (tuple, list)) or not raw:
+        return None, {}
+    return _s(raw[0]).lower() or None, _params(raw[1] if len(raw) > 1 else None)
+
+
+def parse_bodystructure(body: Sequence[Any], prefix: str = "") -> List[MessagePart]:
+    """Flatten an imapclient BODYSTRUCTURE into leaf parts with their IMAP section numbers."""
+    if body and isinstance(body[0], list):
+        parts: List[MessagePart] = []
+        for idx, child in enumerate(body[0], start=1):
+            parts.extend(parse_bodystructure(child, f"{prefix}{idx}."))
+        return parts
+
+    maintype = _s(body[0]).lower()
+    subtype = _s(body[1]).lower()
+    params = _params(body[2])
+    encoding = _s(body[5]).lower() or "7bit"
+    try:
+        size = int(body[6] or 0)
+    except (TypeError, ValueError):
+        size = 0
+    # Extension data position depends on the body type (RFC 3501, 7.4.2)
+    if maintype == "text":
+        disp_idx = 9
+    elif maintype == "message" and subtype == "rfc822":
+        disp_idx = 11
+    else:
+        disp_idx = 8
+    disposition, disp_params = _disposition(body[disp_idx] if len(body) > disp_idx else None)
+    filename = disp_params.get("filename") or params.get("name")
+    return [
+        MessagePart(
+            section=(prefix or "1.")[:-1],
+            mime=f"{maintype}/{subtype}",
+            params=params,
+            encoding=encoding,
+            size=size,
+            disposition=disposition,
+            filename=filename,
+        )
+    ]
+
+
+def decode_transfer(data: bytes, encoding: str) -> bytes:
+    encoding = (encoding or "").lower()
+    if encoding == "base64":
+        try:
+            return base64.b64decode(data)
+        except (binascii.Error, ValueError):
+            return base64.b64decode(data + b"===", validate=False)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+def decode_text(data: bytes, part: MessagePart) -> str:
+    payload = decode_transfer(data, part.encoding)
+    try:
+        return payload.decode(part.charset, "replace")
+    except LookupError:
+        return payload.decode("utf-8", "replace")
+
+
+def fetch_structure(client: Any, uid: int) -> Dict[str, Any]:
+    """Fetch BODYSTRUCTURE and the top-level header block for `uid` without marking it seen."""
+    with stage("imap_fetch"):
+        resp = client.fetch([uid], [b"BODYSTRUCTURE", b"BODY.PEEK[HEADER]"])[uid]
+    header_bytes = resp.get(b"BODY[HEADER]") or b""
+    count_bytes("fetched", len(header_bytes))
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(header_bytes)
+    return {
+        "headers": dict(headers.items()),
+        "parts": parse_bodystructure(resp[b"BODYSTRUCTURE"]),
+    }
+
+
+def fetch_sections(client: Any, uid: int, sections: Sequence[str]) -> Dict[str, bytes]:
+    """Download only the given body sections (BODY.PEEK, so flags are untouched)."""
+    if not sections:
+        return {}
+    items = [f"BODY.PEEK[{s}]".encode("ascii") for s in sections]
+    with stage("imap_fetch"):
+        resp = client.fetch([uid], items)[uid]
+    bodies = {s: resp.get(f"BODY[{s}]".encode("ascii")) or b"" for s in sections}
+    count_bytes("fetched", sum(len(b) for b in bodies.values()))
+    return bodies
+
+
+def iter_section_chunks(client: Any, uid: int, section: str, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Stream one body section with partial fetches (BODY.PEEK[<section>]<offset.length>)."""
+    offset = 0
+    while True:
+        item = f"BODY.PEEK[{section}]<{offset}.{chunk_size}>".encode("ascii")
+        with stage("imap_fetch"):
+            resp = client.fetch([uid], [item])[uid]
+        data = resp.get(f"BODY[{section}]<{offset}>".encode("ascii")) or b""
+        count_bytes("fetched", len(data))
+        if data:
+            yield data
+        if len(data) < chunk_size:
+            return
+        offset += len(data)
@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLedger:
+    """Persistent record of what has been processed and forwarded, per mailbox.
+
+    - `mailbox_state` holds UIDVALIDITY and a high-water UID: everything at or below it
+      is finished, so the monitor only asks the server for `UID high+1:*`.
+    - `messages` tracks individual UIDs (pending/done/duplicate/failed) and their
+      Message-ID, which dedupes re-deliveries and survives UIDVALIDITY resets. A failed
+      attempt (`retry_later`) holds the UID back for an exponentially growing delay.
+    - `forwards` makes delivery at-most-once per message across restarts; a claim left
+      in 'sending' by a crash is released by `recover_forwards` at startup.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_attempts: int = 3,
+        retention_days: float = 90.0,
+        retry_base: float = 60.0,
+        retry_max: float = 3600.0,
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retention_days = retention_days
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS mailbox_state ("
+                " account_id TEXT NOT NULL, mailbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL,"
+                " high_uid INTEGER NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (account_id, mailbox))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " account_id TEXT NOT NULL, mailbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL, uid INTEGER NOT NULL,"
+                " message_id TEXT, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL,"
+                " PRIMARY KEY (account_id, mailbox, uidvalidity, uid))"
+            )
+            if "next_attempt_at" not in {row[1] for row in conn.execute("PRAGMA table_info(messages)")}:
+                conn.execute("ALTER TABLE messages ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_message_id ON messages (account_id, mailbox, message_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_status ON messages (account_id, mailbox, uidvalidity, status, uid)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS forwards ("
+                " key TEXT PRIMARY KEY, status TEXT NOT NULL, sent_id TEXT, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, reused; `with conn` only commits or rolls back
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def sync(self, account_id: str, mailbox: str, uidvalidity: Optional[int]) -> Optional[int]:
+        """High-water UID for the mailbox, or None when there is no usable state.
+
+        None means first run or a UIDVALIDITY change (old UIDs are meaningless): the
+        caller must `bootstrap`. Finished rows are kept so Message-ID dedupe still works.
+        """
+        if uidvalidity is None:
+            return None
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT uidvalidity, high_uid FROM mailbox_state WHERE account_id = ? AND mailbox = ?",
+                (account_id, mailbox),
+            ).fetchone()
+            if row is None:
+                return None
+            if int(row[0]) != uidvalidity:
+                conn.execute(
+                    "DELETE FROM messages WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND status = 'pending'",
+                    (account_id, mailbox, int(row[0])),
+                )
+                conn.execute("DELETE FROM mailbox_state WHERE account_id = ? AND mailbox = ?", (account_id, mailbox))
+                return None
+            return int(row[1])
+
+    def bootstrap(self, account_id: str, mailbox: str, uidvalidity: int, high_uid: int) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO mailbox_state (account_id, mailbox, uidvalidity, high_uid, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (account_id, mailbox, uidvalidity, max(0, high_uid), time.time()),
+            )
+
+    def pending(self, account_id: str, mailbox: str, uidvalidity: int) -> List[int]:
+        """Pending UIDs that are due for another attempt."""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT uid FROM messages WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND status = 'pending'"
+                " AND next_attempt_at <= ? ORDER BY uid",
+                (account_id, mailbox, uidvalidity, time.time()),
+            ).fetchall()
+        return [int(r[0]) for r in rows]
+
+    def begin(self, account_id: str, mailbox: str, uidvalidity: int, uid: int, message_id: Optional[str]) -> str:
+        """Decide whether to process a UID: "process", "later", "done", "duplicate" or "failed".
+
+        Each "process" counts an attempt; after `max_attempts` the UID is given up as failed.
+        "later" means a failed attempt's retry delay has not passed yet.
+        """
+        message_id = (message_id or "").strip().lower() or None
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, attempts, next_attempt_at FROM messages"
+                " WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                (account_id, mailbox, uidvalidity, uid),
+            ).fetchone()
+            if row is not None and row[0] != "pending":
+                return "done"
+            if row is not None and row[2] > now:
+                return "later"
+            if row is None and message_id:
+                dup = conn.execute(
+                    "SELECT 1 FROM messages WHERE account_id = ? AND mailbox = ? AND message_id = ? AND status != 'failed' LIMIT 1",
+                    (account_id, mailbox, message_id),
+                ).fetchone()
+                if dup is not None:
+                    conn.execute(
+                        "INSERT INTO messages (account_id, mailbox, uidvalidity, uid, message_id, status, updated_at)"
+                        " VALUES (?, ?, ?, ?, ?, 'duplicate', ?)",
+                        (account_id, mailbox, uidvalidity, uid, message_id, now),
+                    )
+                    self._advance(conn, account_id, mailbox, uidvalidity)
+                    return "duplicate"
+            attempts = int(row[1]) if row is not None else 0
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    "UPDATE messages SET status = 'failed', updated_at = ?"
+                    " WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                    (now, account_id, mailbox, uidvalidity, uid),
+                )
+                self._advance(conn, account_id, mailbox, uidvalidity)
+                return "failed"
+            conn.execute(
+                "INSERT INTO messages (account_id, mailbox, uidvalidity, uid, message_id, status, attempts, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, 'pending', 1, ?)"
+                " ON CONFLICT (account_id, mailbox, uidvalidity, uid) DO UPDATE SET attempts = attempts + 1, updated_at = excluded.updated_at",
+                (account_id, mailbox, uidvalidity, uid, message_id, now),
+            )
+            return "process"
+
+    def complete(self, account_id: str, mailbox: str, uidvalidity: int, uid: int, status: str = "done") -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE messages SET status = ?, updated_at = ? WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                (status, time.time(), account_id, mailbox, uidvalidity, uid),
+            )
+            self._advance(conn, account_id, mailbox, uidvalidity)
+
+    def retry_later(self, account_id: str, mailbox: str, uidvalidity: int, uid: int) -> float:
+        """Hold a pending UID back after a failed attempt; returns the delay in seconds."""
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT attempts FROM messages WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                (account_id, mailbox, uidvalidity, uid),
+            ).fetchone()
+            attempts = int(row[0]) if row else 1
+            delay = min(self.retry_max, self.retry_base * 2 ** max(0, attempts - 1))
+            conn.execute(
+                "UPDATE messages SET next_attempt_at = ?, updated_at = ?"
+                " WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND uid = ? AND status = 'pending'",
+                (time.time() + delay, time.time(), account_id, mailbox, uidvalidity, uid),
+            )
+        return delay
+
+    @staticmethod
+    def _advance(conn: sqlite3.Connection, account_id: str, mailbox: str, uidvalidity: int) -> None:
+        # High-water never passes a pending UID, so a crash never skips unfinished mail
+        key = (account_id, mailbox, uidvalidity)
+        lowest_pending = conn.execute(
+            "SELECT MIN(uid) FROM messages WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND status = 'pending'", key
+        ).fetchone()[0]
+        highest_done = conn.execute(
+            "SELECT MAX(uid) FROM messages WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND status != 'pending'", key
+        ).fetchone()[0]
+        if highest_done is None:
+            return
+        target = int(highest_done) if lowest_pending is None else min(int(highest_done), int(lowest_pending) - 1)
+        conn.execute(
+            "UPDATE mailbox_state SET high_uid = MAX(high_uid, ?), updated_at = ?"
+            " WHERE account_id = ? AND mailbox = ? AND uidvalidity = ?",
+            (target, time.time(), account_id, mailbox, uidvalidity),
+        )
+
+    def claim_forward(self, key: str) -> bool:
+        """Reserve the right to forward `key`; False if it was forwarded (or is being forwarded) already."""
+        with self._lock, self._connect() as conn:
+            try:
+                conn.execute("INSERT INTO forwards (key, status, updated_at) VALUES (?, 'sending', ?)", (key, time.time()))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def finish_forward(self, key: str, sent_id: Optional[str]) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE forwards SET status = 'sent', sent_id = ?, updated_at = ? WHERE key = ?", (sent_id, time.time(), key)
+            )
+
+    def release_forward(self, key: str) -> None:
+        """Undo a claim after a failed send so a retry may forward again."""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM forwards WHERE key = ? AND status = 'sending'", (key,))
+
+    def recover_forwards(self, older_than: float) -> List[str]:
+        """Release claims stuck in 'sending' for more than `older_than` seconds.
+
+        Such a claim means the process died between claiming and recording the send. The
+        message is still pending, so releasing it lets the retry forward it; if the SMTP
+        server had accepted it before the crash the recipient gets it twice.
+        """
+        cutoff = time.time() - max(0.0, older_than)
+        with self._lock, self._connect() as conn:
+            keys = [
+                str(r[0])
+                for r in conn.execute("SELECT key FROM forwards WHERE status = 'sending' AND updated_at < ?", (cutoff,))
+            ]
+            conn.execute("DELETE FROM forwards WHERE status = 'sending' AND updated_at < ?", (cutoff,))
+        for key in keys:
+            logger.warning("forward of %s was interrupted; it will be sent again when the message is retried", key)
+        return keys
+
+    def prune(self) -> int:
+        """Forget finished UIDs and forwards older than the retention window."""
+        if self.retention_days <= 0:
+            return 0
+        cutoff = time.time() - self.retention_days * 86400
+        with self._lock, self._connect() as conn:
+            n = conn.execute("DELETE FROM messages WHERE status != 'pending' AND updated_at < ?", (cutoff,)).rowcount
+            n += conn.execute("DELETE FROM forwards WHERE status = 'sent' AND updated_at < ?", (cutoff,)).rowcount
+        return n
+
+
+_LEDGER: Optional[MessageLedger] = None
+_LEDGER_LOCK = threading.Lock()
+
+
+def get_ledger() -> MessageLedger:
+    global _LEDGER
+    with _LEDGER_LOCK:
+        if _LEDGER is None:
+            data_dir = os.getenv("DATA_DIR") or os.getcwd()
+            _LEDGER = MessageLedger(
+                os.getenv("LEDGER_DB", os.path.join(data_dir, "ledger.sqlite3")),
+                max_attempts=int(os.getenv("LEDGER_MAX_ATTEMPTS", "3")),
+                retention_days=float(os.getenv("LEDGER_RETENTION_DAYS", "90")),
+                retry_base=float(os.getenv("LEDGER_RETRY_BASE_SECONDS", "60")),
+            )
+            _LEDGER.recover_forwards(float(os.getenv("LEDGER_STALE_SENDING_SECONDS", "900")))
+        return _LEDGER
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+from mail2mail.services.imap_structure import MessagePart, fetch_structure
+from mail2mail.services.metrics import count_bytes, count_cache, stage
+from mail2mail.services.mime_normalize import NormalizedMessage
+
+
+# (account_id, mailbox, UIDVALIDITY, UID)
+CacheKey = Tuple[str, str, Optional[int], int]
+
+
+class _MappedReader(io.RawIOBase):
+    """Independent file-like reader over a memory map (or bytes), with its own position."""
+
+    def __init__(self, data: Union[mmap.mmap, bytes]):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, b: Any) -> int:
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _map_file(path: str) -> Union[mmap.mmap, bytes]:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CachedMessage:
+    """One fetched message: raw RFC822 bytes on disk plus lazily parsed views of it.
+
+    In lazy IMAP mode only the BODYSTRUCTURE (`parts`) and `headers` are known and
+    `path` stays None until something needs the full message. A downloaded file is
+    mapped as soon as the entry is created, so `raw()`, `open()` and `message()` keep
+    working after the cache evicts the entry and unlinks `path`.
+    """
+
+    def __init__(self, key: CacheKey, path: Optional[str], size: int):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.headers: Optional[Dict[str, Any]] = None
+        self.parts: Optional[List[MessagePart]] = None
+        self.normalized: Optional[NormalizedMessage] = None
+        self._message: Optional[EmailMessage] = None
+        self._raw: Optional[Union[mmap.mmap, bytes]] = _map_file(path) if path is not None else None
+        self._lock = threading.Lock()
+
+    def raw(self) -> Union[mmap.mmap, bytes]:
+        """Read-only memory map of the raw message (empty bytes for an empty one)."""
+        if self._raw is None:
+            raise ValueError("raw message was not downloaded")
+        return self._raw
+
+    def open(self) -> BinaryIO:
+        """New binary reader over the raw message; valid even once `path` is gone."""
+        return io.BufferedReader(_MappedReader(self.raw()))  # type: ignore[return-value]
+
+    def message(self) -> EmailMessage:
+        """Parsed message, built once per cache entry."""
+        with self._lock:
+            if self._message is None:
+                with stage("mime_parse"), self.open() as f:
+                    self._message = BytesParser(policy=policy.default).parse(f)  # type: ignore[assignment]
+            return self._message  # type: ignore[return-value]
+
+
+class MessageCache:
+    """Bounded LRU of fetched messages, evicted by entry count and total raw size.
+
+    Evicted files are unlinked immediately. Entries map their file when they are stored,
+    so callers still holding one read it through `open()`/`raw()` until they drop it;
+    `path` itself is only valid while the entry is cached.
+    """
+
+    def __init__(self, root: str, max_entries: int = 64, max_bytes: int = 256 * 1024 * 1024):
+        self.root = root
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self._entries: "OrderedDict[CacheKey, CachedMessage]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path_for(self, key: CacheKey) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, f"{digest}.eml")
+
+    def get(self, key: CacheKey) -> Optional[CachedMessage]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                count_cache("message", "miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            count_cache("message", "hit")
+            return entry
+
+    def put(self, key: CacheKey, raw: bytes) -> CachedMessage:
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        entry = CachedMessage(key, path, len(raw))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old.size
+                entry.headers, entry.parts, entry.normalized = old.headers, old.parts, old.normalized
+            self._entries[key] = entry
+            self._total += entry.size
+            self._evict_locked(keep=key)
+        return entry
+
+    def put_structure(self, key: CacheKey, headers: Dict[str, Any], parts: List[MessagePart]) -> CachedMessage:
+        entry = CachedMessage(key, None, 0)
+        entry.headers = headers
+        entry.parts = parts
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                # Never replace a full download with a structure-only entry
+                old.headers, old.parts = headers, parts
+                return old
+            self._entries[key] = entry
+            self._evict_locked(keep=key)
+        return entry
+
+    def _evict_locked(self, keep: CacheKey) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._total > self.max_bytes):
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            self._entries.pop(key)
+            self._total -= entry.size
+            if entry.path:
+                self._unlink(entry.path)
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def discard(self, account_id: str, uid: int) -> int:
+        """Drop the entries of one message (any mailbox/UIDVALIDITY of `account_id`); returns how many."""
+        with self._lock:
+            keys = [k for k in self._entries if k[0] == account_id and k[3] == int(uid)]
+            entries = [self._entries.pop(k) for k in keys]
+            for entry in entries:
+                self._total -= entry.size
+        for entry in entries:
+            if entry.path:
+                self._unlink(entry.path)
+        return len(entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._total = 0
+        for entry in entries:
+            if entry.path:
+                self._unlink(entry.path)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_CACHE: Optional[MessageCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_message_cache() -> MessageCache:
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            tmp_root = os.getenv("TMP_ROOT", os.path.abspath(os.path.join(os.getcwd(), "tmp")))
+            _CACHE = MessageCache(
+                root=os.getenv("MESSAGE_CACHE_DIR", os.path.join(tmp_root, "message_cache")),
+                max_entries=int(os.getenv("MESSAGE_CACHE_MAX_ENTRIES", "64")),
+                max_bytes=int(os.getenv("MESSAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+            )
+        return _CACHE
+
+
+def fetch_cached_message(account_id: str, session: Any, uid: int) -> CachedMessage:
+    """Return the cached message for `uid`, downloading RFC822 through `session` on a miss."""
+    cache = get_message_cache()
+    key: CacheKey = (account_id, session.mailbox, session.uidvalidity, int(uid))
+    entry = cache.get(key)
+    if entry is None or entry.path is None:
+        with stage("imap_fetch"):
+            raw = session.client.fetch([uid], [b"RFC822"])
+        count_bytes("fetched", len(raw[uid][b"RFC822"]))
+        entry = cache.put(key, raw[uid][b"RFC822"])
+    return entry
+
+
+def fetch_cached_structure(account_id: str, session: Any, uid: int) -> CachedMessage:
+    """Return the cached entry for `uid` with headers and BODYSTRUCTURE populated."""
+    cache = get_message_cache()
+    key: CacheKey = (account_id, session.mailbox, session.uidvalidity, int(uid))
+    entry = cache.get(key)
+    if entry is None or entry.parts is None:
+        structure = fetch_structure(session.client, uid)
+        entry = cache.put_structure(key, structure["headers"], structure["parts"])
+    return entry
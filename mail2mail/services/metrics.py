@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; spans 5 ms resolve lookups up to multi-minute document processing
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, Any]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values: Any, amount: float = 1.0) -> None:
+        key = tuple(str(v) for v in values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *values: Any) -> float:
+        with self._lock:
+            return self._values.get(tuple(str(v) for v in values), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(list(zip(self.labels, key)))} {_format_value(v)}" for key, v in items]
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus semantics: `le` buckets, `_sum`, `_count`)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (non-cumulative, +Inf last), sum, count]
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, amount: float, *values: Any) -> None:
+        key = tuple(str(v) for v in values)
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += amount
+            state[2] += 1
+
+    def count(self, *values: Any) -> int:
+        with self._lock:
+            state = self._values.get(tuple(str(v) for v in values))
+            return int(state[2]) if state else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines: List[str] = []
+        for key, (counts, total, n) in items:
+            pairs = list(zip(self.labels, key))
+            running = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                running += c
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _format_value(bound))])} {running}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {n}")
+        return lines
+
+
+# (name, type, help, [(labels, value)])
+MetricFamily = Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]
+Collector = Callable[[], List[MetricFamily]]
+
+
+class MetricsRegistry:
+    """Metrics of this process, rendered in the Prometheus text format.
+
+    Collectors are called at scrape time and return MetricFamily tuples, for values
+    that are cheaper to read on demand than to keep in sync (queue depths).
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: List[Collector] = []
+        self._lock = threading.Lock()
+
+    def _get_or_add(self, metric: Any) -> Any:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get_or_add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_add(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, collector: Collector) -> None:
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines: List[str] = []
+        for metric in metrics:
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+            lines += metric.samples()
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception:
+                logger.exception("metrics collector %r failed", collector)
+                continue
+            for name, kind, help, samples in families:
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_format_labels(sorted(labels.items()))} {_format_value(v)}" for labels, v in samples]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "mail2mail_stage_seconds", "Wall time of pipeline stages (tools, agent runs, IMAP/SMTP I/O).", ("stage", "outcome")
+)
+BYTES_TOTAL = REGISTRY.counter(
+    "mail2mail_bytes_total", "Bytes fetched from IMAP, decoded into attachments and sent over SMTP.", ("direction",)
+)
+CACHE_LOOKUPS_TOTAL = REGISTRY.counter("mail2mail_cache_lookups_total", "Cache lookups by cache and result.", ("cache", "result"))
+LLM_REQUESTS_TOTAL = REGISTRY.counter("mail2mail_llm_requests_total", "Model requests made by agent runs.", ("agent",))
+LLM_TOKENS_TOTAL = REGISTRY.counter("mail2mail_llm_tokens_total", "Model tokens by agent and kind (input, cached, output).", ("agent", "kind"))
+
+
+def metrics_enabled() -> bool:
+    return _env_flag("METRICS_ENABLED", "true")
+
+
+def count_bytes(direction: str, amount: int) -> None:
+    if amount and metrics_enabled():
+        BYTES_TOTAL.inc(direction, amount=amount)
+
+
+def count_cache(cache: str, result: str) -> None:
+    if metrics_enabled():
+        CACHE_LOOKUPS_TOTAL.inc(cache, result)
+
+
+def count_tokens(agent: str, requests: int, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> None:
+    if not metrics_enabled():
+        return
+    LLM_REQUESTS_TOTAL.inc(agent, amount=requests)
+    LLM_TOKENS_TOTAL.inc(agent, "input", amount=input_tokens)
+    LLM_TOKENS_TOTAL.inc(agent, "output", amount=output_tokens)
+    LLM_TOKENS_TOTAL.inc(agent, "cached", amount=cached_tokens)
+
+
+def record_usage(agent: str, result: Any) -> None:
+    """Add the token usage of a finished Runner.run result."""
+    usage = getattr(getattr(result, "context_wrapper", None), "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    count_tokens(
+        agent,
+        usage.requests or 0,
+        usage.input_tokens or 0,
+        usage.output_tokens or 0,
+        getattr(details, "cached_tokens", 0) or 0,
+    )
+
+
+# Message being processed in this context; stage spans carry it so traces correlate by UID
+_MESSAGE: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("mail2mail_message", default=None)
+
+_TRACER: Any = None
+_TRACER_LOCK = threading.Lock()
+
+
+def _tracer() -> Any:
+    """OpenTelemetry tracer when OTEL_TRACING_ENABLED is set and opentelemetry-api is installed, else None."""
+    global _TRACER
+    if not _env_flag("OTEL_TRACING_ENABLED", "false"):
+        return None
+    with _TRACER_LOCK:
+        if _TRACER is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                logger.warning("OTEL_TRACING_ENABLED is set but opentelemetry-api is not installed")
+                _TRACER = False
+            else:
+                _TRACER = trace.get_tracer("mail2mail")
+        return _TRACER or None
+
+
+def _message_attributes(account_id: str, message_id: str) -> Dict[str, Any]:
+    attrs: Dict[str, Any] = {"mail.account_id": account_id, "mail.message_id": message_id}
+    if message_id.startswith("imap:") and message_id[5:].isdigit():
+        attrs["mail.uid"] = int(message_id[5:])
+    return attrs
+
+
+@contextlib.contextmanager
+def stage(name: str, **attributes: Any) -> Iterator[None]:
+    """Time a block as pipeline stage `name`; also an OpenTelemetry span when tracing is on."""
+    tracer = _tracer()
+    enabled = metrics_enabled()
+    if tracer is None and not enabled:
+        yield
+        return
+    span_cm: Any = contextlib.nullcontext()
+    if tracer is not None:
+        attrs = dict(_MESSAGE.get() or {})
+        attrs.update({k: v for k, v in attributes.items() if v is not None})
+        span_cm = tracer.start_as_current_span(f"mail2mail.{name}", attributes=attrs)
+    outcome = "ok"
+    started = time.perf_counter()
+    with span_cm:
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            if enabled:
+                STAGE_SECONDS.observe(time.perf_counter() - started, name, outcome)
+
+
+@contextlib.contextmanager
+def message_scope(account_id: str, message_id: str) -> Iterator[None]:
+    """Attribute the stages run inside the block to one message (root span "mail2mail.message")."""
+    token = _MESSAGE.set(_message_attributes(account_id, message_id))
+    try:
+        with stage("message"):
+            yield
+    finally:
+        _MESSAGE.reset(token)
+
+
+def traced(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Decorator form of `stage` for sync and async functions."""
+
+    def decorate(fn: Callable[..., Any]) -> Callable[..., Any]:
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with stage(name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0].rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Expose /metrics from a daemon thread, for worker processes without the admin app."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("serving metrics on %s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import base64
+import contextlib
+import functools
+import json
+import mimetypes
+import os
+import re
+import uuid
+from email import policy
+from email.message import EmailMessage
+from email.utils import formatdate, getaddresses, make_msgid
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Union
+
+from mail2mail.services.mime_stream import MANIFEST_NAME
+
+
+# 57 input bytes make one 76-character base64 line; whole lines per chunk keep output aligned
+_B64_CHUNK = 57 * 1024
+_BLOCK = 64 * 1024
+_EOL_RE = re.compile(rb"\r?\n")
+# Encodings that are safe to copy verbatim into an SMTP DATA stream
+_COPYABLE = {"base64", "quoted-printable", "7bit", "8bit"}
+
+Chunks = Callable[[], Iterator[bytes]]
+# A path, or a file opened (pinned) earlier; pinned files are read from the start each time
+Source = Union[str, BinaryIO]
+
+
+class AttachmentUnavailable(Exception):
+    """An attachment could not be read while streaming; not an OSError, so never retried as transient."""
+
+
+@contextlib.contextmanager
+def _opened(source: Source, offset: int = 0) -> Iterator[BinaryIO]:
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            f.seek(offset)
+            yield f
+    else:
+        source.seek(offset)
+        yield source
+
+
+def iter_base64(source: Source) -> Iterator[bytes]:
+    """Base64 of a file in CRLF-terminated 76-character lines, one block at a time."""
+    with _opened(source) as f:
+        while True:
+            block = f.read(_B64_CHUNK)
+            if not block:
+                return
+            yield base64.encodebytes(block).replace(b"\n", b"\r\n")
+
+
+def iter_span(source: Source, offset: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+    """Bytes `offset`..`offset+length` of a file as CRLF-normalized, line-aligned chunks."""
+    with _opened(source, offset) as f:
+        remaining = length if length is not None else -1
+        carry = b""
+        while remaining != 0:
+            block = f.read(_BLOCK if remaining < 0 else min(_BLOCK, remaining))
+            if not block:
+                break
+            if remaining > 0:
+                remaining -= len(block)
+            block = carry + block
+            cut = block.rfind(b"\n") + 1
+            carry = block[cut:]
+            if cut:
+                yield _EOL_RE.sub(b"\r\n", block[:cut])
+        if carry:
+            yield _EOL_RE.sub(b"\r\n", carry) + b"\r\n"
+
+
+def is_7bit(source: Source) -> bool:
+    with _opened(source) as f:
+        while True:
+            block = f.read(_BLOCK)
+            if not block:
+                return True
+            if not block.isascii():
+                return False
+
+
+def _header_block(msg: EmailMessage) -> bytes:
+    return b"".join(policy.SMTP.fold_binary(name, value) for name, value in msg.items())
+
+
+def forward_source(path: str) -> Optional[Dict[str, Any]]:
+    """Original encoded span for a saved attachment, if its source is still unchanged on disk."""
+    manifest_path = os.path.join(os.path.dirname(path), MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            entry = json.load(f).get(path)
+        if not entry or entry.get("encoding") not in _COPYABLE:
+            return None
+        st = os.stat(entry["source"])
+    except (OSError, ValueError, KeyError):
+        return None
+    if st.st_size != entry.get("source_size") or st.st_mtime != entry.get("source_mtime"):
+        return None
+    return entry
+
+
+class ForwardMessage:
+    """Outgoing mail produced as a stream of CRLF lines.
+
+    Attachments are never loaded whole: a part whose original encoded body is still on
+    disk (see `forward_source`) is copied byte for byte, other files are base64-encoded
+    block by block, and a raw .eml goes in verbatim as message/rfc822. Every file is
+    opened when it is attached, so cache cleanup before sending cannot pull it away;
+    `close` releases them.
+    """
+
+    def __init__(self, from_addr: str, to: List[str], subject: str, body: str):
+        self.mail_from = from_addr
+        self.recipients = [addr for _, addr in getaddresses(to) if addr]
+        self.eight_bit = False
+        self.copied = 0
+        self._head = EmailMessage()
+        self._head["From"] = from_addr
+        self._head["To"] = ", ".join(to)
+        # Sanitize subject to avoid header injection
+        self._head["Subject"] = (subject or "").replace("\r", " ").replace("\n", " ")[:998]
+        self._head["Date"] = formatdate(localtime=True)
+        self._head["Message-ID"] = make_msgid()
+        self._text = EmailMessage()
+        self._text.set_content(body or "")
+        del self._text["MIME-Version"]
+        if (self._text.get("Content-Transfer-Encoding") or "").lower() == "8bit":
+            self.eight_bit = True
+        self._parts: List[Any] = []
+        self._files: List[BinaryIO] = []
+
+    def _pin(self, path: str) -> BinaryIO:
+        f = open(path, "rb")
+        self._files.append(f)
+        return f
+
+    def attach_file(self, path: str) -> None:
+        mime, _ = mimetypes.guess_type(path)
+        part = EmailMessage()
+        part["Content-Type"] = mime or "application/octet-stream"
+        part.add_header("Content-Disposition", "attachment", filename=os.path.basename(path))
+        origin = forward_source(path)
+        source: Optional[BinaryIO] = None
+        if origin is not None:
+            try:
+                source = self._pin(origin["source"])
+            except OSError:
+                pass  # gone since the check: encode the saved file instead
+        if origin is not None and source is not None:
+            encoding = origin["encoding"]
+            self.eight_bit = self.eight_bit or encoding == "8bit"
+            self.copied += 1
+            part["Content-Transfer-Encoding"] = encoding
+            body: Chunks = functools.partial(iter_span, source, origin["offset"], origin["length"])
+        else:
+            part["Content-Transfer-Encoding"] = "base64"
+            body = functools.partial(iter_base64, self._pin(path))
+        self._parts.append((_header_block(part), body))
+
+    def attach_eml(self, path: str, filename: str = "original.eml") -> None:
+        part = EmailMessage()
+        part["Content-Type"] = "message/rfc822"
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        source = self._pin(path)
+        if is_7bit(source):
+            part["Content-Transfer-Encoding"] = "7bit"
+        else:
+            part["Content-Transfer-Encoding"] = "8bit"
+            self.eight_bit = True
+        self._parts.append((_header_block(part), functools.partial(iter_span, source)))
+
+    def chunks(self) -> Iterator[bytes]:
+        """The full message; every chunk starts at a line boundary. Can be called repeatedly."""
+        if not self._parts:
+            head = EmailMessage()
+            for name, value in self._head.items():
+                head[name] = value
+            head["MIME-Version"] = "1.0"
+            for name, value in self._text.items():
+                head[name] = value
+            yield _header_block(head) + b"\r\n"
+            yield _EOL_RE.sub(b"\r\n", self._text.get_payload().encode("utf-8", "surrogateescape"))
+            return
+        boundary = "=_" + uuid.uuid4().hex
+        delimiter = b"--" + boundary.encode("ascii")
+        yield _header_block(self._head)
+        yield b"MIME-Version: 1.0\r\n"
+        yield f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n\r\n'.encode("ascii")
+        yield delimiter + b"\r\n"
+        yield self._text.as_bytes(policy=policy.SMTP)
+        for header, body in self._parts:
+            yield b"\r\n" + delimiter + b"\r\n" + header + b"\r\n"
+            try:
+                yield from body()
+            except OSError as e:
+                raise AttachmentUnavailable(str(e)) from e
+        yield b"\r\n" + delimiter + b"--\r\n"
+
+    def close(self) -> None:
+        """Release the attached files; `chunks` cannot be used afterwards."""
+        files, self._files = self._files, []
+        for f in files:
+            f.close()
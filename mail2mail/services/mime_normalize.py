@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import html
+import re
+from email.message import EmailMessage
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from mail2mail.services.mime_stream import walk_mime
+
+
+_LINK_RE = re.compile(r"https?://[^\s<>\"'`]+", re.IGNORECASE)
+_LINK_TRAIL = ".,;:!?*"
+_DROP_RE = re.compile(r"<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+_BREAK_RE = re.compile(r"<br\s*/?>|</?(p|div|tr|li|ul|ol|table|h[1-6]|blockquote|pre)\b[^>]*>", re.IGNORECASE)
+_CELL_RE = re.compile(r"</t[dh]\s*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]*>")
+_SPACES_RE = re.compile(r"[ \t\r\f\v\xa0]+")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+
+
+def extract_links(*texts: Optional[str]) -> List[str]:
+    """http(s) URLs found in `texts`, in order of first appearance, without duplicates.
+
+    Stops at quotes and angle brackets, so `href="..."` in HTML yields the bare URL.
+    """
+    links: Dict[str, None] = {}
+    for text in texts:
+        if not text:
+            continue
+        for url in _LINK_RE.findall(text):
+            url = url.rstrip(_LINK_TRAIL)
+            # Trailing ")" belongs to the URL only if it closes a "(" inside it
+            while url.endswith(")") and url.count(")") > url.count("("):
+                url = url[:-1].rstrip(_LINK_TRAIL)
+            if "&" in url:
+                url = html.unescape(url)
+            links[url] = None
+    return list(links)
+
+
+def html_to_text(markup: Optional[str]) -> str:
+    """Readable plain text of an HTML body: no scripts/styles, block tags as line breaks."""
+    if not markup:
+        return ""
+    text = _DROP_RE.sub(" ", markup)
+    text = _BREAK_RE.sub("\n", text)
+    text = _CELL_RE.sub("\t", text)
+    text = html.unescape(_TAG_RE.sub("", text))
+    lines = (_SPACES_RE.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+class NormalizedMessage:
+    """read_message result: headers, text bodies, links and attachment metadata.
+
+    `text` is the body to analyse: text/plain, or the HTML body converted to text.
+    """
+
+    __slots__ = ("headers", "text_plain", "text_html", "text", "links", "attachments_meta")
+
+    def __init__(
+        self,
+        headers: Dict[str, Any],
+        text_plain: Optional[str],
+        text_html: Optional[str],
+        attachments_meta: List[Dict[str, Any]],
+    ):
+        self.headers = headers
+        self.text_plain = text_plain
+        self.text_html = text_html
+        self.text = text_plain or html_to_text(text_html)
+        self.links = extract_links(text_plain, text_html)
+        self.attachments_meta = attachments_meta
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "headers": dict(self.headers),
+            "text_plain": self.text_plain,
+            "text_html": self.text_html,
+            "text": self.text,
+            "links": list(self.links),
+            "attachments_meta": [dict(meta) for meta in self.attachments_meta],
+        }
+
+
+def _charset(headers: EmailMessage) -> str:
+    return headers.get_content_charset() or "utf-8"
+
+
+class _TextSink:
+    """Collects one decoded text part."""
+
+    raw = False
+
+    def __init__(self, charset: str):
+        self.charset = charset
+        self.aborted = False
+        self.span: Optional[Tuple[int, int]] = None
+        self.encoding: Optional[str] = None
+        self._chunks: List[bytes] = []
+        self.value: Optional[str] = None
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self._chunks.append(data)
+
+    def close(self) -> None:
+        payload = b"".join(self._chunks)
+        self._chunks = []
+        try:
+            self.value = payload.decode(self.charset, "replace")
+        except LookupError:
+            self.value = payload.decode("utf-8", "replace")
+
+
+class _SizeSink:
+    """Sizes an attachment from its still-encoded body; the payload is never decoded."""
+
+    raw = True
+
+    def __init__(self, encoding: Optional[str], meta: Dict[str, Any]):
+        self.kind = (encoding or "").strip().lower()
+        self.meta = meta
+        self.aborted = False
+        self.span: Optional[Tuple[int, int]] = None
+        self.encoding: Optional[str] = None
+        self._chars = 0
+        self._padding = 0
+        self._size = 0
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        if self.kind == "base64":
+            data = data.translate(None, b" \t\r\n")
+            if data:
+                self._chars += len(data)
+                self._padding = len(data) - len(data.rstrip(b"="))
+        elif self.kind == "quoted-printable":
+            # "=XX" is one byte, "=" before a line break is a soft break
+            self._size += len(data) - 2 * data.count(b"=") - data.count(b"=\r\n")
+        else:
+            self._size += len(data)
+
+    def close(self) -> None:
+        if self.kind == "base64":
+            self._size = max(0, self._chars * 3 // 4 - min(self._padding, 2))
+        self.meta["size_bytes"] = max(0, self._size)
+
+
+def normalize_stream(fp: BinaryIO) -> NormalizedMessage:
+    """Normalize a raw RFC822 message in one streaming pass over `fp`.
+
+    Only the first non-attachment text/plain and text/html parts are decoded;
+    attachments contribute filename, MIME type and size.
+    """
+    top: List[EmailMessage] = []
+    texts: Dict[str, _TextSink] = {}
+    attachments_meta: List[Dict[str, Any]] = []
+
+    def _on_leaf(headers: EmailMessage) -> Any:
+        content_type = headers.get_content_type()
+        if headers.get_content_disposition() == "attachment":
+            meta = {"filename": headers.get_filename() or "attachment", "mime": content_type, "size_bytes": 0}
+            attachments_meta.append(meta)
+            return _SizeSink(headers.get("Content-Transfer-Encoding"), meta)
+        if content_type in ("text/plain", "text/html") and content_type not in texts:
+            texts[content_type] = _TextSink(_charset(headers))
+            return texts[content_type]
+        return None
+
+    walk_mime(fp, _on_leaf, top.append)
+
+    def _text(content_type: str) -> Optional[str]:
+        sink = texts.get(content_type)
+        return sink.value if sink is not None else None
+
+    return NormalizedMessage(
+        dict(top[0].items()) if top else {},
+        _text("text/plain"),
+        _text("text/html"),
+        attachments_meta,
+    )
+
+
+def normalize_file(path: str) -> NormalizedMessage:
+    with open(path, "rb") as f:
+        return normalize_stream(f)
+
+
+def body_text(message: Dict[str, Any]) -> str:
+    """Body of a read_message dict as plain text (older results carry no `text` key)."""
+    text = message.get("text")
+    if text is None:
+        text = message.get("text_plain") or html_to_text(message.get("text_html"))
+    return text or ""
+
@@ -0,0 +1,420 @@
+from __future__ import annotations
+
+import binascii
+import hashlib
+import json
+import os
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from mail2mail.services.metrics import count_bytes
+
+
+_LINE_LIMIT = 64 * 1024
+# Per work_dir: saved attachment -> where its original encoded body lives (see forward_source)
+MANIFEST_NAME = ".forward_manifest.json"
+_WHITESPACE = b" \t\r\n"
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+_B64_INVALID = bytes(b for b in range(256) if b not in _B64_ALPHABET)
+
+
+class _Base64Decoder:
+    """Lenient like the email package: stray characters are skipped, padding ends a segment.
+
+    `defects` counts skipped characters and dangling bits so the caller can report them.
+    """
+
+    def __init__(self) -> None:
+        self._tail = b""
+        self.defects = 0
+
+    def _decode(self, quads: bytes) -> bytes:
+        if len(quads) % 4 == 1:
+            # Six bits cannot make a byte
+            quads = quads[:-1]
+            self.defects += 1
+        return binascii.a2b_base64(quads + b"=" * (-len(quads) % 4)) if quads else b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = data.translate(None, _WHITESPACE)
+        clean = data.translate(None, _B64_INVALID)
+        self.defects += len(data) - len(clean)
+        data = self._tail + clean
+        out = []
+        pad = data.find(b"=")
+        while pad >= 0:
+            out.append(self._decode(data[:pad]))
+            data = data[pad:].lstrip(b"=")
+            pad = data.find(b"=")
+        usable = len(data) - len(data) % 4
+        self._tail = data[usable:]
+        out.append(self._decode(data[:usable]))
+        return b"".join(out)
+
+    def flush(self) -> bytes:
+        tail, self._tail = self._tail, b""
+        return self._decode(tail)
+
+
+class _QuotedPrintableDecoder:
+    def __init__(self) -> None:
+        self._tail = b""
+
+    def feed(self, data: bytes) -> bytes:
+        # Escapes never span lines, so decode up to the last complete line
+        data = self._tail + data
+        cut = data.rfind(b"\n") + 1
+        self._tail = data[cut:]
+        return binascii.a2b_qp(data[:cut]) if cut else b""
+
+    def flush(self) -> bytes:
+        tail, self._tail = self._tail, b""
+        return binascii.a2b_qp(tail) if tail else b""
+
+
+class _IdentityDecoder:
+    def feed(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def make_decoder(encoding: Optional[str]):
+    """Incremental Content-Transfer-Encoding decoder with feed()/flush()."""
+    encoding = (encoding or "").strip().lower()
+    if encoding == "base64":
+        return _Base64Decoder()
+    if encoding == "quoted-printable":
+        return _QuotedPrintableDecoder()
+    return _IdentityDecoder()
+
+
+def _safe_filename(filename: Optional[str]) -> str:
+    name = os.path.basename((filename or "").replace("\\", "/")).strip()
+    return name if name not in ("", ".", "..") else "attachment"
+
+
+def _file_digest(path: str) -> Optional[str]:
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+class AttachmentWriter:
+    """Writes decoded attachments into `target_dir` under byte budgets, deduplicated by SHA-256."""
+
+    def __init__(
+        self,
+        target_dir: str,
+        max_attachment_bytes: Optional[int] = None,
+        max_message_bytes: Optional[int] = None,
+    ):
+        self.target_dir = target_dir
+        self.max_attachment_bytes = max_attachment_bytes or None
+        self.max_message_bytes = max_message_bytes or None
+        self.total_bytes = 0
+        self.saved: List[str] = []
+        self.notes: List[str] = []
+        # Raw message the attachments are being cut from, if it is a file on disk
+        self.source_path: Optional[str] = None
+        self.sources: Dict[str, Dict[str, Any]] = {}
+        self._by_digest: Dict[str, str] = {}
+        os.makedirs(target_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, target_dir: str) -> "AttachmentWriter":
+        return cls(
+            target_dir,
+            max_attachment_bytes=int(os.getenv("ATTACHMENT_MAX_BYTES", str(50 * 1024 * 1024))),
+            max_message_bytes=int(os.getenv("MESSAGE_ATTACHMENTS_MAX_BYTES", str(200 * 1024 * 1024))),
+        )
+
+    def open(self, filename: Optional[str]) -> "AttachmentSink":
+        return AttachmentSink(self, _safe_filename(filename))
+
+    def _origin(self, span: Optional[Tuple[int, int]], encoding: Optional[str]) -> Optional[Dict[str, Any]]:
+        if span is None or not self.source_path:
+            return None
+        try:
+            st = os.stat(self.source_path)
+        except OSError:
+            return None  # source gone: the saved file is forwarded re-encoded
+        return {
+            "source": self.source_path,
+            "offset": span[0],
+            "length": span[1] - span[0],
+            "encoding": (encoding or "7bit").strip().lower(),
+            "source_size": st.st_size,
+            "source_mtime": st.st_mtime,
+        }
+
+    def _commit(self, tmp_path: str, filename: str, digest: str, size: int, origin: Optional[Dict[str, Any]] = None) -> None:
+        existing = self._by_digest.get(digest)
+        if existing is not None:
+            os.remove(tmp_path)
+            return
+        stem, ext = os.path.splitext(filename)
+        out_path = os.path.join(self.target_dir, filename)
+        n = 1
+        while os.path.exists(out_path):
+            if _file_digest(out_path) == digest:
+                # Same content already on disk (e.g. a repeated save into the same dir)
+                os.remove(tmp_path)
+                self._by_digest[digest] = out_path
+                self.saved.append(out_path)
+                if origin is not None:
+                    self.sources[out_path] = origin
+                return
+            out_path = os.path.join(self.target_dir, f"{stem} ({n}){ext}")
+            n += 1
+        os.replace(tmp_path, out_path)
+        self._by_digest[digest] = out_path
+        self.total_bytes += size
+        self.saved.append(out_path)
+        if origin is not None:
+            self.sources[out_path] = origin
+
+    def write_manifest(self) -> None:
+        """Record original encoded spans so forwarding can copy them instead of re-encoding."""
+        if not self.sources:
+            return
+        path = os.path.join(self.target_dir, MANIFEST_NAME)
+        manifest: Dict[str, Any] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+        manifest.update(self.sources)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+
+class AttachmentSink:
+    """Receives decoded bytes of one attachment; see AttachmentWriter."""
+
+    def __init__(self, writer: AttachmentWriter, filename: str):
+        self.writer = writer
+        self.filename = filename
+        self.size = 0
+        self.aborted = False
+        # Byte range of the still-encoded body in writer.source_path, set by the walker
+        self.span: Optional[Tuple[int, int]] = None
+        self.encoding: Optional[str] = None
+        self._hash = hashlib.sha256()
+        self._tmp_path = os.path.join(writer.target_dir, f".{filename}.{id(self)}.part")
+        self._file: Optional[BinaryIO] = open(self._tmp_path, "wb")
+
+    def write(self, data: bytes) -> None:
+        if self.aborted or not data:
+            return
+        self.size += len(data)
+        w = self.writer
+        if w.max_attachment_bytes and self.size > w.max_attachment_bytes:
+            self._abort(f"attachment over budget ({w.max_attachment_bytes} bytes): {self.filename}")
+            return
+        if w.max_message_bytes and w.total_bytes + self.size > w.max_message_bytes:
+            self._abort(f"message attachment budget exhausted ({w.max_message_bytes} bytes): {self.filename}")
+            return
+        self._hash.update(data)
+        assert self._file is not None
+        self._file.write(data)
+
+    def defect(self, note: str) -> None:
+        self.writer.notes.append(f"{note}: {self.filename}")
+
+    def _abort(self, note: str) -> None:
+        self.aborted = True
+        self.writer.notes.append(note)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        if self.aborted:
+            return
+        assert self._file is not None
+        self._file.close()
+        self._file = None
+        count_bytes("decoded", self.size)
+        origin = self.writer._origin(self.span, self.encoding)
+        self.writer._commit(self._tmp_path, self.filename, self._hash.hexdigest(), self.size, origin)
+
+
+class _LineReader:
+    """Line iterator that caps line length and remembers whether a chunk starts a line."""
+
+    def __init__(self, fp: BinaryIO):
+        self._fp = fp
+        self.line_start = True
+        self._next_start = True
+        try:
+            self.can_tell = fp.seekable()
+        except (AttributeError, OSError):
+            self.can_tell = False
+
+    def tell(self) -> int:
+        return self._fp.tell()
+
+    def readline(self) -> bytes:
+        line = self._fp.readline(_LINE_LIMIT)
+        self.line_start = self._next_start
+        self._next_start = line.endswith(b"\n")
+        return line
+
+
+def _delimiter(line: bytes, boundaries: List[bytes]) -> Optional[bytes]:
+    """Return the boundary `line` delimits (innermost first), or None for body lines."""
+    if not line.startswith(b"--"):
+        return None
+    stripped = line.rstrip(_WHITESPACE)
+    for boundary in reversed(boundaries):
+        marker = b"--" + boundary
+        if stripped == marker or stripped == marker + b"--":
+            return boundary
+    return None
+
+
+def _is_close(line: bytes, boundary: bytes) -> bool:
+    return line.rstrip(_WHITESPACE) == b"--" + boundary + b"--"
+
+
+LeafHandler = Callable[[EmailMessage], Optional[AttachmentSink]]
+HeadersHandler = Callable[[EmailMessage], None]
+
+
+def _skip_to_delimiter(reader: _LineReader, boundaries: List[bytes]) -> Optional[bytes]:
+    while True:
+        line = reader.readline()
+        if not line:
+            return None
+        if reader.line_start and _delimiter(line, boundaries) is not None:
+            return line
+
+
+def _walk_entity(
+    reader: _LineReader,
+    boundaries: List[bytes],
+    on_leaf: LeafHandler,
+    on_headers: Optional[HeadersHandler] = None,
+) -> Optional[bytes]:
+    """Consume one MIME entity; return the delimiter line that ended it (None at EOF)."""
+    header_lines: List[bytes] = []
+    while True:
+        line = reader.readline()
+        if not line:
+            return None
+        if reader.line_start and _delimiter(line, boundaries) is not None:
+            return line
+        if reader.line_start and line in (b"\r\n", b"\n"):
+            break
+        header_lines.append(line)
+    headers: EmailMessage = BytesHeaderParser(policy=policy.default).parsebytes(b"".join(header_lines))  # type: ignore[assignment]
+    if on_headers is not None:
+        on_headers(headers)
+
+    boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+    if boundary:
+        inner = boundary.encode("utf-8", "surrogateescape")
+        stack = boundaries + [inner]
+        term = _skip_to_delimiter(reader, stack)
+        while term is not None and _delimiter(term, stack) == inner and not _is_close(term, inner):
+            term = _walk_entity(reader, stack, on_leaf)
+        if term is not None and _is_close(term, inner):
+            # Epilogue runs until the enclosing delimiter (or EOF at top level)
+            term = _skip_to_delimiter(reader, boundaries)
+        return term
+
+    sink = on_leaf(headers)
+    decoder = None
+    if sink is not None:
+        # Raw sinks get the body still transfer-encoded (e.g. to size it without decoding)
+        decoder = make_decoder(None if getattr(sink, "raw", False) else headers.get("Content-Transfer-Encoding"))
+    body_start = reader.tell() if sink is not None and reader.can_tell else None
+    pending = b""
+    term = None
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        if reader.line_start and _delimiter(line, boundaries) is not None:
+            term = line
+            break
+        if sink is not None and not sink.aborted:
+            sink.write(decoder.feed(pending))  # type: ignore[union-attr]
+        pending = line
+    if sink is not None:
+        body_end = reader.tell() if body_start is not None else None
+        if term is not None:
+            # The line break before a delimiter belongs to the delimiter
+            if pending.endswith(b"\r\n"):
+                pending = pending[:-2]
+                trimmed = 2
+            elif pending.endswith(b"\n"):
+                pending = pending[:-1]
+                trimmed = 1
+            else:
+                trimmed = 0
+            if body_end is not None:
+                body_end -= len(term) + trimmed
+        if body_start is not None and body_end is not None:
+            sink.span = (body_start, max(body_start, body_end))
+            sink.encoding = headers.get("Content-Transfer-Encoding")
+        if not sink.aborted:
+            sink.write(decoder.feed(pending))  # type: ignore[union-attr]
+            sink.write(decoder.flush())  # type: ignore[union-attr]
+            defects = getattr(decoder, "defects", 0)
+            if defects and hasattr(sink, "defect"):
+                sink.defect(f"invalid base64 ({defects} characters skipped)")
+        sink.close()
+    return term
+
+
+def walk_mime(fp: BinaryIO, on_leaf: LeafHandler, on_headers: Optional[HeadersHandler] = None) -> None:
+    """Single streaming pass over a raw RFC822 message.
+
+    `on_leaf` gets the headers of each non-multipart entity and returns a sink for its
+    transfer-decoded body (encoded if the sink sets `raw`), or None to skip it.
+    `on_headers` gets the top-level headers before anything else. Bodies are never
+    held in memory whole.
+    """
+    _walk_entity(_LineReader(fp), [], on_leaf, on_headers)
+
+
+def stream_attachments(
+    fp: BinaryIO,
+    writer: AttachmentWriter,
+    skip_exts: Optional[set] = None,
+    source_path: Optional[str] = None,
+) -> List[str]:
+    """Decode every `Content-Disposition: attachment` part of `fp` straight into `writer`.
+
+    With `source_path` (the file behind `fp`), each part's encoded byte range is kept
+    in `writer.sources` for zero-copy forwarding.
+    """
+    skip_exts = skip_exts or set()
+    writer.source_path = source_path
+
+    def _on_leaf(headers: EmailMessage) -> Optional[AttachmentSink]:
+        if headers.get_content_disposition() != "attachment":
+            return None
+        filename = headers.get_filename() or "attachment"
+        if os.path.splitext(filename)[1].lower() in skip_exts:
+            return None
+        return writer.open(filename)
+
+    walk_mime(fp, _on_leaf)
+    return writer.saved
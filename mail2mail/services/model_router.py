@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import os
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+from mail2mail.services.context_budget import estimate_tokens
+from mail2mail.services.metrics import REGISTRY, metrics_enabled
+from mail2mail.services.mime_normalize import body_text
+from mail2mail.services.prefilter import PrefilterResult, load_prefilter_rules
+
+
+MODEL_TIER_TOTAL = REGISTRY.counter(
+    "mail2mail_model_tier_total", "Triage calls by model tier (small, large, escalated).", ("tier",)
+)
+
+# Weights of the complexity signals; they add up to 1
+_LENGTH_WEIGHT = 0.35
+_ATTACHMENTS_WEIGHT = 0.25
+_LANGUAGE_WEIGHT = 0.15
+_PREFILTER_WEIGHT = 0.25
+# Text at which the length signal saturates, and attachment count likewise
+_LONG_TOKENS = 4000
+_MANY_ATTACHMENTS = 4
+
+
+class Complexity(BaseModel):
+    """How hard a message looks before any model call: 0 (trivial) to 1."""
+
+    score: float = 0.0
+    reasons: List[str] = Field(default_factory=list)
+
+
+def _script_mix(text: str) -> float:
+    """0 for single-script Latin or Cyrillic text, up to 1 for mixed or other scripts."""
+    latin = cyrillic = other = 0
+    for ch in text[:5000]:
+        if not ch.isalpha():
+            continue
+        code = ord(ch)
+        if code < 0x250:
+            latin += 1
+        elif 0x400 <= code < 0x530:
+            cyrillic += 1
+        else:
+            other += 1
+    total = latin + cyrillic + other
+    if not total:
+        return 0.0
+    if other / total > 0.1:
+        return 1.0
+    return min(1.0, min(latin, cyrillic) / total / 0.3)
+
+
+def estimate_complexity(
+    message: Dict[str, Any],
+    attachments_text: str = "",
+    verdict: Optional[PrefilterResult] = None,
+) -> Complexity:
+    """Length, attachment count, language mix and pre-filter ambiguity folded into one score."""
+    body = body_text(message)
+    reasons: List[str] = []
+    score = 0.0
+
+    tokens = estimate_tokens(body) + (estimate_tokens(attachments_text) if attachments_text else 0)
+    length = min(1.0, tokens / _LONG_TOKENS)
+    score += _LENGTH_WEIGHT * length
+    if length >= 0.5:
+        reasons.append(f"long text (~{tokens} tokens)")
+
+    count = len(message.get("attachments_meta") or [])
+    score += _ATTACHMENTS_WEIGHT * min(1.0, count / _MANY_ATTACHMENTS)
+    if count:
+        reasons.append(f"{count} attachment(s)")
+
+    mix = _script_mix(body)
+    score += _LANGUAGE_WEIGHT * mix
+    if mix >= 0.5:
+        reasons.append("mixed or uncommon script")
+
+    if verdict is not None:
+        spam_threshold = float(load_prefilter_rules().get("spam_threshold", 0.8))
+        # Spam signals just under the threshold are the ambiguous cases; a routing hint or a
+        # trusted sender makes the call easier
+        ambiguity = min(1.0, verdict.score / spam_threshold) if spam_threshold > 0 else 0.0
+        if any(r.startswith(("weak routing hint", "trusted sender")) for r in verdict.reasons):
+            ambiguity /= 2
+        score += _PREFILTER_WEIGHT * ambiguity
+        if ambiguity >= 0.5:
+            reasons.append(f"ambiguous pre-filter score {verdict.score:.2f}")
+
+    return Complexity(score=round(min(score, 1.0), 3), reasons=reasons)
+
+
+class ModelTiers:
+    """Small and large triage models: the small one for simple mail, the large one for the rest.
+
+    A small-model answer whose `confidence` is below `escalate_below` is redone with the large model.
+    """
+
+    def __init__(self, small: str, large: str, complexity_threshold: float = 0.4, escalate_below: float = 0.6):
+        self.small = small
+        self.large = large
+        self.complexity_threshold = complexity_threshold
+        self.escalate_below = escalate_below
+
+    @property
+    def label(self) -> str:
+        """Stands for the pair wherever a single model name identifies the configuration."""
+        return f"{self.small}>{self.large}"
+
+    def choose(self, complexity: Complexity) -> str:
+        model = self.small if complexity.score < self.complexity_threshold else self.large
+        count_tier("small" if model == self.small else "large")
+        return model
+
+    def should_escalate(self, model: str, decision: Any) -> bool:
+        if model != self.small:
+            return False
+        confidence = getattr(decision, "confidence", None)
+        return confidence is not None and confidence < self.escalate_below
+
+
+def count_tier(tier: str) -> None:
+    if metrics_enabled():
+        MODEL_TIER_TOTAL.inc(tier)
+
+
+def get_model_tiers(default_model: str) -> Optional[ModelTiers]:
+    """Tiers from TRIAGE_MODEL_SMALL / TRIAGE_MODEL_LARGE, or None when routing is off.
+
+    The large model defaults to `default_model` (settings.model).
+    """
+    small = os.getenv("TRIAGE_MODEL_SMALL", "").strip()
+    large = os.getenv("TRIAGE_MODEL_LARGE", "").strip() or default_model
+    if not small or small == large:
+        return None
+    return ModelTiers(
+        small,
+        large,
+        complexity_threshold=float(os.getenv("TRIAGE_COMPLEXITY_THRESHOLD", "0.4")),
+        escalate_below=float(os.getenv("TRIAGE_ESCALATE_BELOW", "0.6")),
+    )
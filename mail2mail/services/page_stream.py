@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import os
+from typing import Iterator, List, Tuple
+
+
+# Formats PyMuPDF opens natively and extracts text from page by page
+PAGED_EXTS = {".pdf", ".xps", ".oxps", ".epub", ".mobi", ".fb2", ".cbz"}
+# Plain-text formats we can stream ourselves
+TEXT_EXTS = {".txt", ".csv", ".tsv", ".md", ".json", ".xml", ".log", ".eml"}
+
+_TEXT_BLOCK_CHARS = 4000
+
+
+def can_stream(path: str) -> bool:
+    ext = os.path.splitext(path)[1].lower()
+    return ext in PAGED_EXTS or ext in TEXT_EXTS
+
+
+def iter_page_texts(path: str) -> Iterator[str]:
+    """Yield a document's text one page (or one text block) at a time.
+
+    Pages are produced lazily, so a consumer that stops early never touches the rest
+    of the document.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PAGED_EXTS:
+        try:
+            import pymupdf as fitz
+        except ImportError:  # PyMuPDF < 1.24.3
+            import fitz  # type: ignore[no-redef]
+
+        with fitz.open(path) as doc:
+            for page in doc:
+                yield page.get_text("text") or ""
+        return
+    if ext in TEXT_EXTS:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            while True:
+                block = f.read(_TEXT_BLOCK_CHARS)
+                if not block:
+                    return
+                yield block
+        return
+    raise ValueError(f"page streaming not supported for {ext or 'files without extension'}")
+
+
+def take_text(pages: Iterator[str], budget: int) -> Tuple[str, int, bool]:
+    """Concatenate pages until `budget` characters; returns (text, pages_read, truncated)."""
+    parts: List[str] = []
+    used = 0
+    read = 0
+    for page in pages:
+        read += 1
+        page = page.strip()
+        if not page:
+            continue
+        room = max(0, budget - used)
+        if room <= 0:
+            # Budget already spent and there is more text
+            return "\n\n".join(parts), read, True
+        if len(page) > room:
+            parts.append(page[:room])
+            return "\n\n".join(parts), read, True
+        parts.append(page)
+        used += len(page) + 2
+    return "\n\n".join(parts), read, False
+
+
+def default_preview_budget() -> int:
+    return int(os.getenv("DOCPROC_PREVIEW_MAX_CHARS", "8000"))
+
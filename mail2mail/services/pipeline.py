@@ -0,0 +1,570 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from mail2mail.agents.triage_compose import (
+    TRIAGE_COMPOSE_INSTRUCTIONS,
+    ComposeDecision,
+    ComposeEnvelope,
+    build_triage_compose_agent,
+)
+from mail2mail.services.context_budget import attachments_max_tokens, fit_attachment_text
+from mail2mail.services.decision_cache import Fingerprint, config_version, fingerprint, get_decision_cache
+from mail2mail.services.metrics import record_usage, stage
+from mail2mail.services.mime_normalize import body_text
+from mail2mail.services.model_router import Complexity, count_tier, estimate_complexity, get_model_tiers
+from mail2mail.services.prefilter import PrefilterResult, evaluate, get_sender_reputation, sender_of
+from mail2mail.services.scheduler import get_model_loop, get_rate_limiter
+from mail2mail.services.settings_cache import SettingsSnapshot, get_snapshot
+from mail2mail.services.triage_batch import (
+    batch_item_max_tokens,
+    batchable,
+    get_offline_triage,
+    get_triage_batcher,
+    offline_triage_accounts,
+)
+from mail2mail.tools.docproc_tools import preview_paths
+from mail2mail.tools.email_tools import forward_key, read_email_message, send_once
+from mail2mail.tools.housekeeping_tools import cleanup_work_dir
+from mail2mail.tools.routing_tools import resolve_route
+from mail2mail.tools.storage_tools import raw_message_path, save_message_attachments
+
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineResult(BaseModel):
+    account_id: str
+    message_id: str
+    # "prefilter" when decided locally, otherwise the agent that produced `decision`
+    source: str
+    status: str
+    prefilter: Optional[PrefilterResult] = None
+    decision: Optional[Dict[str, Any]] = None
+    work_dir: Optional[str] = None
+    # Identity used by the forward-once guard in `deliver`
+    message_key: Optional[str] = None
+    # Model that made the decision and the complexity estimate it was picked by
+    model: Optional[str] = None
+    complexity: Optional[Complexity] = None
+
+
+def work_dir_for(account_id: str, message_id: str) -> str:
+    tmp_root = os.getenv("TMP_ROOT", os.path.abspath(os.path.join(os.getcwd(), "tmp")))
+    digest = hashlib.sha1(f"{account_id}\x00{message_id}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(tmp_root, "work", digest)
+
+
+def _header(message: Dict[str, Any], name: str) -> str:
+    for k, v in (message.get("headers") or {}).items():
+        if str(k).lower() == name.lower():
+            return str(v)
+    return ""
+
+
+def message_key(account_id: str, message_id: str, message: Dict[str, Any]) -> str:
+    """Stable identity of a message: its Message-ID header, else where it was read from.
+
+    A bare `imap:<UID>` is reused after a UIDVALIDITY reset, so an IMAP message without
+    Message-ID is keyed by mailbox, UIDVALIDITY and UID.
+    """
+    mid = _header(message, "Message-ID").strip().strip("<>").lower()
+    if mid:
+        return f"{account_id}/{mid}"
+    origin = message.get("imap") or {}
+    if origin.get("uid") is not None:
+        return f"{account_id}/imap:{origin.get('mailbox')}:{origin.get('uidvalidity')}:{origin['uid']}"
+    return f"{account_id}/{message_id}"
+
+
+def _prefilter_decision(
+    account_id: str,
+    message_id: str,
+    message: Dict[str, Any],
+    verdict: PrefilterResult,
+    work_dir: str,
+) -> ComposeDecision:
+    reason = "prefilter: " + "; ".join(verdict.reasons or [verdict.verdict])
+    if verdict.verdict != "route" or not verdict.category:
+        return ComposeDecision(is_relevant=False, reason=reason, task_markdown="")
+
+    route = resolve_route(verdict.category)
+    if not route.get("to"):
+        return ComposeDecision(is_relevant=True, reason=reason, task_markdown=f"Категория: {verdict.category}")
+    saved = save_message_attachments(account_id, message_id, work_dir).get("saved_paths", [])
+    prefix = route.get("subject_prefix")
+    subject = _header(message, "Subject")
+    return ComposeDecision(
+        is_relevant=True,
+        reason=reason,
+        task_markdown=f"Категория: {verdict.category}",
+        compose=ComposeEnvelope(
+            to=route["to"],
+            subject=f"{prefix} {subject}".strip() if prefix else subject,
+            body_text=body_text(message),
+            attach_paths=saved,
+        ),
+    )
+
+
+def _routing_table() -> List[Dict[str, Any]]:
+    return [route.table_entry() for route in get_snapshot().routes]
+
+
+def build_analysis_text(
+    message: Dict[str, Any],
+    saved_paths: List[str],
+    attachments_text: str,
+    verdict: Optional[PrefilterResult] = None,
+    routing: bool = True,
+) -> str:
+    """Assemble the "text for analysis" the orchestrator prompt describes, in code.
+
+    Batched requests pass `routing=False` and carry the routing table once for all messages.
+    """
+    lines: List[str] = ["[HEADERS]"]
+    for name in ("From", "To", "Cc", "Date", "Subject"):
+        value = _header(message, name)
+        if value:
+            lines.append(f"{name}: {value}")
+    lines += ["", "[BODY]", body_text(message)]
+    links = message.get("links") or []
+    if links:
+        lines += ["", "[LINKS]"] + [str(u) for u in links]
+    meta = message.get("attachments_meta") or []
+    if meta or saved_paths:
+        lines += ["", "[ATTACHMENTS]"]
+        lines += [f"- {m.get('filename')} ({m.get('mime')}, {m.get('size_bytes')} bytes)" for m in meta]
+        lines += ["Saved paths:"] + [f"- {p}" for p in saved_paths]
+    if attachments_text:
+        lines += ["", "[ATTACHMENTS TEXT]", attachments_text]
+    if verdict is not None and verdict.reasons:
+        lines += ["", "[PREFILTER]", f"{verdict.verdict} ({verdict.score:.2f}): " + "; ".join(verdict.reasons)]
+    if routing:
+        lines += ["", "[ROUTING]", json.dumps(_routing_table(), ensure_ascii=False)]
+    return "\n".join(lines)
+
+
+def attachments_prompt_text(message: Dict[str, Any], preview: Dict[str, Any]) -> str:
+    """preview_paths output fitted into TRIAGE_ATTACHMENTS_MAX_TOKENS: ranked, deduplicated, tables shortened."""
+    sections = [(s["path"], s["text"]) for s in preview.get("sections") or []]
+    text, trimmed = fit_attachment_text(sections, attachments_max_tokens(), body_text(message))
+    if text and (trimmed or preview.get("truncated")):
+        text += "\n\n[attachment text trimmed to budget]"
+    return text
+
+
+def _status_of(decision: ComposeDecision) -> str:
+    if not decision.is_relevant:
+        return "spam"
+    return "ready_to_send" if decision.compose is not None else "no_route"
+
+
+def _short_circuit(
+    account_id: str,
+    message_id: str,
+    message: Dict[str, Any],
+    verdict: PrefilterResult,
+    work_dir: str,
+) -> Optional[PipelineResult]:
+    """PipelineResult for a final pre-filter verdict, or None when the message needs a model."""
+    if not verdict.is_final:
+        return None
+    try:
+        decision = _prefilter_decision(account_id, message_id, message, verdict, work_dir)
+    except Exception:
+        # Fast path is an optimization only; never lose a message to it
+        logger.exception("pre-filter fast path failed for %s %s", account_id, message_id)
+        return None
+    # No reputation update: counting the pre-filter's own verdicts (which reputation feeds)
+    # would make a sender's spam score self-reinforcing
+    return PipelineResult(
+        account_id=account_id,
+        message_id=message_id,
+        source="prefilter",
+        status=verdict.verdict if verdict.verdict != "route" else _status_of(decision),
+        prefilter=verdict,
+        decision=decision.model_dump(),
+        work_dir=work_dir,
+        message_key=message_key(account_id, message_id, message),
+    )
+
+
+def _orchestrator_input(account_id: str, message_id: str, work_dir: str, message: Dict[str, Any], verdict: PrefilterResult) -> str:
+    # The message is already read; handing it over saves the agent a read_message turn
+    return json.dumps(
+        {
+            "account_id": account_id,
+            "message_id": message_id,
+            "work_dir": work_dir,
+            "message": message,
+            "prefilter": verdict.model_dump(),
+        },
+        ensure_ascii=False,
+        default=str,
+    )
+
+
+def _use_api_key(api_key: Optional[str]) -> None:
+    if api_key:
+        from agents import set_default_openai_key
+
+        set_default_openai_key(api_key)
+
+
+async def _with_forward_key(key: Optional[str], coro: Any) -> Any:
+    # Set inside the model-loop task, so the agent's send tool sees it (context is per task)
+    forward_key.set(key)
+    return await coro
+
+
+async def _run_agent(agent: Any, text: str, key: Optional[str] = None) -> Any:
+    """Runner.run under the shared LLM rate limit, timed as stage "llm" with token usage recorded.
+
+    The run itself happens on the process-wide model loop (see scheduler.get_model_loop).
+    `key` is the message the run handles: the send tool forwards it at most once.
+    """
+    # The agents SDK (and openai) load on the first model call, or earlier in warmup
+    from agents import Runner
+
+    await get_rate_limiter("llm").acquire_async()
+    with stage("llm", agent=agent.name):
+        result = await get_model_loop().wrap(_with_forward_key(key, Runner.run(agent, text)))
+    record_usage(agent.name, result)
+    return result
+
+
+async def run_orchestrated(account_id: str, message_id: str, tiered: bool = True) -> PipelineResult:
+    """Process one message: local pre-filter first, the tool-calling orchestrator only for ambiguous mail.
+
+    With model tiers configured (`tiered`), simple mail gets the small model.
+    """
+    work_dir = work_dir_for(account_id, message_id)
+    message = read_email_message(account_id, message_id)
+    verdict = evaluate(message)
+    shortcut = _short_circuit(account_id, message_id, message, verdict, work_dir)
+    if shortcut is not None:
+        return shortcut
+
+    settings = get_snapshot().settings
+    tiers = get_model_tiers(settings.orchestrator_model or settings.model) if tiered else None
+    complexity: Optional[Complexity] = None
+    model: Optional[str] = None
+    if tiers is not None:
+        complexity = estimate_complexity(message, verdict=verdict)
+        model = tiers.choose(complexity)
+    from mail2mail.agents.orchestrator import build_orchestrator_agent
+
+    agent = build_orchestrator_agent(model)
+    key = message_key(account_id, message_id, message)
+    result = await _run_agent(agent, _orchestrator_input(account_id, message_id, work_dir, message, verdict), key)
+    output = result.final_output
+    data = output.model_dump() if isinstance(output, BaseModel) else {"output": output}
+    if "is_spam" in data:
+        get_sender_reputation().record(sender_of(message), bool(data.get("is_spam")))
+    return PipelineResult(
+        account_id=account_id,
+        message_id=message_id,
+        source="orchestrator",
+        status=str(data.get("status") or ("spam" if data.get("is_spam") else "ready_to_send")),
+        prefilter=verdict,
+        decision=data,
+        work_dir=work_dir,
+        message_key=key,
+        model=str(agent.model),
+        complexity=complexity,
+    )
+
+
+def _category_for(decision: ComposeDecision) -> Optional[str]:
+    """Routing category whose recipients the composed mail goes to, if any."""
+    if decision.compose is None:
+        return None
+    to = {a.lower() for a in decision.compose.to}
+    for route in get_snapshot().routes:
+        if to and {a.lower() for a in route.to} == to:
+            return route.category
+    return None
+
+
+def _attachment_name(path: str) -> str:
+    # Saved names may carry a " (n)" collision suffix (see AttachmentWriter)
+    return re.sub(r" \(\d+\)(?=\.[^.]*$|$)", "", os.path.basename(path))
+
+
+def _decision_skeleton(decision: ComposeDecision) -> Dict[str, Any]:
+    # Message-specific text is rebuilt on reuse; attachments are remembered by file name
+    data = decision.model_dump()
+    if data.get("compose"):
+        data["compose"]["subject"] = ""
+        data["compose"]["body_text"] = ""
+        data["compose"]["attach_paths"] = [_attachment_name(p) for p in data["compose"]["attach_paths"]]
+    return data
+
+
+def _from_cache(
+    account_id: str,
+    message_id: str,
+    message: Dict[str, Any],
+    hit: Dict[str, Any],
+    work_dir: str,
+) -> Optional[ComposeDecision]:
+    """Rebuild a decision from a cached skeleton for the current message, or None if it can't be reused."""
+    payload = hit["payload"]
+    if not payload.get("is_relevant"):
+        return ComposeDecision(**payload)
+    compose = payload.get("compose")
+    if compose is None:
+        return ComposeDecision(**payload)
+    if hit["near"] or not hit["category"]:
+        # Forwarded content must come from this exact template, not a look-alike
+        return None
+    route = resolve_route(hit["category"])
+    saved: List[str] = []
+    if compose.get("attach_paths"):
+        saved = save_message_attachments(account_id, message_id, work_dir).get("saved_paths", [])
+    wanted = set(compose.get("attach_paths") or [])
+    prefix = route.get("subject_prefix")
+    subject = _header(message, "Subject")
+    compose.update(
+        to=route.get("to") or compose.get("to") or [],
+        subject=f"{prefix} {subject}".strip() if prefix else subject,
+        body_text=body_text(message),
+        attach_paths=[p for p in saved if _attachment_name(p) in wanted],
+    )
+    return ComposeDecision(**payload)
+
+
+def _version_for(snapshot: SettingsSnapshot, instructions: str, model: str, category: Optional[str]) -> str:
+    route = snapshot.route(category)
+    return config_version(instructions, model, route.table_entry() if route is not None else None)
+
+
+def _settle(
+    decision: ComposeDecision,
+    saved: List[str],
+    sender: str,
+    fp: Optional[Fingerprint],
+    snapshot: SettingsSnapshot,
+    instructions: str,
+    model: str,
+) -> None:
+    """Bookkeeping after a model decision, whichever way (direct, batched, Batch API) it was made."""
+    if decision.compose is not None:
+        # Only files we extracted may be forwarded
+        decision.compose.attach_paths = [p for p in decision.compose.attach_paths if p in saved]
+    if decision.is_relevant:
+        # ComposeDecision has no spam judgement: irrelevant mail is not necessarily spam
+        get_sender_reputation().record(sender, False)
+    cache = get_decision_cache()
+    if cache is not None and fp is not None:
+        category = _category_for(decision)
+        if decision.compose is None or category:
+            cache.store(fp, "compose", _decision_skeleton(decision), category, _version_for(snapshot, instructions, model, category))
+
+
+async def run_single_shot(
+    account_id: str,
+    message_id: str,
+    instructions: Optional[str] = None,
+    model: Optional[str] = None,
+    allow_deferred: bool = True,
+) -> PipelineResult:
+    """Code-driven pipeline: fetch, extract and route in Python, then one triage/compose model call.
+
+    With TRIAGE_BATCH_ENABLED small mail without attachments shares the call with other
+    messages in flight; mailboxes in TRIAGE_OFFLINE_ACCOUNTS get status "deferred" and
+    are finished by `complete_deferred` once the Batch API answers. Unless `model` is
+    given, TRIAGE_MODEL_SMALL/LARGE tiers pick the model by estimated complexity and a
+    low-confidence small-model answer is redone by the large model.
+    """
+    snapshot = get_snapshot()
+    settings = snapshot.settings
+    work_dir = work_dir_for(account_id, message_id)
+    message = read_email_message(account_id, message_id)
+    verdict = evaluate(message)
+    shortcut = _short_circuit(account_id, message_id, message, verdict, work_dir)
+    if shortcut is not None:
+        return shortcut
+
+    instructions = instructions or TRIAGE_COMPOSE_INSTRUCTIONS
+    tiers = get_model_tiers(settings.model)
+    # Cached decisions belong to the tier pair, not to whichever tier answered
+    config_model = tiers.label if tiers is not None and model in (None, tiers.small, tiers.large) else (model or settings.model)
+    def version_for(category: Optional[str]) -> str:
+        return _version_for(snapshot, instructions, config_model, category)
+
+    cache = get_decision_cache()
+    fp: Optional[Fingerprint] = fingerprint(message) if cache is not None else None
+    if cache is not None and fp is not None:
+        hit = cache.lookup(fp, "compose", version_for)
+        cached = _from_cache(account_id, message_id, message, hit, work_dir) if hit else None
+        if cached is not None:
+            return PipelineResult(
+                account_id=account_id,
+                message_id=message_id,
+                source="decision_cache",
+                status=_status_of(cached),
+                prefilter=verdict,
+                decision=cached.model_dump(),
+                work_dir=work_dir,
+                message_key=message_key(account_id, message_id, message),
+            )
+
+    saved: List[str] = []
+    attachments_text = ""
+    if message.get("attachments_meta"):
+        saved = save_message_attachments(account_id, message_id, work_dir).get("saved_paths", [])
+        attachments_text = attachments_prompt_text(message, preview_paths(saved))
+
+    complexity = estimate_complexity(message, attachments_text, verdict)
+    if model is None:
+        model = tiers.choose(complexity) if tiers is not None else settings.model
+    key = message_key(account_id, message_id, message)
+    if allow_deferred and account_id in offline_triage_accounts():
+        context = {
+            "work_dir": work_dir,
+            "saved": saved,
+            "sender": sender_of(message),
+            "message_key": key,
+            "prefilter": verdict.model_dump(),
+            "fingerprint": [fp.sender, fp.template, fp.body_hash] if fp is not None else None,
+            "config_model": config_model,
+        }
+        text = build_analysis_text(message, saved, attachments_text, verdict)
+        get_offline_triage().enqueue(account_id, message_id, model, instructions, text, context)
+        return PipelineResult(
+            account_id=account_id,
+            message_id=message_id,
+            source="batch_api",
+            status="deferred",
+            prefilter=verdict,
+            work_dir=work_dir,
+            message_key=key,
+            model=model,
+            complexity=complexity,
+        )
+
+    _use_api_key(settings.openai_api_key)
+    decision: Optional[ComposeDecision] = None
+    source = "triage_compose"
+    batcher = get_triage_batcher()
+    if batcher is not None:
+        text = build_analysis_text(message, saved, attachments_text, verdict, routing=False)
+        if batchable(message, text, batch_item_max_tokens()):
+            routing = json.dumps(_routing_table(), ensure_ascii=False)
+            decision = await asyncio.wrap_future(batcher.submit(instructions, model, routing, text))
+            source = "triage_compose_batch"
+    if decision is None:
+        # Not batchable, alone in its window or not answered by the batch: a call of its own
+        agent = build_triage_compose_agent(instructions, model)
+        result = await _run_agent(agent, build_analysis_text(message, saved, attachments_text, verdict))
+        decision = result.final_output
+        source = "triage_compose"
+    if tiers is not None and tiers.should_escalate(model, decision):
+        count_tier("escalated")
+        model = tiers.large
+        agent = build_triage_compose_agent(instructions, model)
+        result = await _run_agent(agent, build_analysis_text(message, saved, attachments_text, verdict))
+        decision = result.final_output
+        source = "triage_compose"
+    _settle(decision, saved, sender_of(message), fp, snapshot, instructions, config_model)
+    return PipelineResult(
+        account_id=account_id,
+        message_id=message_id,
+        source=source,
+        status=_status_of(decision),
+        prefilter=verdict,
+        decision=decision.model_dump(),
+        work_dir=work_dir,
+        message_key=key,
+        model=model,
+        complexity=complexity,
+    )
+
+
+async def complete_deferred(item: Dict[str, Any], decision: Optional[ComposeDecision]) -> PipelineResult:
+    """Result for a message triaged through the Batch API (see OfflineTriage).
+
+    Without a usable answer the message is run again with a direct model call, and so is
+    a low-confidence small-tier answer, with the large model.
+    """
+    account_id, message_id = item["account_id"], item["message_id"]
+    if decision is None:
+        return await run_single_shot(account_id, message_id, item["instructions"], item["model"], allow_deferred=False)
+    snapshot = get_snapshot()
+    tiers = get_model_tiers(snapshot.settings.model)
+    if tiers is not None and tiers.should_escalate(item["model"], decision):
+        count_tier("escalated")
+        return await run_single_shot(account_id, message_id, item["instructions"], tiers.large, allow_deferred=False)
+    context = item["context"]
+    fp = Fingerprint(*context["fingerprint"]) if context.get("fingerprint") else None
+    config_model = context.get("config_model") or item["model"]
+    _settle(decision, context.get("saved") or [], context.get("sender") or "", fp, snapshot, item["instructions"], config_model)
+    return PipelineResult(
+        account_id=account_id,
+        message_id=message_id,
+        source="batch_api",
+        status=_status_of(decision),
+        prefilter=PrefilterResult(**context["prefilter"]),
+        decision=decision.model_dump(),
+        work_dir=context.get("work_dir"),
+        message_key=context.get("message_key"),
+        model=item["model"],
+    )
+
+
+async def process_message(account_id: str, message_id: str) -> PipelineResult:
+    """Entry point honoring PIPELINE_MODE: `single_shot` (default) or `orchestrator`.
+
+    Single-shot failures fall back to the tool-calling orchestrator.
+    """
+    mode = os.getenv("PIPELINE_MODE", "single_shot").strip().lower()
+    if mode == "single_shot":
+        try:
+            return await run_single_shot(account_id, message_id)
+        except Exception:
+            logger.exception("single-shot pipeline failed for %s %s; falling back to orchestrator", account_id, message_id)
+            # The fallback has to succeed where single-shot did not: no small tier
+            return await run_orchestrated(account_id, message_id, tiered=False)
+    return await run_orchestrated(account_id, message_id)
+
+
+def deliver(result: PipelineResult, from_account_id: str = "__default__") -> Optional[Dict[str, Any]]:
+    """Send the composed mail of a `ready_to_send` result; returns send_email_smtp output.
+
+    Each message is forwarded at most once, across restarts; repeats return None.
+    """
+    if result.status != "ready_to_send" or not result.decision:
+        return None
+    compose = (result.decision or {}).get("compose")
+    if not compose or not compose.get("to"):
+        return None
+    raw_eml = raw_message_path(result.account_id, result.message_id) if compose.get("include_raw_eml") else None
+    return send_once(
+        result.message_key,
+        from_account_id,
+        compose["to"],
+        compose.get("subject") or "",
+        compose.get("body_text") or "",
+        compose.get("attach_paths") or [],
+        raw_eml_path=raw_eml,
+    )
+
+
+def finish(result: PipelineResult) -> None:
+    """Drop per-message temporary state once the result has been delivered.
+
+    Deferred results keep their work_dir: saved attachments are forwarded later.
+    """
+    if result.status == "deferred":
+        return
+    cleanup_work_dir(result.work_dir, result.account_id, result.message_id)
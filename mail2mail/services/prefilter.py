@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import fnmatch
+import os
+import re
+import sqlite3
+import threading
+from email.utils import parseaddr
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from pydantic import BaseModel, Field
+
+from mail2mail.services.mime_normalize import body_text
+from mail2mail.services.settings_cache import get_snapshot
+
+
+class PrefilterResult(BaseModel):
+    """Local verdict taken before any model call.
+
+    verdict: "spam" | "irrelevant" | "route" (category resolved by rules) | "llm" (ambiguous).
+    """
+
+    verdict: str
+    score: float = 0.0
+    category: Optional[str] = None
+    reasons: List[str] = Field(default_factory=list)
+
+    @property
+    def is_final(self) -> bool:
+        return self.verdict != "llm"
+
+
+DEFAULT_PREFILTER = {
+    "enabled": True,
+    "spam_threshold": 0.8,
+    "route_threshold": 0.9,
+    "spam_senders": [],
+    "trusted_senders": [],
+    "spam_keywords": [],
+    "blocked_link_domains": [],
+}
+
+_BULK_PRECEDENCE = {"bulk", "list", "junk"}
+_NOREPLY_LOCALPARTS = ("noreply", "no-reply", "donotreply", "do-not-reply", "mailer-daemon", "newsletter")
+
+def load_prefilter_rules() -> Dict[str, Any]:
+    """`prefilter:` section of settings.yaml merged over defaults, reloaded with the settings snapshot."""
+    snapshot = get_snapshot()
+    return snapshot.memo("prefilter", lambda: {**DEFAULT_PREFILTER, **snapshot.section("prefilter")})
+
+
+class SenderReputation:
+    """Per-sender tally of past model judgements (spam vs. not), persisted in SQLite.
+
+    Only fresh model answers are recorded: the orchestrator's is_spam both ways and relevant
+    single-shot decisions as legitimate. Pre-filter verdicts and cache hits are not.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sender_reputation ("
+                " sender TEXT PRIMARY KEY, spam INTEGER NOT NULL DEFAULT 0, ham INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, reused; `with conn` only commits or rolls back
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def record(self, sender: str, is_spam: bool) -> None:
+        if not sender:
+            return
+        column = "spam" if is_spam else "ham"
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO sender_reputation (sender, {column}) VALUES (?, 1) "
+                f"ON CONFLICT(sender) DO UPDATE SET {column} = {column} + 1",
+                (sender,),
+            )
+
+    def get(self, sender: str) -> Tuple[int, int]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT spam, ham FROM sender_reputation WHERE sender = ?", (sender,)).fetchone()
+        return (int(row[0]), int(row[1])) if row else (0, 0)
+
+
+_REPUTATION: Optional[SenderReputation] = None
+_REPUTATION_LOCK = threading.Lock()
+
+
+def get_sender_reputation() -> SenderReputation:
+    global _REPUTATION
+    with _REPUTATION_LOCK:
+        if _REPUTATION is None:
+            data_dir = os.getenv("DATA_DIR") or os.getcwd()
+            _REPUTATION = SenderReputation(os.getenv("SENDER_REPUTATION_DB", os.path.join(data_dir, "sender_reputation.sqlite3")))
+        return _REPUTATION
+
+
+def _header(headers: Dict[str, Any], name: str) -> str:
+    lname = name.lower()
+    for k, v in headers.items():
+        if str(k).lower() == lname:
+            return str(v)
+    return ""
+
+
+def _matches(address: str, patterns: List[str]) -> bool:
+    address = address.lower()
+    domain = address.rsplit("@", 1)[-1]
+    for pattern in patterns or []:
+        p = str(pattern).strip().lower()
+        if not p:
+            continue
+        if fnmatch.fnmatch(address, p) or (p.startswith("@") and domain == p[1:]) or domain == p:
+            return True
+    return False
+
+
+@lru_cache(maxsize=1024)
+def _keyword_pattern(keyword: str) -> "re.Pattern[str]":
+    # Whole words only: "sale" must not hit "wholesale"
+    return re.compile(r"(?<!\w)" + re.escape(keyword) + r"(?!\w)")
+
+
+def _keyword_hits(text: str, keywords: List[str]) -> List[str]:
+    return [k for k in keywords or [] if str(k).strip() and _keyword_pattern(str(k).strip().lower()).search(text)]
+
+
+def _route_candidates(sender: str, subject: str, body: str) -> List[Tuple[float, str, List[str]]]:
+    """Score routing_rules entries that declare `senders` / `keywords` match hints."""
+    try:
+        routes = get_snapshot().routes
+    except Exception:
+        return []
+    out: List[Tuple[float, str, List[str]]] = []
+    for route in routes:
+        category = route.category
+        confidence = 0.0
+        reasons: List[str] = []
+        if _matches(sender, list(route.senders)):
+            confidence += 0.95
+            reasons.append(f"sender matches routing rule '{category}'")
+        subject_hits = _keyword_hits(subject, list(route.keywords))
+        if subject_hits:
+            confidence += 0.7
+            reasons.append(f"subject keywords for '{category}': {', '.join(subject_hits)}")
+        elif _keyword_hits(body, list(route.keywords)):
+            confidence += 0.3
+            reasons.append(f"body keywords for '{category}'")
+        if confidence:
+            out.append((min(confidence, 1.0), category, reasons))
+    out.sort(key=lambda c: c[0], reverse=True)
+    return out
+
+
+def evaluate(message: Dict[str, Any], rules: Optional[Dict[str, Any]] = None) -> PrefilterResult:
+    """Score a normalized message (read_message output) with headers, links and configured rules."""
+    rules = rules if rules is not None else load_prefilter_rules()
+    if not rules.get("enabled", True):
+        return PrefilterResult(verdict="llm", reasons=["prefilter disabled"])
+
+    headers = message.get("headers") or {}
+    sender = parseaddr(_header(headers, "From"))[1].lower()
+    subject = _header(headers, "Subject").lower()
+    body = body_text(message)[:20000].lower()
+    links: List[str] = message.get("links") or []
+
+    # Explicit sender/keyword routing beats heuristics
+    candidates = _route_candidates(sender, subject, body)
+    if candidates and candidates[0][0] >= float(rules.get("route_threshold", 0.9)):
+        if len(candidates) == 1 or candidates[1][0] < candidates[0][0]:
+            confidence, category, reasons = candidates[0]
+            return PrefilterResult(verdict="route", score=confidence, category=category, reasons=reasons)
+
+    if _matches(sender, rules.get("trusted_senders") or []):
+        return PrefilterResult(verdict="llm", reasons=["trusted sender"])
+
+    auto_submitted = _header(headers, "Auto-Submitted").strip().lower()
+    if auto_submitted.startswith("auto-replied"):
+        return PrefilterResult(verdict="irrelevant", score=0.95, reasons=["Auto-Submitted: auto-replied"])
+
+    score = 0.0
+    evidence = False
+    reasons: List[str] = []
+
+    def add(points: float, reason: str, content: bool = False) -> None:
+        # content marks signals about the message itself rather than how it was sent
+        nonlocal score, evidence
+        score += points
+        evidence = evidence or content
+        reasons.append(reason)
+
+    if _matches(sender, rules.get("spam_senders") or []):
+        add(1.0, "sender on spam list", content=True)
+    if _header(headers, "X-Spam-Flag").strip().lower() == "yes":
+        add(0.6, "X-Spam-Flag: YES", content=True)
+    if _header(headers, "X-Spam-Status").strip().lower().startswith("yes"):
+        add(0.5, "X-Spam-Status: Yes", content=True)
+    if _header(headers, "List-Unsubscribe"):
+        add(0.3, "List-Unsubscribe present")
+    if _header(headers, "List-Id"):
+        add(0.1, "List-Id present")
+    precedence = _header(headers, "Precedence").strip().lower()
+    if precedence in _BULK_PRECEDENCE:
+        add(0.5 if precedence == "junk" else 0.3, f"Precedence: {precedence}")
+    if auto_submitted and auto_submitted != "no":
+        add(0.3, f"Auto-Submitted: {auto_submitted}")
+    if sender.split("@", 1)[0] in _NOREPLY_LOCALPARTS:
+        add(0.2, "no-reply sender")
+
+    hits = _keyword_hits(subject + "\n" + body, rules.get("spam_keywords") or [])
+    if hits:
+        add(min(0.25 * len(hits), 0.5), f"spam keywords: {', '.join(hits[:5])}", content=True)
+    blocked = rules.get("blocked_link_domains") or []
+    bad_links = [u for u in links if _matches(urlparse(u).hostname or "", blocked)]
+    if bad_links:
+        add(0.5, f"links to blocked domains: {len(bad_links)}", content=True)
+    if len(links) > 15:
+        add(0.1, f"many links ({len(links)})")
+
+    if sender:
+        spam, ham = get_sender_reputation().get(sender)
+        seen = spam + ham
+        if seen >= 5 and spam / seen >= 0.9:
+            add(0.6, f"sender reputation: {spam}/{seen} spam", content=True)
+        elif seen >= 5 and ham / seen >= 0.9:
+            add(-0.5, f"sender reputation: {ham}/{seen} legitimate")
+
+    score = max(0.0, min(score, 1.0))
+    if score >= float(rules.get("spam_threshold", 0.8)):
+        if evidence:
+            return PrefilterResult(verdict="spam", score=score, reasons=reasons)
+        # Bulk/automated headers alone also describe receipts, alerts and mailing lists
+        reasons.append("bulk headers only, no content evidence")
+    if candidates:
+        reasons.append(f"weak routing hint: {candidates[0][1]} ({candidates[0][0]:.2f})")
+    return PrefilterResult(verdict="llm", score=score, reasons=reasons)
+
+
+def sender_of(message: Dict[str, Any]) -> str:
+    return parseaddr(_header(message.get("headers") or {}, "From"))[1].lower()
@@ -0,0 +1,425 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS queue_items ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " account_id TEXT NOT NULL,"
+    " message_id TEXT NOT NULL,"
+    " mailbox TEXT NOT NULL DEFAULT '',"
+    " uidvalidity INTEGER NOT NULL DEFAULT 0,"
+    " uid INTEGER,"
+    " status TEXT NOT NULL,"
+    " attempts INTEGER NOT NULL DEFAULT 0,"
+    " claimed_by TEXT,"
+    " lease_until REAL,"
+    " created_at REAL NOT NULL,"
+    " updated_at REAL NOT NULL,"
+    " result TEXT,"
+    " error TEXT,"
+    # "imap:<UID>" is only unique within one mailbox and UIDVALIDITY
+    " UNIQUE (account_id, mailbox, uidvalidity, message_id))",
+    "CREATE INDEX IF NOT EXISTS queue_status ON queue_items (status, id)",
+    "CREATE INDEX IF NOT EXISTS queue_account ON queue_items (account_id, id)",
+    "CREATE INDEX IF NOT EXISTS queue_uid ON queue_items (account_id, mailbox, uidvalidity, uid)",
+    "CREATE INDEX IF NOT EXISTS queue_message ON queue_items (account_id, message_id, id)",
+    "CREATE INDEX IF NOT EXISTS queue_updated ON queue_items (updated_at)",
+)
+
+# Terminal states that retention may delete
+FINISHED_STATUSES = ("done", "failed", "spam", "irrelevant", "no_route", "ready_to_send", "sent")
+
+_COLUMNS = (
+    "id, account_id, message_id, mailbox, uidvalidity, uid, status, attempts, claimed_by, lease_until,"
+    " created_at, updated_at, result, error"
+)
+
+
+def _row(row: sqlite3.Row) -> Dict[str, Any]:
+    item = dict(row)
+    if item.get("result"):
+        try:
+            item["result"] = json.loads(item["result"])
+        except ValueError:
+            pass
+    return item
+
+
+def _uid_of(message_id: str) -> Optional[int]:
+    if message_id.startswith("imap:"):
+        tail = message_id.split(":", 1)[1]
+        return int(tail) if tail.isdigit() else None
+    return None
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Rebuild a queue_items table from before the mailbox/UIDVALIDITY key."""
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(queue_items)")}
+    if not columns or "uidvalidity" in columns:
+        return
+    conn.execute("ALTER TABLE queue_items RENAME TO queue_items_old")
+    for index in ("queue_status", "queue_account", "queue_uid", "queue_updated"):
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+    for stmt in _SCHEMA:
+        conn.execute(stmt)
+    conn.execute(
+        "INSERT INTO queue_items (id, account_id, message_id, mailbox, uid, status, attempts, claimed_by, lease_until,"
+        " created_at, updated_at, result, error)"
+        " SELECT id, account_id, message_id, COALESCE(mailbox, ''), uid, status, attempts, claimed_by, lease_until,"
+        " created_at, updated_at, result, error FROM queue_items_old"
+    )
+    conn.execute("DROP TABLE queue_items_old")
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK; takes the write lock up front so claims can't race."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class QueueDB:
+    """Processing queue and result log in SQLite (WAL).
+
+    Writers touch one row per update; readers page by id. Workers `claim` items under
+    a lease, then `ack` or `nack` them; expired leases become claimable again. Items are
+    keyed by account, mailbox, UIDVALIDITY and message id.
+    """
+
+    def __init__(self, path: str, retention_days: float = 30.0, compact_every: int = 1000):
+        self.path = path
+        self.retention_days = retention_days
+        self.compact_every = compact_every
+        self._local = threading.local()
+        self._acks = 0
+        self._acks_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        with _Transaction(conn):
+            _migrate(conn)
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _insert(
+        conn: sqlite3.Connection,
+        account_id: str,
+        message_id: str,
+        mailbox: Optional[str],
+        uidvalidity: Optional[int],
+        uid: Optional[int],
+        requeue: bool,
+    ) -> int:
+        key = (account_id, mailbox or "", uidvalidity or 0, message_id)
+        now = time.time()
+        conn.execute(
+            "INSERT OR IGNORE INTO queue_items (account_id, mailbox, uidvalidity, message_id, uid, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (*key, uid if uid is not None else _uid_of(message_id), now, now),
+        )
+        row = conn.execute(
+            "SELECT id, status FROM queue_items WHERE account_id = ? AND mailbox = ? AND uidvalidity = ? AND message_id = ?", key
+        ).fetchone()
+        if requeue and row["status"] != "processing":
+            conn.execute("UPDATE queue_items SET status = 'queued', updated_at = ? WHERE id = ?", (now, row["id"]))
+        return int(row["id"])
+
+    def enqueue(
+        self,
+        account_id: str,
+        message_id: str,
+        mailbox: Optional[str] = None,
+        uid: Optional[int] = None,
+        uidvalidity: Optional[int] = None,
+        requeue: bool = False,
+    ) -> int:
+        """Add a message once; re-enqueueing a known message returns its existing id.
+
+        With `requeue`, a known message that is not being processed goes back to `queued`
+        (a retry the caller has decided on).
+        """
+        conn = self._conn()
+        with _Transaction(conn):
+            return self._insert(conn, account_id, message_id, mailbox, uidvalidity, uid, requeue)
+
+    def claim(
+        self,
+        worker: str,
+        lease_seconds: float = 300.0,
+        limit: int = 1,
+        account_id: Optional[str] = None,
+        message_id: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Atomically move up to `limit` queued (or lease-expired) items to `processing`.
+
+        With `message_id` the newest matching items go first: after a UIDVALIDITY reset
+        that is the current mailbox generation.
+        """
+        now = time.time()
+        conn = self._conn()
+        where = "(status = 'queued' OR (status = 'processing' AND lease_until < ?))"
+        params: List[Any] = [now]
+        if account_id is not None:
+            where += " AND account_id = ?"
+            params.append(account_id)
+        if message_id is not None:
+            where += " AND message_id = ?"
+            params.append(message_id)
+        order = "id DESC" if message_id is not None else "id"
+        with _Transaction(conn):
+            rows = conn.execute(
+                f"SELECT {_COLUMNS} FROM queue_items WHERE {where} ORDER BY {order} LIMIT ?", (*params, limit)
+            ).fetchall()
+            ids = [r["id"] for r in rows]
+            if ids:
+                conn.executemany(
+                    "UPDATE queue_items SET status = 'processing', claimed_by = ?, lease_until = ?,"
+                    " attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    [(worker, now + lease_seconds, now, i) for i in ids],
+                )
+        items = [_row(r) for r in rows]
+        for item in items:
+            item.update(status="processing", claimed_by=worker, lease_until=now + lease_seconds, attempts=item["attempts"] + 1)
+        return items
+
+    def ack(self, item_id: int, status: str = "done", result: Optional[Dict[str, Any]] = None, worker: Optional[str] = None) -> bool:
+        """Finish a claimed item; with `worker`, only if that worker still holds the lease."""
+        sql = "UPDATE queue_items SET status = ?, result = ?, error = NULL, claimed_by = NULL, lease_until = NULL, updated_at = ? WHERE id = ?"
+        params: List[Any] = [status, json.dumps(result, ensure_ascii=False, default=str) if result is not None else None, time.time(), item_id]
+        if worker is not None:
+            sql += " AND claimed_by = ?"
+            params.append(worker)
+        conn = self._conn()
+        with _Transaction(conn):
+            changed = conn.execute(sql, params).rowcount > 0
+        self._after_ack()
+        return changed
+
+    def nack(self, item_id: int, error: str, max_attempts: int = 3, worker: Optional[str] = None) -> bool:
+        """Return a failed item to the queue, or mark it `failed` after `max_attempts`."""
+        sql = (
+            "UPDATE queue_items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+            " error = ?, claimed_by = NULL, lease_until = NULL, updated_at = ? WHERE id = ?"
+        )
+        params: List[Any] = [max_attempts, error[:4000], time.time(), item_id]
+        if worker is not None:
+            sql += " AND claimed_by = ?"
+            params.append(worker)
+        conn = self._conn()
+        with _Transaction(conn):
+            return conn.execute(sql, params).rowcount > 0
+
+    def requeue(self, claimed_by_prefix: str, keep_prefix: Optional[str] = None) -> int:
+        """Return `processing` items of workers whose id starts with `claimed_by_prefix` to the queue.
+
+        For claims left behind by a process that died mid-message; `keep_prefix` spares
+        the workers of the calling process.
+        """
+        sql = "UPDATE queue_items SET status = 'queued', claimed_by = NULL, lease_until = NULL, updated_at = ? WHERE status = 'processing' AND substr(claimed_by, 1, ?) = ?"
+        params: List[Any] = [time.time(), len(claimed_by_prefix), claimed_by_prefix]
+        if keep_prefix:
+            sql += " AND substr(claimed_by, 1, ?) != ?"
+            params += [len(keep_prefix), keep_prefix]
+        conn = self._conn()
+        with _Transaction(conn):
+            return conn.execute(sql, params).rowcount
+
+    def record(
+        self,
+        account_id: str,
+        message_id: str,
+        status: str,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+        mailbox: Optional[str] = None,
+        uidvalidity: Optional[int] = None,
+    ) -> int:
+        """Upsert a processing result without the claim protocol, in one transaction.
+
+        Without `mailbox`/`uidvalidity` the newest item of the message is updated. Safe
+        from any thread (each has its own connection); concurrent records of one message
+        leave the last one written.
+        """
+        conn = self._conn()
+        with _Transaction(conn):
+            row = None
+            if mailbox is None and uidvalidity is None:
+                row = conn.execute(
+                    "SELECT id FROM queue_items WHERE account_id = ? AND message_id = ? ORDER BY id DESC LIMIT 1",
+                    (account_id, message_id),
+                ).fetchone()
+            item_id = int(row["id"]) if row else self._insert(conn, account_id, message_id, mailbox, uidvalidity, None, False)
+            conn.execute(
+                "UPDATE queue_items SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False, default=str) if result is not None else None, error, time.time(), item_id),
+            )
+        self._after_ack()
+        return item_id
+
+    def get(self, item_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(f"SELECT {_COLUMNS} FROM queue_items WHERE id = ?", (item_id,)).fetchone()
+        return _row(row) if row else None
+
+    def find(self, account_id: str, message_id: str, mailbox: Optional[str] = None, uidvalidity: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Newest item for the message, optionally within one mailbox/UIDVALIDITY."""
+        where = "account_id = ? AND message_id = ?"
+        params: List[Any] = [account_id, message_id]
+        if mailbox is not None:
+            where += " AND mailbox = ?"
+            params.append(mailbox)
+        if uidvalidity is not None:
+            where += " AND uidvalidity = ?"
+            params.append(uidvalidity)
+        row = self._conn().execute(f"SELECT {_COLUMNS} FROM queue_items WHERE {where} ORDER BY id DESC LIMIT 1", params).fetchone()
+        return _row(row) if row else None
+
+    def page(
+        self,
+        status: Optional[str] = None,
+        account_id: Optional[str] = None,
+        before_id: Optional[int] = None,
+        limit: int = 50,
+    ) -> Dict[str, Any]:
+        """Newest-first page; pass the returned `next_before_id` to get the following page.
+
+        Keyset pagination keeps every page an index range scan, however deep the history is.
+        """
+        clauses: List[str] = []
+        params: List[Any] = []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if account_id:
+            clauses.append("account_id = ?")
+            params.append(account_id)
+        if before_id is not None:
+            clauses.append("id < ?")
+            params.append(before_id)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        limit = max(1, min(int(limit), 500))
+        rows = self._conn().execute(
+            f"SELECT {_COLUMNS} FROM queue_items{where} ORDER BY id DESC LIMIT ?", (*params, limit + 1)
+        ).fetchall()
+        items = [_row(r) for r in rows[:limit]]
+        return {"items": items, "next_before_id": items[-1]["id"] if len(rows) > limit else None}
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) AS n FROM queue_items GROUP BY status").fetchall()
+        return {r["status"]: int(r["n"]) for r in rows}
+
+    def purge(self, older_than_days: Optional[float] = None, statuses: Iterable[str] = FINISHED_STATUSES) -> int:
+        """Delete finished items last updated more than `older_than_days` ago."""
+        days = self.retention_days if older_than_days is None else older_than_days
+        statuses = list(statuses)
+        if days <= 0 or not statuses:
+            return 0
+        cutoff = time.time() - days * 86400
+        marks = ",".join("?" for _ in statuses)
+        conn = self._conn()
+        with _Transaction(conn):
+            return conn.execute(
+                f"DELETE FROM queue_items WHERE updated_at < ? AND status IN ({marks})", (cutoff, *statuses)
+            ).rowcount
+
+    def compact(self) -> None:
+        """Apply retention, return freed pages to the OS and truncate the WAL."""
+        self.purge()
+        conn = self._conn()
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _after_ack(self) -> None:
+        if self.compact_every <= 0:
+            return
+        with self._acks_lock:
+            self._acks += 1
+            due = self._acks % self.compact_every == 0
+        if due:
+            self.compact()
+
+    def import_json(self, path: str) -> int:
+        """One-off import of a legacy admin_queue.json (list of records or {"items": [...]})."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if isinstance(data, dict):
+            data = data.get("items") or data.get("queue") or []
+        imported = 0
+        conn = self._conn()
+        with _Transaction(conn):
+            for rec in data if isinstance(data, list) else []:
+                if not isinstance(rec, dict):
+                    continue
+                account_id = str(rec.get("account_id") or rec.get("account") or "")
+                message_id = str(rec.get("message_id") or rec.get("uid") or "")
+                if not account_id or not message_id:
+                    continue
+                ts = rec.get("updated_at") or rec.get("timestamp") or rec.get("ts") or rec.get("created_at")
+                try:
+                    ts = float(ts)
+                except (TypeError, ValueError):
+                    ts = time.time()
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO queue_items (account_id, message_id, mailbox, uid, status, created_at, updated_at, result, error)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        account_id,
+                        message_id,
+                        str(rec.get("mailbox") or ""),
+                        _uid_of(message_id) if rec.get("uid") is None else int(rec["uid"]),
+                        str(rec.get("status") or "done"),
+                        ts,
+                        ts,
+                        json.dumps(rec, ensure_ascii=False, default=str),
+                        rec.get("error"),
+                    ),
+                )
+                imported += cur.rowcount
+        return imported
+
+
+_DB: Optional[QueueDB] = None
+_DB_LOCK = threading.Lock()
+
+
+def get_queue_db() -> QueueDB:
+    """Process-wide queue store; imports admin_queue.json the first time the database is created."""
+    global _DB
+    with _DB_LOCK:
+        if _DB is None:
+            data_dir = os.getenv("DATA_DIR") or os.getcwd()
+            path = os.getenv("QUEUE_DB", os.path.join(data_dir, "queue.sqlite3"))
+            fresh = not os.path.exists(path)
+            _DB = QueueDB(path, retention_days=float(os.getenv("QUEUE_RETENTION_DAYS", "30")))
+            if fresh:
+                base = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+                _DB.import_json(os.getenv("ADMIN_QUEUE_PATH", os.path.join(base, "admin_queue.json")))
+        return _DB
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Coroutine, Deque, Dict, List, Optional, Tuple, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `burst`."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take `tokens` now (possibly going into debt) and return how long to wait before using them."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= tokens
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens: float = 1.0) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_LIMITERS: Dict[str, RateLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    """Process-wide limiter for `name` ("llm", "smtp", ...).
+
+    Configured by <NAME>_RATE_PER_MINUTE (0 = unlimited) and <NAME>_BURST.
+    """
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(name)
+        if limiter is None:
+            prefix = name.upper()
+            per_minute = float(os.getenv(f"{prefix}_RATE_PER_MINUTE", "0"))
+            limiter = RateLimiter(per_minute / 60.0, float(os.getenv(f"{prefix}_BURST", "1")))
+            _LIMITERS[name] = limiter
+        return limiter
+
+
+T = TypeVar("T")
+
+
+class LoopThread:
+    """One long-lived asyncio event loop in a daemon thread, fed from any other thread."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> "Future[T]":
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        """Run `coro` on the loop and block the calling thread for its result."""
+        return self.submit(coro).result(timeout)
+
+    def wrap(self, coro: Coroutine[Any, Any, T]) -> Awaitable[T]:
+        """Await `coro` from another event loop while it runs on this one."""
+        return asyncio.wrap_future(self.submit(coro))
+
+
+_MODEL_LOOP = LoopThread("model-loop")
+
+
+def get_model_loop() -> LoopThread:
+    """Loop that every agents SDK call runs on.
+
+    The SDK shares one AsyncOpenAI/httpx client per process and its keep-alive connections
+    belong to the loop that opened them; per-message asyncio.run() loops in worker threads
+    would reuse sockets of loops that are already closed (SDK retries, connection errors).
+    """
+    return _MODEL_LOOP
+
+
+class QueueFull(Exception):
+    pass
+
+
+Job = Tuple[str, Optional[Callable[[Optional[BaseException]], None]]]
+
+
+class MessageScheduler:
+    """Run a handler over (account_id, message_id) jobs with worker threads.
+
+    - Messages of one account start in submission order; with the default
+      `per_account` of 1 they also finish in order.
+    - Accounts are served round-robin, so a slow or failing mailbox only ever holds
+      its own `per_account` workers.
+    - `submit` blocks (or raises QueueFull) once `max_queue` jobs are waiting overall or
+      `max_queue_per_account` for one account.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, str], Any],
+        workers: int = 4,
+        per_account: int = 1,
+        max_queue: int = 1000,
+        max_queue_per_account: int = 200,
+    ):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.per_account = max(1, per_account)
+        self.max_queue = max(1, max_queue)
+        self.max_queue_per_account = max(1, max_queue_per_account)
+        self.processed = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        # account -> pending jobs; order of keys is the round-robin order
+        self._pending: "OrderedDict[str, Deque[Job]]" = OrderedDict()
+        self._running: Dict[str, int] = {}
+        self._queued = 0
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> "MessageScheduler":
+        with self._cond:
+            if self._threads:
+                return self
+            self._stopping = False
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"mail-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        return self
+
+    def submit(
+        self,
+        account_id: str,
+        message_id: str,
+        on_done: Optional[Callable[[Optional[BaseException]], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """Queue a message; blocks while the queue is full (QueueFull after `timeout`)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queued >= self.max_queue or len(self._pending.get(account_id) or ()) >= self.max_queue_per_account:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise QueueFull(f"queue full for {account_id}")
+                self._cond.wait(remaining)
+            self._pending.setdefault(account_id, deque()).append((message_id, on_done))
+            self._queued += 1
+            self._cond.notify_all()
+
+    def _next_job(self) -> Optional[Tuple[str, Job]]:
+        for account_id, jobs in self._pending.items():
+            if jobs and self._running.get(account_id, 0) < self.per_account:
+                job = jobs.popleft()
+                # Served accounts go to the back of the line
+                self._pending.move_to_end(account_id)
+                if not jobs:
+                    del self._pending[account_id]
+                return account_id, job
+        return None
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    picked = self._next_job()
+                    if picked is not None:
+                        break
+                    self._cond.wait()
+                account_id, (message_id, on_done) = picked
+                self._queued -= 1
+                self._running[account_id] = self._running.get(account_id, 0) + 1
+                self._cond.notify_all()
+            error: Optional[BaseException] = None
+            try:
+                self.handler(account_id, message_id)
+            except Exception as e:
+                error = e
+                logger.exception("processing %s %s failed", account_id, message_id)
+            with self._cond:
+                self._running[account_id] -= 1
+                if not self._running[account_id]:
+                    del self._running[account_id]
+                if error is None:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
+            if on_done is not None:
+                try:
+                    on_done(error)
+                except Exception:
+                    logger.exception("on_done callback failed")
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until nothing is queued or running; False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queued or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, wait: bool = True) -> None:
+        """Stop workers after their current job; queued jobs are dropped."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        if wait:
+            for t in threads:
+                t.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "queued": self._queued,
+                "running": sum(self._running.values()),
+                "accounts_waiting": len(self._pending),
+                "processed": self.processed,
+                "failed": self.failed,
+            }
+
+
+def scheduler_from_env(handler: Callable[[str, str], Any]) -> MessageScheduler:
+    return MessageScheduler(
+        handler,
+        workers=int(os.getenv("SCHEDULER_WORKERS", "4")),
+        per_account=int(os.getenv("SCHEDULER_PER_ACCOUNT", "1")),
+        max_queue=int(os.getenv("SCHEDULER_MAX_QUEUE", "1000")),
+        max_queue_per_account=int(os.getenv("SCHEDULER_MAX_QUEUE_PER_ACCOUNT", "200")),
+    )
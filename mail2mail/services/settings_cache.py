@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+import yaml
+from pydantic import BaseModel, ConfigDict
+
+
+logger = logging.getLogger(__name__)
+
+Stamps = Tuple[Tuple[str, Optional[int], Optional[int]], ...]
+
+
+def _settings_module() -> Any:
+    # Imported on first use, so services that only read snapshots stay cheap to import
+    from mail2mail import settings
+
+    return settings
+
+
+def category_key(name: Any) -> str:
+    """Lookup form of a category or alias: trimmed, inner whitespace collapsed, case-folded."""
+    return " ".join(str(name or "").split()).casefold()
+
+
+class Route(BaseModel):
+    """One `routing_rules` entry, normalized and immutable."""
+
+    model_config = ConfigDict(frozen=True)
+
+    category: str
+    to: Tuple[str, ...] = ()
+    subject_prefix: Optional[str] = None
+    aliases: Tuple[str, ...] = ()
+    senders: Tuple[str, ...] = ()
+    keywords: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_rule(cls, rule: Mapping[str, Any]) -> "Route":
+        def strings(value: Any) -> Tuple[str, ...]:
+            if isinstance(value, str):
+                value = [value]
+            return tuple(s for s in (str(x).strip() for x in value or []) if s)
+
+        prefix = rule.get("subject_prefix")
+        return cls(
+            category=str(rule.get("category", "")).strip(),
+            to=strings(rule.get("to")),
+            subject_prefix=str(prefix) if prefix is not None else None,
+            aliases=strings(rule.get("aliases")),
+            senders=strings(rule.get("senders")),
+            keywords=strings(rule.get("keywords")),
+        )
+
+    def table_entry(self) -> Dict[str, Any]:
+        """The {category, to, subject_prefix} shape shown to the model and hashed into cache versions."""
+        return {"category": self.category, "to": list(self.to), "subject_prefix": self.subject_prefix}
+
+
+class SettingsSnapshot:
+    """Immutable view of settings.yaml (plus admin_*.json stamps) taken at one point in time.
+
+    Never mutated after construction; a changed file produces a new snapshot that
+    replaces the old one in a single assignment, so readers need no lock.
+    """
+
+    def __init__(self, data: Dict[str, Any], rules: List[Mapping[str, Any]], stamps: Stamps):
+        self.data: Mapping[str, Any] = MappingProxyType(data)
+        self.stamps = stamps
+        self.rules: Tuple[Mapping[str, Any], ...] = tuple(rules)
+        self.loaded_at = time.time()
+        routes: List[Route] = []
+        index: Dict[str, Route] = {}
+        for rule in rules:
+            if not isinstance(rule, Mapping):
+                continue
+            route = Route.from_rule(rule)
+            key = category_key(route.category)
+            if not key:
+                continue
+            if key in index:
+                # First rule wins, as with a linear scan
+                logger.warning("duplicate routing category %r ignored", route.category)
+                continue
+            index[key] = route
+            routes.append(route)
+        for route in routes:
+            for alias in route.aliases:
+                key = category_key(alias)
+                if key in index and index[key] is not route:
+                    logger.warning("routing alias %r of %r ignored: already used by %r", alias, route.category, index[key].category)
+                    continue
+                index[key] = route
+        self.routes: Tuple[Route, ...] = tuple(routes)
+        self.index: Mapping[str, Route] = MappingProxyType(index)
+        self.version = hashlib.sha256(
+            json.dumps([r.table_entry() for r in routes], sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:16]
+        self._memo: Dict[Any, Any] = {}
+        # Re-entrant: a factory may itself read other memoized values
+        self._memo_lock = threading.RLock()
+
+    def route(self, category: Optional[str]) -> Optional[Route]:
+        return self.index.get(category_key(category)) if category else None
+
+    def section(self, name: str) -> Dict[str, Any]:
+        value = self.data.get(name)
+        return dict(value) if isinstance(value, Mapping) else {}
+
+    def memo(self, key: Any, factory: Callable[[], Any]) -> Any:
+        """Value computed once per snapshot; dropped automatically when the snapshot is replaced."""
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        with self._memo_lock:
+            if key not in self._memo:
+                self._memo[key] = factory()
+            return self._memo[key]
+
+    @property
+    def settings(self) -> Any:
+        return self.memo("settings", _settings_module().get_settings)
+
+
+def _base_dir() -> str:
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def settings_yaml_path() -> str:
+    return os.getenv("SETTINGS_YAML", os.path.join(_base_dir(), "settings.yaml"))
+
+
+def _watched_paths() -> List[str]:
+    base = _base_dir()
+    return [
+        settings_yaml_path(),
+        os.getenv("ADMIN_MAILBOXES_PATH", os.path.join(base, "admin_mailboxes.json")),
+        os.getenv("ADMIN_SMTP_PATH", os.path.join(base, "admin_smtp.json")),
+    ]
+
+
+def _stamps(paths: List[str]) -> Stamps:
+    out = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            out.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append((path, None, None))
+    return tuple(out)
+
+
+def _settings_rules() -> List[Mapping[str, Any]]:
+    try:
+        return list(_settings_module().get_settings().routing_rules or [])
+    except Exception:
+        return []
+
+
+def load_snapshot(stamps: Optional[Stamps] = None) -> SettingsSnapshot:
+    """Read settings.yaml and build a snapshot; raises if the file exists but cannot be parsed."""
+    stamps = stamps if stamps is not None else _stamps(_watched_paths())
+    path = settings_yaml_path()
+    data: Dict[str, Any] = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            loaded = yaml.safe_load(f) or {}
+        if not isinstance(loaded, dict):
+            raise ValueError(f"{path}: expected a mapping at top level")
+        data = loaded
+    # No YAML rules: fall back to whatever the settings loader provides
+    rules = (data.get("routing_rules") or []) if "routing_rules" in data else _settings_rules()
+    return SettingsSnapshot(data, list(rules), stamps)
+
+
+_SNAPSHOT: Optional[SettingsSnapshot] = None
+_SNAPSHOT_LOCK = threading.Lock()
+_checked_at = 0.0
+
+
+def _reload_interval() -> float:
+    return float(os.getenv("SETTINGS_RELOAD_SECONDS", "2"))
+
+
+def get_snapshot() -> SettingsSnapshot:
+    """Current settings snapshot.
+
+    Files are stat()ed at most once per SETTINGS_RELOAD_SECONDS; when one changed, a
+    new snapshot is built and swapped in. A broken edit keeps the previous snapshot.
+    """
+    global _SNAPSHOT, _checked_at
+    snapshot = _SNAPSHOT
+    if snapshot is not None and time.monotonic() - _checked_at < _reload_interval():
+        return snapshot
+    with _SNAPSHOT_LOCK:
+        snapshot = _SNAPSHOT
+        if snapshot is not None and time.monotonic() - _checked_at < _reload_interval():
+            return snapshot
+        stamps = _stamps(_watched_paths())
+        if snapshot is None or stamps != snapshot.stamps:
+            try:
+                snapshot = load_snapshot(stamps)
+            except Exception:
+                logger.exception("failed to load %s; keeping previous settings", settings_yaml_path())
+                # Same content under the new stamps: not retried until a file changes again,
+                # while memoized values (admin_*.json derived) are still refreshed
+                if snapshot is None:
+                    snapshot = SettingsSnapshot({}, _settings_rules(), stamps)
+                else:
+                    snapshot = SettingsSnapshot(dict(snapshot.data), list(snapshot.rules), stamps)
+            _SNAPSHOT = snapshot
+        _checked_at = time.monotonic()
+        return snapshot
+
+
+def reload_settings() -> SettingsSnapshot:
+    """Re-read now instead of at the next check (e.g. right after the admin UI saved a file)."""
+    global _SNAPSHOT, _checked_at
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT = load_snapshot()
+        _checked_at = time.monotonic()
+        return _SNAPSHOT
+
+
+def imap_config(account_id: str) -> Any:
+    """get_imap_config, cached until the settings files change."""
+    return get_snapshot().memo(("imap", account_id), lambda: _settings_module().get_imap_config(account_id))
+
+
+def smtp_config(account_id: str) -> Any:
+    """get_smtp_config, cached until the settings files change."""
+    return get_snapshot().memo(("smtp", account_id), lambda: _settings_module().get_smtp_config(account_id))
@@ -0,0 +1,593 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import re
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from email.utils import getaddresses
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from mail2mail.services.metrics import count_bytes, stage
+from mail2mail.services.mime_forward import ForwardMessage, iter_span
+from mail2mail.services.scheduler import get_rate_limiter
+from mail2mail.services.settings_cache import get_snapshot, smtp_config
+
+
+logger = logging.getLogger(__name__)
+
+SmtpKey = Tuple[str, int, bool, str]
+
+_EOL_RE = re.compile(rb"\r\n|\n|\r(?!\n)")
+_DOT_RE = re.compile(rb"(?m)^\.")
+
+
+class SmtpConfig:
+    def __init__(self, host: str, port: int, starttls: bool, username: Optional[str], password: Optional[str], from_addr: Optional[str]):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.from_addr = from_addr
+
+
+def _smtp_store_path() -> str:
+    base = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    return os.getenv("ADMIN_SMTP_PATH", os.path.join(base, "admin_smtp.json"))
+
+
+def _read_default_smtp_config() -> Optional[SmtpConfig]:
+    data: Dict[str, Any] = {}
+    try:
+        with open(_smtp_store_path(), "r", encoding="utf-8") as f:
+            data = json.loads(f.read() or "{}")
+    except Exception:
+        data = {}
+    if not data:
+        return None
+    username = data.get("username")
+    from_addr = data.get("from") or username
+    # password from .env via smtp_config using username/from as account_id
+    env_cfg = smtp_config(username or from_addr or "")
+    return SmtpConfig(
+        host=data.get("host"),
+        port=int(data.get("port") or 587),
+        starttls=bool(data.get("starttls", True)),
+        username=username,
+        password=env_cfg.password if env_cfg else None,
+        from_addr=from_addr,
+    )
+
+
+def load_default_smtp_config() -> Optional[SmtpConfig]:
+    """The global sender from admin_smtp.json, re-read only when the file changes (see settings_cache)."""
+    return get_snapshot().memo("default_smtp", _read_default_smtp_config)
+
+
+def resolve_smtp_config(from_account_id: str) -> Optional[Any]:
+    # Single global sender: "__default__" uses admin_smtp.json
+    if from_account_id == "__default__":
+        return load_default_smtp_config()
+    return smtp_config(from_account_id)
+
+
+def is_transient(exc: BaseException) -> bool:
+    """True for failures worth retrying later (4xx replies, dropped or refused connections)."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    # Plain socket errors; other SMTPException subclasses (also OSError) are permanent
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+class _Connection:
+    def __init__(self, key: SmtpKey, smtp: smtplib.SMTP):
+        self.key = key
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+Refused = Dict[str, Tuple[int, bytes]]
+
+
+def _stream_data(smtp: smtplib.SMTP, mail_from: str, recipients: List[str], chunks: Iterable[bytes], eight_bit: bool) -> Refused:
+    """MAIL/RCPT/DATA with the body written to the socket as it is produced.
+
+    Chunks must start on line boundaries so dot-stuffing can be applied per chunk.
+    Returns the recipients the server refused while accepting others, as smtplib.sendmail does.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    options = ["BODY=8BITMIME"] if eight_bit and smtp.has_extn("8bitmime") else []
+    code, resp = smtp.mail(mail_from, options)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, mail_from)
+    refused: Refused = {}
+    for rcpt in recipients:
+        code, resp = smtp.rcpt(rcpt)
+        if code not in (250, 251):
+            refused[rcpt] = (code, resp)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, resp = smtp.docmd("DATA")
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    tail = b"\r\n"
+    sent = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = _DOT_RE.sub(b"..", _EOL_RE.sub(b"\r\n", chunk))
+        smtp.send(chunk)
+        sent += len(chunk)
+        tail = chunk[-2:]
+    smtp.send(b".\r\n" if tail == b"\r\n" else b"\r\n.\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    count_bytes("sent", sent)
+    return refused
+
+
+def describe_refused(refused: Refused) -> Dict[str, str]:
+    """Refused recipients as {address: "code reply"}."""
+    return {rcpt: f"{code} {resp.decode('utf-8', 'replace')}" for rcpt, (code, resp) in refused.items()}
+
+
+class SmtpPool:
+    """Logged-in SMTP sessions reused across messages.
+
+    A reused session gets RSET first (which doubles as a liveness probe); sessions are
+    retired after `max_messages` sends or `max_idle` seconds unused.
+    """
+
+    def __init__(self, max_sessions: int = 2, max_messages: int = 100, max_idle: float = 240.0, timeout: float = 30.0):
+        self.max_sessions = max(1, max_sessions)
+        self.max_messages = max(1, max_messages)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle: Dict[SmtpKey, List[_Connection]] = {}
+        self._slots: Dict[SmtpKey, threading.BoundedSemaphore] = {}
+
+    @staticmethod
+    def _key_for(cfg: Any) -> SmtpKey:
+        return (str(cfg.host), int(cfg.port), bool(getattr(cfg, "starttls", True)), str(cfg.username or ""))
+
+    def _slot(self, key: SmtpKey) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._slots.get(key)
+            if sem is None:
+                sem = self._slots[key] = threading.BoundedSemaphore(self.max_sessions)
+            return sem
+
+    def _connect(self, key: SmtpKey, cfg: Any) -> _Connection:
+        smtp = smtplib.SMTP(cfg.host, cfg.port, timeout=self.timeout)
+        try:
+            if getattr(cfg, "starttls", True):
+                smtp.starttls()
+            if cfg.username:
+                smtp.login(cfg.username, cfg.password)
+        except Exception:
+            smtp.close()
+            raise
+        return _Connection(key, smtp)
+
+    def _checkout(self, key: SmtpKey, cfg: Any) -> Tuple[_Connection, bool]:
+        while True:
+            with self._lock:
+                bucket = self._idle.get(key) or []
+                conn = bucket.pop() if bucket else None
+            if conn is None:
+                return self._connect(key, cfg), False
+            if time.monotonic() - conn.last_used > self.max_idle:
+                conn.close()
+                continue
+            try:
+                code, _ = conn.smtp.rset()
+            except (smtplib.SMTPException, OSError):
+                conn.close()
+                continue
+            if code != 250:
+                conn.close()
+                continue
+            return conn, True
+
+    def _checkin(self, conn: _Connection) -> None:
+        if conn.sent >= self.max_messages:
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(conn.key, []).append(conn)
+
+    def _run(self, cfg: Any, transmit: Callable[[smtplib.SMTP], Refused]) -> Refused:
+        get_rate_limiter("smtp").acquire()
+        key = self._key_for(cfg)
+        slot = self._slot(key)
+        slot.acquire()
+        try:
+            while True:
+                conn, reused = self._checkout(key, cfg)
+                try:
+                    with stage("smtp"):
+                        refused = transmit(conn.smtp)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    conn.close()
+                    if reused:
+                        # The server dropped an idle session between RSET and DATA; use a fresh one
+                        continue
+                    raise
+                except (smtplib.SMTPException, OSError) as e:
+                    if isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                        self._checkin(conn)
+                    else:
+                        conn.close()
+                    raise
+                except BaseException:
+                    # Failed mid-transaction (e.g. an attachment became unreadable): the session state is unknown
+                    conn.close()
+                    raise
+                conn.sent += 1
+                self._checkin(conn)
+                return refused
+        finally:
+            slot.release()
+
+    def send(self, cfg: Any, msg: EmailMessage) -> Refused:
+        return self._run(cfg, lambda smtp: smtp.send_message(msg))
+
+    def send_stream(
+        self,
+        cfg: Any,
+        mail_from: str,
+        recipients: List[str],
+        chunks: Callable[[], Iterable[bytes]],
+        eight_bit: bool = False,
+    ) -> Refused:
+        """Send a message produced chunk by chunk; `chunks` is called again if a stale session is retried.
+
+        Returns the refused recipients when the server accepted only some of them.
+        """
+        return self._run(cfg, lambda smtp: _stream_data(smtp, mail_from, recipients, chunks(), eight_bit))
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns = [c for bucket in self._idle.values() for c in bucket]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+def _owner_alive(owner: str, me: str) -> bool:
+    """Whether the process that claimed an outbox row (owner "host:pid:run") may still be sending it."""
+    host, _, rest = owner.partition(":")
+    pid, _, _ = rest.partition(":")
+    if owner == me or host != socket.gethostname():
+        # Another host's process cannot be checked; its claim expires with the lease
+        return True
+    try:
+        pid_num = int(pid)
+    except ValueError:
+        return False
+    if pid_num == os.getpid():
+        # Same pid, different run: an earlier process of this container
+        return False
+    try:
+        os.kill(pid_num, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class SmtpSpool:
+    """Persistent outbox: MIME files on disk, delivery state in SQLite.
+
+    Claimed rows carry their owner process and claim time. A row left 'sending' goes back
+    to the queue once its owner is gone or the claim is older than `lease` seconds, so
+    processes sharing the outbox never resend each other's mail in flight.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_attempts: int = 10,
+        base_delay: float = 60.0,
+        max_delay: float = 6 * 3600.0,
+        lease: float = 3600.0,
+    ):
+        self.root = root
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, from_account_id TEXT NOT NULL, status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, created_at REAL NOT NULL,"
+                " last_error TEXT, sent_id TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+            # Envelope of streamed messages; rows without one hold a parsed EmailMessage
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            for column, decl in (
+                ("mail_from", "TEXT"),
+                ("rcpt_to", "TEXT"),
+                ("eight_bit", "INTEGER NOT NULL DEFAULT 0"),
+                ("owner", "TEXT"),
+                ("claimed_at", "REAL"),
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {decl}")
+            self._release_abandoned(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, reused; `with conn` only commits or rolls back
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "outbox.sqlite3"), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _release_abandoned(self, conn: sqlite3.Connection) -> None:
+        # Rows left 'sending' by a crashed process, or claimed too long ago, go back to the queue
+        expired = time.time() - self.lease
+        rows = conn.execute("SELECT id, owner, claimed_at FROM outbox WHERE status = 'sending'").fetchall()
+        abandoned = [
+            (item_id,)
+            for item_id, owner, claimed_at in rows
+            if not owner or claimed_at is None or claimed_at < expired or not _owner_alive(owner, self.owner)
+        ]
+        if abandoned:
+            conn.executemany("UPDATE outbox SET status = 'queued', owner = NULL WHERE id = ? AND status = 'sending'", abandoned)
+            logger.warning("outbox: %d abandoned sends returned to the queue", len(abandoned))
+
+    def path_for(self, item_id: int) -> str:
+        return os.path.join(self.root, f"{item_id}.eml")
+
+    def put(self, from_account_id: str, msg: ForwardMessage, error: Optional[str] = None, attempts: int = 0) -> int:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            # Not due until the file is in place
+            cur = conn.execute(
+                "INSERT INTO outbox (from_account_id, status, attempts, next_attempt_at, created_at, last_error,"
+                " mail_from, rcpt_to, eight_bit) VALUES (?, 'writing', ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    from_account_id,
+                    attempts,
+                    now + (self._delay(attempts) if attempts else 0.0),
+                    now,
+                    error,
+                    msg.mail_from,
+                    json.dumps(msg.recipients),
+                    int(msg.eight_bit),
+                ),
+            )
+            item_id = int(cur.lastrowid)
+        path = self.path_for(item_id)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                for chunk in msg.chunks():
+                    f.write(chunk)
+            os.replace(path + ".tmp", path)
+        except BaseException:
+            # e.g. an attachment became unreadable: drop the half-written entry
+            with self._lock, self._connect() as conn:
+                conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+            try:
+                os.remove(path + ".tmp")
+            except OSError:
+                pass
+            raise
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE outbox SET status = 'queued' WHERE id = ?", (item_id,))
+        return item_id
+
+    def _delay(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** max(0, attempts - 1)) * random.uniform(0.8, 1.2)
+
+    def claim_due(self, limit: int = 20) -> List[Dict[str, Any]]:
+        with self._lock, self._connect() as conn:
+            self._release_abandoned(conn)
+            now = time.time()
+            rows = conn.execute(
+                "SELECT id, from_account_id, mail_from, rcpt_to, eight_bit FROM outbox"
+                " WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', owner = ?, claimed_at = ? WHERE id = ?", [(self.owner, now, r[0]) for r in rows]
+            )
+        return [
+            {
+                "id": int(r[0]),
+                "from_account_id": str(r[1]),
+                "mail_from": r[2],
+                "recipients": json.loads(r[3]) if r[3] else None,
+                "eight_bit": bool(r[4]),
+            }
+            for r in rows
+        ]
+
+    def load(self, item_id: int) -> EmailMessage:
+        with open(self.path_for(item_id), "rb") as f:
+            return BytesParser(policy=policy.default).parse(f)
+
+    def stream(self, item_id: int) -> Iterator[bytes]:
+        return iter_span(self.path_for(item_id))
+
+    def mark_sent(self, item_id: int, sent_id: str, note: Optional[str] = None) -> None:
+        """`note` (e.g. recipients the server refused) is kept in last_error."""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = 'sent', sent_id = ?, last_error = COALESCE(?, last_error) WHERE id = ?",
+                (sent_id, note, item_id),
+            )
+        try:
+            os.remove(self.path_for(item_id))
+        except OSError:
+            pass
+
+    def mark_failed(self, item_id: int, error: str, permanent: bool = False) -> str:
+        """Schedule a retry with exponential backoff, or give up ('dead', file kept for inspection)."""
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT attempts FROM outbox WHERE id = ?", (item_id,)).fetchone()
+            attempts = (int(row[0]) if row else 0) + 1
+            status = "dead" if permanent or attempts >= self.max_attempts else "queued"
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, time.time() + self._delay(attempts), error[:2000], item_id),
+            )
+        return status
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {str(s): int(n) for s, n in rows}
+
+
+def sent_id_for(cfg: Any, recipients: int) -> str:
+    return f"smtp://{cfg.host}:{cfg.port}/{recipients}"
+
+
+class SmtpSender:
+    """Pool + spool: send now when possible, park transient failures for background retry."""
+
+    def __init__(self, pool: SmtpPool, spool: SmtpSpool, poll_interval: float = 15.0):
+        self.pool = pool
+        self.spool = spool
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+    def send(self, from_account_id: str, cfg: Any, msg: ForwardMessage) -> Dict[str, Any]:
+        try:
+            refused = self.pool.send_stream(cfg, msg.mail_from, msg.recipients, msg.chunks, msg.eight_bit)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            item_id = self.spool.put(from_account_id, msg, error=f"{type(e).__name__}: {e}", attempts=1)
+            self.start()
+            logger.warning("SMTP send failed (%s); queued as outbox #%d", e, item_id)
+            return {"sent_message_id": f"queued://{item_id}", "queued": True}
+        result: Dict[str, Any] = {"sent_message_id": sent_id_for(cfg, len(msg.recipients) - len(refused))}
+        if refused:
+            result["refused"] = describe_refused(refused)
+            logger.warning("SMTP server refused some recipients: %s", result["refused"])
+        return result
+
+    def enqueue(self, from_account_id: str, msg: ForwardMessage) -> Dict[str, Any]:
+        """Hand the message to the background sender and return immediately."""
+        item_id = self.spool.put(from_account_id, msg)
+        self.start()
+        self._wake.set()
+        return {"sent_message_id": f"queued://{item_id}", "queued": True}
+
+    def drain_once(self) -> int:
+        sent = 0
+        for item in self.spool.claim_due():
+            item_id = item["id"]
+            cfg = resolve_smtp_config(item["from_account_id"])
+            if not cfg:
+                self.spool.mark_failed(item_id, "SMTP config not found", permanent=True)
+                continue
+            try:
+                if item["recipients"] is not None:
+                    recipients = item["recipients"]
+                    refused = self.pool.send_stream(
+                        cfg, item["mail_from"], recipients, lambda i=item_id: self.spool.stream(i), item["eight_bit"]
+                    )
+                else:
+                    # Written before envelopes were recorded
+                    msg = self.spool.load(item_id)
+                    recipients = [a for _, a in getaddresses(msg.get_all("To", []))]
+                    refused = self.pool.send(cfg, msg)
+            except Exception as e:
+                status = self.spool.mark_failed(item_id, f"{type(e).__name__}: {e}", permanent=not is_transient(e))
+                logger.warning("outbox #%d failed (%s): %s", item_id, status, e)
+                continue
+            note = None
+            if refused:
+                note = f"refused recipients: {json.dumps(describe_refused(refused), ensure_ascii=False)}"
+                logger.warning("outbox #%d: %s", item_id, note)
+            self.spool.mark_sent(item_id, sent_id_for(cfg, len(recipients) - len(refused)), note)
+            sent += 1
+        return sent
+
+    def start(self) -> None:
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+
+            def _loop() -> None:
+                while True:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+                    try:
+                        while self.drain_once():
+                            pass
+                    except Exception:
+                        logger.exception("outbox drain failed")
+
+            self._thread = threading.Thread(target=_loop, name="smtp-outbox", daemon=True)
+            self._thread.start()
+
+
+_SENDER: Optional[SmtpSender] = None
+_SENDER_LOCK = threading.Lock()
+
+
+def get_smtp_sender() -> SmtpSender:
+    global _SENDER
+    with _SENDER_LOCK:
+        if _SENDER is None:
+            data_dir = os.getenv("DATA_DIR") or os.getcwd()
+            pool = SmtpPool(
+                max_sessions=int(os.getenv("SMTP_POOL_MAX_SESSIONS", "2")),
+                max_messages=int(os.getenv("SMTP_POOL_MAX_MESSAGES", "100")),
+                max_idle=float(os.getenv("SMTP_POOL_MAX_IDLE_SECONDS", "240")),
+            )
+            spool = SmtpSpool(
+                os.getenv("SMTP_OUTBOX_DIR", os.path.join(data_dir, "outbox")),
+                max_attempts=int(os.getenv("SMTP_RETRY_MAX_ATTEMPTS", "10")),
+                base_delay=float(os.getenv("SMTP_RETRY_BASE_SECONDS", "60")),
+                lease=float(os.getenv("SMTP_OUTBOX_LEASE_SECONDS", "3600")),
+            )
+            _SENDER = SmtpSender(pool, spool, poll_interval=float(os.getenv("SMTP_OUTBOX_POLL_SECONDS", "15")))
+            # Deliver whatever an earlier run left behind
+            _SENDER.start()
+        return _SENDER
@@ -0,0 +1,457 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from pydantic import ValidationError
+
+from mail2mail.agents.triage_compose import ComposeDecision, ComposeDecisionBatch, build_triage_compose_batch_agent
+from mail2mail.services.context_budget import estimate_tokens
+from mail2mail.services.metrics import REGISTRY, count_tokens, metrics_enabled, record_usage, stage
+from mail2mail.services.scheduler import get_model_loop, get_rate_limiter
+from mail2mail.services.settings_cache import get_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = REGISTRY.histogram(
+    "mail2mail_triage_batch_size", "Messages answered per batched triage request.", ("path",), buckets=(1, 2, 4, 8, 16, 32, 64, 256, 1024)
+)
+
+# (instructions, model, routing table JSON): only requests sharing all three can be combined
+BatchKey = Tuple[str, str, str]
+
+
+def batchable(message: Dict[str, Any], text: str, max_tokens: int) -> bool:
+    """Small mail without attachments; everything else keeps its own triage call."""
+    return not message.get("attachments_meta") and estimate_tokens(text) <= max_tokens
+
+
+def batch_input(routing: str, texts: Sequence[str]) -> str:
+    lines = ["[ROUTING]", routing]
+    for index, text in enumerate(texts):
+        lines += ["", f"=== MESSAGE {index} ===", text]
+    return "\n".join(lines)
+
+
+def split_decisions(batch: ComposeDecisionBatch, count: int) -> List[Optional[ComposeDecision]]:
+    """Demultiplex by index; missing, repeated or out-of-range answers come back as None."""
+    out: List[Optional[ComposeDecision]] = [None] * count
+    seen: Set[int] = set()
+    for item in batch.decisions:
+        if not 0 <= item.index < count:
+            continue
+        # Two answers for one message: trust neither
+        out[item.index] = None if item.index in seen else item.decision
+        seen.add(item.index)
+    return out
+
+
+async def run_batch(instructions: str, model: str, routing: str, texts: Sequence[str]) -> List[Optional[ComposeDecision]]:
+    """One Triage & Composer request over `texts` (analysis texts without their routing table)."""
+    from agents import Runner
+
+    agent = build_triage_compose_batch_agent(instructions, model)
+    await get_rate_limiter("llm").acquire_async()
+    with stage("llm", agent=agent.name):
+        result = await Runner.run(agent, batch_input(routing, texts))
+    record_usage(agent.name, result)
+    if metrics_enabled():
+        BATCH_SIZE.observe(len(texts), "online")
+    return split_decisions(result.final_output, len(texts))
+
+
+class TriageBatcher:
+    """Collects concurrent triage requests and answers up to `max_items` of them with one call.
+
+    A group is sent once it is full (`max_items` or `max_tokens` of analysis text) or its
+    oldest request has waited `max_wait` seconds. Callers get a Future per message that
+    resolves to its ComposeDecision, or None when the message must be triaged on its own
+    (lone request, failed call, unusable answer).
+    """
+
+    def __init__(self, max_items: int = 8, max_tokens: int = 12000, max_wait: float = 0.5, concurrency: int = 2):
+        self.max_items = max(1, max_items)
+        self.max_tokens = max(1, max_tokens)
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._groups: Dict[BatchKey, List[Tuple[str, int, Future]]] = {}
+        self._since: Dict[BatchKey, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="triage-batch")
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, instructions: str, model: str, routing: str, text: str) -> Future:
+        future: Future = Future()
+        key = (instructions, model, routing)
+        with self._cond:
+            group = self._groups.setdefault(key, [])
+            if not group:
+                self._since[key] = time.monotonic()
+            group.append((text, estimate_tokens(text), future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="triage-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _take_ready(self, now: float) -> List[Tuple[BatchKey, List[Tuple[str, int, Future]]]]:
+        ready: List[Tuple[BatchKey, List[Tuple[str, int, Future]]]] = []
+        for key, group in list(self._groups.items()):
+            while group:
+                count, tokens = 0, 0
+                for _, item_tokens, _ in group:
+                    if count and (count >= self.max_items or tokens + item_tokens > self.max_tokens):
+                        break
+                    count += 1
+                    tokens += item_tokens
+                full = count < len(group) or count >= self.max_items or tokens >= self.max_tokens
+                if not full and now - self._since[key] < self.max_wait:
+                    break
+                ready.append((key, group[:count]))
+                del group[:count]
+                self._since[key] = now
+            if not group:
+                del self._groups[key]
+                del self._since[key]
+        return ready
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = self._take_ready(now)
+                    if ready:
+                        break
+                    deadlines = [since + self.max_wait - now for since in self._since.values()]
+                    self._cond.wait(max(0.0, min(deadlines)) if deadlines else None)
+            for key, items in ready:
+                self._executor.submit(self._answer, key, items)
+
+    def _answer(self, key: BatchKey, items: List[Tuple[str, int, Future]]) -> None:
+        decisions: List[Optional[ComposeDecision]] = [None] * len(items)
+        if len(items) > 1:
+            try:
+                # On the shared model loop, like every other agent call (see get_model_loop)
+                decisions = get_model_loop().run(run_batch(*key, [text for text, _, _ in items]))
+            except Exception:
+                logger.exception("batched triage of %d messages failed; falling back to single calls", len(items))
+        for (_, _, future), decision in zip(items, decisions):
+            future.set_result(decision)
+
+
+_BATCHER: Optional[TriageBatcher] = None
+_BATCHER_LOCK = threading.Lock()
+
+
+def get_triage_batcher() -> Optional[TriageBatcher]:
+    """Process-wide batcher, or None unless TRIAGE_BATCH_ENABLED is set."""
+    global _BATCHER
+    if os.getenv("TRIAGE_BATCH_ENABLED", "false").strip().lower() not in ("1", "true", "yes", "on"):
+        return None
+    with _BATCHER_LOCK:
+        if _BATCHER is None:
+            _BATCHER = TriageBatcher(
+                max_items=int(os.getenv("TRIAGE_BATCH_MAX_MESSAGES", "8")),
+                max_tokens=int(os.getenv("TRIAGE_BATCH_MAX_TOKENS", "12000")),
+                max_wait=float(os.getenv("TRIAGE_BATCH_WAIT_MS", "500")) / 1000.0,
+                concurrency=int(os.getenv("TRIAGE_BATCH_CONCURRENCY", "2")),
+            )
+        return _BATCHER
+
+
+def batch_item_max_tokens() -> int:
+    return int(os.getenv("TRIAGE_BATCH_ITEM_MAX_TOKENS", "1500"))
+
+
+def offline_triage_accounts() -> Set[str]:
+    """Mailboxes whose triage may wait for the Batch API (TRIAGE_OFFLINE_ACCOUNTS, comma-separated)."""
+    return {a.strip() for a in os.getenv("TRIAGE_OFFLINE_ACCOUNTS", "").split(",") if a.strip()}
+
+
+def _openai_client() -> Any:
+    from openai import OpenAI
+
+    return OpenAI(api_key=get_snapshot().settings.openai_api_key or None)
+
+
+def _response_format() -> Dict[str, Any]:
+    from agents import AgentOutputSchema
+
+    schema = AgentOutputSchema(ComposeDecision)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "ComposeDecision", "schema": schema.json_schema(), "strict": schema.is_strict_json_schema()},
+    }
+
+
+OfflineHandler = Callable[[Dict[str, Any], Optional[ComposeDecision]], None]
+
+
+class OfflineTriage:
+    """Deferred triage through the OpenAI Batch API, for mailboxes that can wait.
+
+    Requests wait in SQLite until `min_items` are queued or the oldest is `max_age`
+    seconds old, then go out as one batch job (one model per job). When the job ends
+    each item is handed to the `on_result` passed to `start`, with None where the job
+    failed, expired or gave no valid ComposeDecision for it. Answers are stored before
+    they are handed over: an item whose handler fails is retried on later polls with
+    exponential backoff and given up (status 'failed') after `max_attempts`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        min_items: int = 50,
+        max_age: float = 600.0,
+        poll_interval: float = 60.0,
+        completion_window: str = "24h",
+        client_factory: Optional[Callable[[], Any]] = None,
+        max_attempts: int = 5,
+        max_delay: float = 3600.0,
+    ):
+        self.path = path
+        self.min_items = max(1, min_items)
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.client_factory = client_factory or _openai_client
+        self.max_attempts = max(1, max_attempts)
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread: Optional[threading.Thread] = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, account_id TEXT NOT NULL, message_id TEXT NOT NULL,"
+                " model TEXT NOT NULL, instructions TEXT NOT NULL, text TEXT NOT NULL, context TEXT NOT NULL,"
+                " status TEXT NOT NULL, batch_id TEXT, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS items_status ON items (status, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                " batch_id TEXT PRIMARY KEY, status TEXT NOT NULL, items INTEGER NOT NULL, created_at REAL NOT NULL)"
+            )
+            # Answer of a finished job ('answered' items) and its delivery retries
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(items)")}
+            for column, decl in (
+                ("decision", "TEXT"),
+                ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                ("next_attempt_at", "REAL NOT NULL DEFAULT 0"),
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE items ADD COLUMN {column} {decl}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, reused; `with conn` only commits or rolls back
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, account_id: str, message_id: str, model: str, instructions: str, text: str, context: Dict[str, Any]) -> int:
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO items (account_id, message_id, model, instructions, text, context, status, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                (account_id, message_id, model, instructions, text, json.dumps(context, ensure_ascii=False), time.time()),
+            )
+            return int(cur.lastrowid)
+
+    def submit_ready(self) -> Optional[str]:
+        """Send queued items of the oldest waiting model as one batch job, if enough are due."""
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT model, COUNT(*), MIN(created_at) FROM items WHERE status = 'queued'"
+                " GROUP BY model ORDER BY MIN(created_at) LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            model, count, oldest = row
+            if count < self.min_items and time.time() - oldest < self.max_age:
+                return None
+            # Batch API input files are capped at 50,000 requests
+            rows = conn.execute(
+                "SELECT id, instructions, text FROM items WHERE status = 'queued' AND model = ? ORDER BY id LIMIT 50000",
+                (model,),
+            ).fetchall()
+        response_format = _response_format()
+        lines = [
+            json.dumps(
+                {
+                    "custom_id": f"item-{item_id}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "messages": [{"role": "system", "content": instructions}, {"role": "user", "content": text}],
+                        "response_format": response_format,
+                    },
+                },
+                ensure_ascii=False,
+            )
+            for item_id, instructions, text in rows
+        ]
+        client = self.client_factory()
+        upload = client.files.create(file=("triage.jsonl", ("\n".join(lines) + "\n").encode("utf-8")), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window=self.completion_window
+        )
+        with self._lock, self._connect() as conn:
+            conn.executemany("UPDATE items SET status = 'submitted', batch_id = ? WHERE id = ?", [(batch.id, r[0]) for r in rows])
+            conn.execute(
+                "INSERT INTO batches (batch_id, status, items, created_at) VALUES (?, ?, ?, ?)",
+                (batch.id, batch.status, len(rows), time.time()),
+            )
+        if metrics_enabled():
+            BATCH_SIZE.observe(len(rows), "batch_api")
+        logger.info("submitted %d triage requests as batch %s", len(rows), batch.id)
+        return batch.id
+
+    @staticmethod
+    def _parse_output(text: str) -> Dict[int, Optional[ComposeDecision]]:
+        out: Dict[int, Optional[ComposeDecision]] = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                item_id = int(str(record["custom_id"]).rsplit("-", 1)[1])
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            decision: Optional[ComposeDecision] = None
+            if response.get("status_code") == 200 and not record.get("error"):
+                try:
+                    decision = ComposeDecision.model_validate_json(body["choices"][0]["message"]["content"] or "")
+                except (ValidationError, KeyError, IndexError, TypeError):
+                    decision = None
+                usage = body.get("usage") or {}
+                cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+                count_tokens("Triage & Composer (batch api)", 1, usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0, cached)
+            out[item_id] = decision
+        return out
+
+    def collect(self, on_result: OfflineHandler) -> int:
+        """Store the answers of finished batch jobs and hand over the due ones; returns how many were delivered."""
+        self._fetch_finished()
+        return self._deliver_due(on_result)
+
+    def _fetch_finished(self) -> None:
+        with self._lock, self._connect() as conn:
+            pending = [r[0] for r in conn.execute("SELECT batch_id FROM batches WHERE status NOT IN ('completed', 'failed', 'expired', 'cancelled')")]
+        if not pending:
+            return
+        client = self.client_factory()
+        for batch_id in pending:
+            batch = client.batches.retrieve(batch_id)
+            if batch.status not in ("completed", "failed", "expired", "cancelled"):
+                continue
+            decisions: Dict[int, Optional[ComposeDecision]] = {}
+            # An expired or cancelled job may still have answered part of its requests
+            if batch.output_file_id:
+                decisions = self._parse_output(client.files.content(batch.output_file_id).text)
+            with self._lock, self._connect() as conn:
+                ids = [r[0] for r in conn.execute("SELECT id FROM items WHERE batch_id = ? AND status = 'submitted'", (batch_id,))]
+                answers = [(decisions[i].model_dump_json() if decisions.get(i) is not None else None, i) for i in ids]
+                conn.executemany("UPDATE items SET status = 'answered', decision = ? WHERE id = ?", answers)
+                conn.execute("UPDATE batches SET status = ? WHERE batch_id = ?", (batch.status, batch_id))
+            logger.info("batch %s %s: %d of %d answered", batch_id, batch.status, sum(1 for d in decisions.values() if d), len(ids))
+
+    def _deliver_due(self, on_result: OfflineHandler) -> int:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, account_id, message_id, model, instructions, context, decision, attempts FROM items"
+                " WHERE status = 'answered' AND next_attempt_at <= ? ORDER BY id",
+                (time.time(),),
+            ).fetchall()
+        handed = 0
+        for item_id, account_id, message_id, model, instructions, context, decision, attempts in rows:
+            item = {
+                "id": item_id,
+                "account_id": account_id,
+                "message_id": message_id,
+                "model": model,
+                "instructions": instructions,
+                "context": json.loads(context),
+            }
+            try:
+                on_result(item, ComposeDecision.model_validate_json(decision) if decision else None)
+            except Exception:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logger.error(
+                        "deferred triage result for %s %s could not be delivered after %d attempts; giving up",
+                        account_id, message_id, attempts, exc_info=True,
+                    )
+                    with self._lock, self._connect() as conn:
+                        conn.execute("UPDATE items SET status = 'failed', attempts = ? WHERE id = ?", (attempts, item_id))
+                else:
+                    delay = min(self.max_delay, self.poll_interval * 2 ** (attempts - 1))
+                    logger.warning(
+                        "deferred triage result for %s %s could not be delivered (attempt %d); retrying in %.0fs",
+                        account_id, message_id, attempts, delay, exc_info=True,
+                    )
+                    with self._lock, self._connect() as conn:
+                        conn.execute(
+                            "UPDATE items SET attempts = ?, next_attempt_at = ? WHERE id = ?", (attempts, time.time() + delay, item_id)
+                        )
+                continue
+            with self._lock, self._connect() as conn:
+                conn.execute("UPDATE items SET status = 'done' WHERE id = ?", (item_id,))
+            handed += 1
+        return handed
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall()
+        return {str(s): int(n) for s, n in rows}
+
+    def start(self, on_result: OfflineHandler) -> None:
+        """Submit and collect in a background thread every `poll_interval` seconds."""
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            def _loop() -> None:
+                while True:
+                    try:
+                        while self.submit_ready():
+                            pass
+                        self.collect(on_result)
+                    except Exception:
+                        logger.exception("offline triage poll failed")
+                    time.sleep(self.poll_interval)
+
+            self._thread = threading.Thread(target=_loop, name="triage-batch-api", daemon=True)
+            self._thread.start()
+
+
+_OFFLINE: Optional[OfflineTriage] = None
+_OFFLINE_LOCK = threading.Lock()
+
+
+def get_offline_triage() -> OfflineTriage:
+    global _OFFLINE
+    with _OFFLINE_LOCK:
+        if _OFFLINE is None:
+            data_dir = os.getenv("DATA_DIR") or os.getcwd()
+            _OFFLINE = OfflineTriage(
+                os.getenv("TRIAGE_OFFLINE_DB", os.path.join(data_dir, "triage_batches.sqlite3")),
+                min_items=int(os.getenv("TRIAGE_OFFLINE_MIN_MESSAGES", "50")),
+                max_age=float(os.getenv("TRIAGE_OFFLINE_MAX_WAIT_SECONDS", "600")),
+                poll_interval=float(os.getenv("TRIAGE_OFFLINE_POLL_SECONDS", "60")),
+                max_attempts=int(os.getenv("TRIAGE_OFFLINE_MAX_ATTEMPTS", "5")),
+            )
+        return _OFFLINE
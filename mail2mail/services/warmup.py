@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from mail2mail.services.metrics import Collector, MetricFamily
+
+
+logger = logging.getLogger(__name__)
+
+
+def _process_started() -> float:
+    """time.monotonic() value at process start (from /proc on Linux), else at this import."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+_STARTED = _process_started()
+_MARKS: Dict[str, float] = {}
+_STEPS: Dict[str, float] = {}
+_SKIPPED: Dict[str, str] = {}
+_BEGUN = threading.Event()
+_DONE = threading.Event()
+_LOCK = threading.Lock()
+
+
+def warmup_enabled() -> bool:
+    return os.getenv("WARMUP_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def mark(phase: str) -> float:
+    """Record when `phase` (e.g. "imports", "ready") was first reached; seconds since process start."""
+    elapsed = time.monotonic() - _STARTED
+    with _LOCK:
+        _MARKS.setdefault(phase, elapsed)
+    return elapsed
+
+
+def mark_ready() -> None:
+    """Mark the "ready" phase (mail is being watched) and log the startup report, once."""
+    with _LOCK:
+        first = "ready" not in _MARKS
+    if first:
+        mark("ready")
+        logger.info("startup: %s", format_report())
+
+
+def _agents_sdk() -> None:
+    importlib.import_module("agents")
+
+
+def _pipeline() -> None:
+    importlib.import_module("mail2mail.services.pipeline")
+
+
+def _triage_agents() -> None:
+    from mail2mail.agents.triage_compose import (
+        TRIAGE_COMPOSE_INSTRUCTIONS,
+        build_triage_compose_agent,
+        build_triage_compose_batch_agent,
+    )
+    from mail2mail.services.model_router import get_model_tiers
+    from mail2mail.services.settings_cache import get_snapshot
+    from mail2mail.services.triage_batch import get_triage_batcher
+
+    default = get_snapshot().settings.model
+    tiers = get_model_tiers(default)
+    models = {default} if tiers is None else {tiers.small, tiers.large}
+    batched = get_triage_batcher() is not None
+    for model in models:
+        build_triage_compose_agent(TRIAGE_COMPOSE_INSTRUCTIONS, model)
+        if batched:
+            build_triage_compose_batch_agent(TRIAGE_COMPOSE_INSTRUCTIONS, model)
+
+
+def _orchestrator_agent() -> None:
+    from mail2mail.agents.orchestrator import build_orchestrator_agent
+
+    build_orchestrator_agent()
+
+
+def _pymupdf() -> None:
+    try:
+        importlib.import_module("pymupdf")
+    except ImportError:  # PyMuPDF < 1.24.3
+        importlib.import_module("fitz")
+
+
+def _documents_processor() -> None:
+    from mail2mail.services.docproc_pool import preload
+
+    preload()
+
+
+# In order: later steps reuse what earlier ones imported
+STEPS: List[Tuple[str, Callable[[], None]]] = [
+    ("agents_sdk", _agents_sdk),
+    ("pipeline", _pipeline),
+    ("triage_agents", _triage_agents),
+    ("orchestrator_agent", _orchestrator_agent),
+    ("pymupdf", _pymupdf),
+    ("documents_processor", _documents_processor),
+]
+
+
+def warmup(only: Optional[Sequence[str]] = None) -> Dict[str, float]:
+    """Import heavy dependencies and build the agents and Documents_processor once.
+
+    Returns seconds per step. A failing step (e.g. Documents_processor not installed) is
+    recorded as skipped; the first message then pays for that part instead.
+    """
+    _BEGUN.set()
+    for name, step in STEPS:
+        if only and name not in only:
+            continue
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            with _LOCK:
+                _SKIPPED[name] = f"{type(e).__name__}: {e}"
+            logger.info("warmup step %s skipped: %s", name, e)
+        with _LOCK:
+            _STEPS[name] = time.perf_counter() - started
+    mark("warm")
+    _DONE.set()
+    return dict(_STEPS)
+
+
+def _warmup_and_report() -> None:
+    warmup()
+    logger.info("startup: %s", format_report())
+
+
+def start_warmup() -> Optional[threading.Thread]:
+    """Warm up in a daemon thread, so mailboxes are watched while the SDK is still loading.
+
+    Disabled with WARMUP_ENABLED=false (everything then loads on first use).
+    """
+    if not warmup_enabled():
+        return None
+    thread = threading.Thread(target=_warmup_and_report, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def startup_report() -> Dict[str, Any]:
+    """Phase marks and warmup step times, in seconds."""
+    with _LOCK:
+        return {
+            "marks": {k: round(v, 4) for k, v in _MARKS.items()},
+            "warmup": {k: round(v, 4) for k, v in _STEPS.items()},
+            "skipped": dict(_SKIPPED),
+            "warm": _DONE.is_set(),
+        }
+
+
+def format_report() -> str:
+    report = startup_report()
+    marks = ", ".join(f"{k} {v:.3f}s" for k, v in report["marks"].items())
+    steps = ", ".join(
+        f"{k} {v:.3f}s" + (" (skipped)" if k in report["skipped"] else "") for k, v in report["warmup"].items()
+    )
+    if not report["warm"]:
+        steps = ", ".join(filter(None, [steps, "in progress" if _BEGUN.is_set() else "not run"]))
+    return f"{marks or 'no marks'}; warmup: {steps}"
+
+
+def startup_metrics() -> Collector:
+    """Scrape-time collector for the startup report (see MetricsRegistry.add_collector)."""
+
+    def collect() -> List[MetricFamily]:
+        report = startup_report()
+        return [
+            ("mail2mail_startup_seconds", "gauge", "Seconds from process start to each startup phase.", [({"phase": k}, v) for k, v in report["marks"].items()]),
+            ("mail2mail_warmup_seconds", "gauge", "Seconds spent per warmup step.", [({"step": k}, v) for k, v in report["warmup"].items()]),
+        ]
+
+    return collect
+
+
+if __name__ == "__main__":
+    # Foreground warmup with a JSON report: `python -m mail2mail.services.warmup`
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    mark("imports")
+    warmup()
+    print(json.dumps(startup_report(), indent=2))
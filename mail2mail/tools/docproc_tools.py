@@ -3,58 +3,75 @@ from __future__ import annotations
 import os
 from typing import Any, Dict, List, Optional
 
-from agents import function_tool
 from pydantic import BaseModel, ConfigDict
 
+from mail2mail.services.docproc_cache import get_docproc_cache
+from mail2mail.services.docproc_pool import error_result, execution_mode, process_document, processor_env, run_isolated
+from mail2mail.services.metrics import traced
+from mail2mail.services.page_stream import can_stream, default_preview_budget, iter_page_texts, take_text
+from mail2mail.tools.lazy import function_tool
 
-def _run_documents_processor(path: str, work_dir: str, options: Optional[ProcessOptions]) -> Dict[str, Any]:
-    """Invoke external/Documents_processor to process a file and return extracted pieces.
+
+def _run_documents_processor(path: str) -> Dict[str, Any]:
+    """Invoke external/Documents_processor in this process with the environment as it is.
 
     We import its module directly to avoid spawning a process; fallback to simple stub if import fails.
     """
     try:
-        import sys
-        proj_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-        ext_dir = os.path.join(proj_root, "external", "Documents_processor")
-        if ext_dir not in sys.path:
-            sys.path.insert(0, ext_dir)
-
-        from documents_processor import Document  # type: ignore
-
-        # Configure page limits via env if provided
-        if options and options.page_limits is not None:
-            os.environ["MAX_DOCUMENT_PAGES"] = str(options.page_limits)
-            os.environ["DISABLE_PAGE_LIMIT"] = "false"
-
-        # Pass vision toggle via env for the downstream library
-        if options and options.vision_descriptions is not None:
-            os.environ["MAX_VISION_CALLS_PER_PAGE"] = "50" if options.vision_descriptions else "0"
-
-        # Optional model routing for vision descriptions
-        docs_vision_model = os.getenv("DOCS_VISION_MODEL")
-        if docs_vision_model:
-            os.environ["DOCS_VISION_MODEL"] = docs_vision_model
-
-        doc = Document(path)
-        doc.process()
-
-        # Gather results
-        text_content = getattr(doc, "text_content", "") or ""
-        tables = getattr(doc, "tables", []) or []
-        images = getattr(doc, "images", []) or []
-        return {
-            "extracted_text": text_content,
-            "tables": tables,
-            "images": images,
-            "notes": [],
-        }
+        return process_document(path)
     except Exception as e:  # fallback
-        return {
-            "extracted_text": f"[documents_processor error] {e}",
-            "tables": [],
-            "images": [],
-            "notes": [f"documents_processor failure: {e}"],
-        }
+        return error_result(str(e))
+
+
+def _options_env(options: Optional[ProcessOptions]) -> Dict[str, str]:
+    return processor_env(
+        options.page_limits if options else None,
+        options.vision_descriptions if options else None,
+    )
+
+
+@traced("documents_processor")
+def _run_uncached(paths: List[str], options: Optional[ProcessOptions]) -> List[Dict[str, Any]]:
+    """Process files either inline or, with DOCPROC_EXECUTION=process, in isolated child processes.
+
+    Documents_processor reads its options from os.environ, which every worker thread shares;
+    inline calls whose options differ from it go to child processes that get them explicitly.
+    """
+    if not paths:
+        return []
+    env = _options_env(options)
+    overrides = any(os.environ.get(k) != v for k, v in env.items())
+    if execution_mode() != "process" and not overrides:
+        return [_run_documents_processor(p) for p in paths]
+    return run_isolated(
+        paths,
+        env,
+        workers=int(os.getenv("DOCPROC_WORKERS", "0")) or (os.cpu_count() or 1),
+        timeout=float(os.getenv("DOCPROC_TIMEOUT_SECONDS", "300")),
+        memory_limit_mb=int(os.getenv("DOCPROC_MEMORY_LIMIT_MB", "0")),
+    )
+
+
+def _process_paths(paths: List[str], options: Optional[ProcessOptions]) -> List[Dict[str, Any]]:
+    """Results for `paths` in input order; cache hits skip processing entirely."""
+    cache = get_docproc_cache()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(paths)
+    keys: List[Optional[str]] = [None] * len(paths)
+    misses: List[int] = []
+    for i, p in enumerate(paths):
+        if cache is not None:
+            keys[i] = cache.key_for(p, options.model_dump() if options else None)
+            results[i] = cache.get(keys[i])  # type: ignore[arg-type]
+        if results[i] is None:
+            misses.append(i)
+
+    fresh = _run_uncached([paths[i] for i in misses], options)
+    for i, result in zip(misses, fresh):
+        results[i] = result
+        # Failures carry notes; don't pin them in the cache
+        if cache is not None and not result.get("notes"):
+            cache.put(keys[i], result)  # type: ignore[arg-type]
+    return [r for r in results if r is not None]
 
 
 class ProcessOptions(BaseModel):
@@ -63,13 +80,9 @@ class ProcessOptions(BaseModel):
     vision_descriptions: Optional[bool] = None
 
 
-@function_tool
-def process_files(paths: List[str], options: Optional[ProcessOptions] = None) -> Dict[str, Any]:
-    """Извлечёт текст/таблицы/описания изображений из файлов локально.
-
-    Прототип: возвращает объединённый псевдо‑текст и пустые tables/images.
-    В дальнейшем подключим NumericalArt/Documents_processor через CLI/SDK.
-    """
+@traced("process_files")
+def process_file_paths(paths: List[str], options: Optional[ProcessOptions] = None) -> Dict[str, Any]:
+    """Internal helper behind process_files: combined text, tables, images and notes for `paths`."""
     notes: List[str] = []
     combined_texts: List[str] = []
     all_tables: List[Dict[str, Any]] = []
@@ -78,11 +91,14 @@ def process_files(paths: List[str], options: Optional[ProcessOptions] = None) ->
     work_dir = os.getenv("TMP_ROOT", os.path.abspath(os.path.join(os.getcwd(), "tmp")))
     os.makedirs(work_dir, exist_ok=True)
 
+    existing: List[str] = []
     for p in paths or []:
         if not os.path.exists(p):
             notes.append(f"missing: {p}")
             continue
-        result = _run_documents_processor(p, work_dir, options)
+        existing.append(p)
+
+    for result in _process_paths(existing, options):
         if result.get("extracted_text"):
             combined_texts.append(str(result.get("extracted_text")))
         all_tables.extend(result.get("tables", []))
@@ -95,3 +111,82 @@ def process_files(paths: List[str], options: Optional[ProcessOptions] = None) ->
         "images": all_images,
         "notes": notes,
     }
+
+
+@function_tool
+def process_files(paths: List[str], options: Optional[ProcessOptions] = None) -> Dict[str, Any]:
+    """Извлечёт текст/таблицы/описания изображений из файлов локально.
+
+    Прототип: возвращает объединённый псевдо‑текст и пустые tables/images.
+    В дальнейшем подключим NumericalArt/Documents_processor через CLI/SDK.
+    """
+    return process_file_paths(paths, options)
+
+
+@traced("preview_files")
+def preview_paths(paths: List[str], max_chars: Optional[int] = None) -> Dict[str, Any]:
+    """Text of the first pages of `paths`, stopping once `max_chars` are collected.
+
+    PDFs and other paged formats are read page by page with PyMuPDF; formats we cannot
+    stream, and paged files without a text layer (scans), go through the regular (cached)
+    Documents_processor path with OCR/vision and are cut to budget; the latter are listed
+    in `full_extraction`. `sections` carries the same text per file ({path, text}) for
+    prompt budgeting.
+    """
+    budget = max_chars or default_preview_budget()
+    texts: List[str] = []
+    sections: List[Dict[str, str]] = []
+    notes: List[str] = []
+    full_extraction: List[str] = []
+    truncated = False
+
+    for p in paths or []:
+        if not os.path.exists(p):
+            notes.append(f"missing: {p}")
+            continue
+        if budget <= 0:
+            truncated = True
+            notes.append(f"not previewed (budget exhausted): {p}")
+            continue
+        needs_full = not can_stream(p)
+        if not needs_full:
+            try:
+                text, _, cut = take_text(iter_page_texts(p), budget)
+            except Exception as e:
+                notes.append(f"preview failure: {p}: {e}")
+                continue
+            # No text layer (scans, image-only PDFs): only full extraction with OCR/vision reads it
+            needs_full = not text.strip()
+            if needs_full:
+                full_extraction.append(p)
+        if needs_full:
+            result = _process_paths([p], None)[0]
+            notes.extend(result.get("notes", []))
+            full = str(result.get("extracted_text") or "")
+            text, cut = full[:budget], len(full) > budget
+        truncated = truncated or cut
+        if text:
+            texts.append(text)
+            sections.append({"path": p, "text": text})
+            budget -= len(text) + 2
+
+    return {
+        "extracted_text": "\n\n".join(texts),
+        "sections": sections,
+        "truncated": truncated,
+        "full_extraction": full_extraction,
+        "notes": notes,
+    }
+
+
+@function_tool
+def preview_files(paths: List[str], max_chars: Optional[int] = None) -> Dict[str, Any]:
+    """Быстро извлечёт текст первых страниц файлов в пределах бюджета символов.
+
+    Вернёт {extracted_text, truncated, notes}. Если truncated=true и для классификации
+    нужен полный текст — вызови process_files.
+    """
+    result = preview_paths(paths, max_chars)
+    # Per-file copy of extracted_text is for in-process callers; don't send it to the model twice
+    result.pop("sections", None)
+    return result
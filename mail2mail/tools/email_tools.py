@@ -1,96 +1,83 @@
 from __future__ import annotations
 
-import email
+import asyncio
+import logging
 import os
-from email import policy
-from email.parser import BytesParser
-from typing import Any, Dict, List, Optional
-
-from agents import function_tool
-from imapclient import IMAPClient
-
-from mail2mail.settings import get_imap_config, get_smtp_config
-import smtplib
-from email.message import EmailMessage
-
-
-def _extract_links_from_text(text: str) -> List[str]:
-    import re
-
-    url_pattern = re.compile(r"https?://\S+")
-    return url_pattern.findall(text or "")
+from contextvars import ContextVar
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from imapclient import SEEN
+
+from mail2mail.services.imap_pool import imap_session
+from mail2mail.services.imap_structure import decode_text, fetch_sections, lazy_fetch_enabled
+from mail2mail.services.ledger import get_ledger
+from mail2mail.services.message_cache import fetch_cached_message, fetch_cached_structure
+from mail2mail.services.metrics import traced
+from mail2mail.services.mime_forward import ForwardMessage
+from mail2mail.services.mime_normalize import NormalizedMessage, normalize_stream
+from mail2mail.services.smtp_pool import get_smtp_sender, resolve_smtp_config
+from mail2mail.tools.lazy import function_tool
+
+
+logger = logging.getLogger(__name__)
+
+# Ledger key of the message an agent run is handling; set by pipeline.run_orchestrated
+forward_key: ContextVar[Optional[str]] = ContextVar("forward_key", default=None)
+
+
+@traced("mime_parse")
+def _normalize_raw(fp: BinaryIO) -> NormalizedMessage:
+    return normalize_stream(fp)
+
+
+def _read_imap_lazy(account_id: str, session: Any, uid: int) -> Dict[str, Any]:
+    """Normalize a message from BODYSTRUCTURE + headers, downloading only its text parts."""
+    cached = fetch_cached_structure(account_id, session, uid)
+    if cached.normalized is None:
+        parts = cached.parts or []
+        plain = next((p for p in parts if p.mime == "text/plain" and not p.is_attachment), None)
+        html = next((p for p in parts if p.mime == "text/html" and not p.is_attachment), None)
+        bodies = fetch_sections(session.client, uid, [p.section for p in (plain, html) if p is not None])
+        attachments_meta = [
+            {"filename": p.filename or "attachment", "mime": p.mime, "size_bytes": p.decoded_size}
+            for p in parts
+            if p.is_attachment
+        ]
+        cached.normalized = NormalizedMessage(
+            cached.headers or {},
+            decode_text(bodies[plain.section], plain) if plain is not None else None,
+            decode_text(bodies[html.section], html) if html is not None else None,
+            attachments_meta,
+        )
+        # BODY.PEEK leaves the message unseen; keep the RFC822 contract the monitor relies on
+        session.client.add_flags([uid], [SEEN])
+    return cached.normalized.to_dict()
+
+
+def _with_origin(message: Dict[str, Any], session: Any, uid: int) -> Dict[str, Any]:
+    # Where the message lives; identifies it when there is no Message-ID header
+    message["imap"] = {"mailbox": session.mailbox, "uidvalidity": session.uidvalidity, "uid": uid}
+    return message
 
 
 def _parse_eml(file_path: str) -> Dict[str, Any]:
     with open(file_path, "rb") as f:
-        msg = BytesParser(policy=policy.default).parse(f)
-
-    headers = dict(msg.items())
-    text_plain: Optional[str] = None
-    text_html: Optional[str] = None
-    attachments_meta: List[Dict[str, Any]] = []
-
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_disposition = part.get_content_disposition()
-            content_type = part.get_content_type()
-            if content_disposition == "attachment":
-                attachments_meta.append(
-                    {
-                        "filename": part.get_filename() or "attachment",
-                        "mime": content_type,
-                        "size_bytes": len(part.get_payload(decode=True) or b""),
-                    }
-                )
-            elif content_type == "text/plain" and text_plain is None:
-                text_plain = part.get_content()
-            elif content_type == "text/html" and text_html is None:
-                text_html = part.get_content()
-    else:
-        ctype = msg.get_content_type()
-        if ctype == "text/plain":
-            text_plain = msg.get_content()
-        elif ctype == "text/html":
-            text_html = msg.get_content()
-
-    links: List[str] = []
-    if text_plain:
-        links += _extract_links_from_text(text_plain)
-    if text_html:
-        links += _extract_links_from_text(text_html)
-
-    return {
-        "headers": headers,
-        "text_plain": text_plain,
-        "text_html": text_html,
-        "links": list(dict.fromkeys(links)),
-        "attachments_meta": attachments_meta,
-    }
+        return _normalize_raw(f).to_dict()
 
 
-@function_tool
-def read_message(account_id: str, message_id: str) -> Dict[str, Any]:
-    """Вернёт нормализованное письмо.
-
-    headers, text_plain, text_html, links[], attachments_meta[{filename, mime, size_bytes}]
-
-    Для базового локального теста `message_id` может быть абсолютным путём к .eml файлу.
-    """
+@traced("read_message")
+def read_email_message(account_id: str, message_id: str) -> Dict[str, Any]:
+    """Internal helper behind read_message: normalized message from a local .eml or IMAP."""
     # Basic stub: if message_id is a path to a local EML, parse it
     if os.path.isfile(message_id) and message_id.endswith(".eml"):
         return _parse_eml(message_id)
 
     # IMAP support: message_id may be "imap:latest_unseen" or "imap:UID"
     if message_id.startswith("imap:"):
-        cfg = get_imap_config(account_id)
-        if not cfg:
-            raise ValueError("IMAP config not found for account")
-
         uid_to_fetch: Optional[int] = None
         mode = message_id.split(":", 1)[1]
-        with IMAPClient(cfg.host, port=cfg.port, ssl=cfg.use_ssl) as client:
-            client.login(cfg.username, cfg.password)
-            client.select_folder(cfg.mailbox)
+        with imap_session(account_id) as session:
+            client = session.client
             if mode == "latest_unseen":
                 uids = client.search(["UNSEEN"]) or client.search(["ALL"])
                 if not uids:
@@ -102,129 +89,122 @@ def read_message(account_id: str, message_id: str) -> Dict[str, Any]:
                 except ValueError:
                     raise ValueError("Unsupported imap message_id. Use imap:latest_unseen or imap:<UID>")
 
-            raw = client.fetch([uid_to_fetch], [b'RFC822'])
-            msg_bytes = raw[uid_to_fetch][b'RFC822']
-            # Parse bytes and reuse the .eml parser
-            msg = BytesParser(policy=policy.default).parsebytes(msg_bytes)
-            headers = dict(msg.items())
-            text_plain: Optional[str] = None
-            text_html: Optional[str] = None
-            attachments_meta: List[Dict[str, Any]] = []
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_disposition = part.get_content_disposition()
-                    content_type = part.get_content_type()
-                    if content_disposition == "attachment":
-                        attachments_meta.append(
-                            {
-                                "filename": part.get_filename() or "attachment",
-                                "mime": content_type,
-                                "size_bytes": len(part.get_payload(decode=True) or b""),
-                            }
-                        )
-                    elif content_type == "text/plain" and text_plain is None:
-                        text_plain = part.get_content()
-                    elif content_type == "text/html" and text_html is None:
-                        text_html = part.get_content()
-            else:
-                ctype = msg.get_content_type()
-                if ctype == "text/plain":
-                    text_plain = msg.get_content()
-                elif ctype == "text/html":
-                    text_html = msg.get_content()
-
-            links: List[str] = []
-            if text_plain:
-                links += _extract_links_from_text(text_plain)
-            if text_html:
-                links += _extract_links_from_text(text_html)
-
-            return {
-                "headers": headers,
-                "text_plain": text_plain,
-                "text_html": text_html,
-                "links": list(dict.fromkeys(links)),
-                "attachments_meta": attachments_meta,
-            }
+            if lazy_fetch_enabled():
+                try:
+                    return _with_origin(_read_imap_lazy(account_id, session, uid_to_fetch), session, uid_to_fetch)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    # Unusual BODYSTRUCTURE: fall back to the full download below
+                    pass
+
+            # One download and one parse per message, shared with save_attachments
+            cached = fetch_cached_message(account_id, session, uid_to_fetch)
+            if cached.normalized is None:
+                with cached.open() as f:
+                    cached.normalized = _normalize_raw(f)
+            return _with_origin(cached.normalized.to_dict(), session, uid_to_fetch)
 
     # Otherwise, not supported
     raise NotImplementedError("read_message supports local .eml path or imap:latest_unseen/imap:<UID>")
 
 
-from email.message import EmailMessage
+@function_tool
+def read_message(account_id: str, message_id: str) -> Dict[str, Any]:
+    """Вернёт нормализованное письмо.
+
+    headers, text_plain, text_html, text (тело как обычный текст), links[], attachments_meta[{filename, mime, size_bytes}],
+    для IMAP ещё imap{mailbox, uidvalidity, uid}
+
+    Для базового локального теста `message_id` может быть абсолютным путём к .eml файлу.
+    """
+    return read_email_message(account_id, message_id)
 
 
+@traced("send")
 def send_email_smtp(
     from_account_id: str,
     to: List[str],
     subject: str,
     body: str,
     attach_paths: List[str],
+    raw_eml_path: Optional[str] = None,
 ) -> Dict[str, Any]:
-    """Internal helper to send email via SMTP (STARTTLS), returns {sent_message_id} or mock."""
-    # Single global sender: if from_account_id is "__default__" use admin_smtp.json
-    cfg = None
-    if from_account_id == "__default__":
-        # read admin_smtp.json
-        base = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-        smtp_store = os.path.join(base, "admin_smtp.json")
-        data = {}
-        if os.path.isfile(smtp_store):
-            import json
-            try:
-                data = json.loads(open(smtp_store, "r", encoding="utf-8").read() or "{}")
-            except Exception:
-                data = {}
-        if data:
-            # build cfg-like
-            class _Cfg:
-                pass
-            c = _Cfg()
-            c.host = data.get("host")
-            c.port = int(data.get("port") or 587)
-            c.starttls = bool(data.get("starttls", True))
-            c.username = data.get("username")
-            c.from_addr = data.get("from") or c.username
-            # password from .env via get_smtp_config using username/from as account_id
-            env_cfg = get_smtp_config(c.username or c.from_addr or "")
-            c.password = env_cfg.password if env_cfg else None
-            cfg = c
-    else:
-        cfg = get_smtp_config(from_account_id)
+    """Internal helper to send email via SMTP (STARTTLS), returns {sent_message_id} or mock.
+
+    Sessions are pooled; transient failures are queued for retry (sent_message_id "queued://<id>").
+    With SMTP_SEND_MODE=queue the message is always handed to the background sender.
+    The body is streamed: attachments are not loaded into memory, and `raw_eml_path`
+    (the original RFC822 message) is attached as message/rfc822 without re-encoding.
+    """
+    cfg = resolve_smtp_config(from_account_id)
     if not cfg:
         mock_id = f"sent://{from_account_id}/to={len(to)}"
         return {"sent_message_id": mock_id}
 
-    # Sanitize subject to avoid header injection
-    safe_subject = (subject or "").replace("\r", " ").replace("\n", " ")[:998]
+    msg = ForwardMessage(cfg.from_addr, to, subject, body)
+    try:
+        for path in attach_paths or []:
+            try:
+                if os.path.isfile(path):
+                    msg.attach_file(path)
+            except Exception:
+                continue
+        if raw_eml_path and os.path.isfile(raw_eml_path):
+            msg.attach_eml(raw_eml_path)
 
-    msg = EmailMessage()
-    msg["From"] = cfg.from_addr
-    msg["To"] = ", ".join(to)
-    msg["Subject"] = safe_subject
-    msg.set_content(body)
+        sender = get_smtp_sender()
+        if os.getenv("SMTP_SEND_MODE", "direct").strip().lower() == "queue":
+            return sender.enqueue(from_account_id, msg)
+        # A message queued for retry is spooled to disk first, so the files can go now
+        return sender.send(from_account_id, cfg, msg)
+    finally:
+        msg.close()
 
-    for path in attach_paths or []:
-        try:
-            with open(path, "rb") as f:
-                data = f.read()
-            import mimetypes
 
-            mime, _ = mimetypes.guess_type(path)
-            maintype, subtype = (mime.split("/", 1) if mime else ("application", "octet-stream"))
-            msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=os.path.basename(path))
-        except Exception:
-            continue
+def send_once(
+    key: Optional[str],
+    from_account_id: str,
+    to: List[str],
+    subject: str,
+    body: str,
+    attach_paths: List[str],
+    raw_eml_path: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """send_email_smtp at most once per message `key`, across restarts; repeats return None.
 
-    with smtplib.SMTP(cfg.host, cfg.port, timeout=30) as s:
-        if cfg.starttls:
-            s.starttls()
-        s.login(cfg.username, cfg.password)
-        s.send_message(msg)
-    return {"sent_message_id": f"smtp://{cfg.host}:{cfg.port}/{len(to)}"}
+    Without a key the mail is sent unguarded.
+    """
+    ledger = get_ledger()
+    if key and not ledger.claim_forward(key):
+        logger.info("%s was already forwarded; not sending again", key)
+        return None
+    try:
+        sent = send_email_smtp(from_account_id, to, subject, body, attach_paths, raw_eml_path=raw_eml_path)
+    except Exception:
+        if key:
+            ledger.release_forward(key)
+        raise
+    if key:
+        ledger.finish_forward(key, sent.get("sent_message_id"))
+    return sent
+
+
+async def send_email_async(
+    from_account_id: str,
+    to: List[str],
+    subject: str,
+    body: str,
+    attach_paths: List[str],
+    raw_eml_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """send_email_smtp without blocking the event loop."""
+    return await asyncio.to_thread(send_email_smtp, from_account_id, to, subject, body, attach_paths, raw_eml_path)
 
 
 @function_tool
 def send(from_account_id: str, to: List[str], subject: str, body: str, attach_paths: List[str]) -> Dict[str, Any]:
-    """Отправит письмо и вернёт {sent_message_id: str}. Tool wrapper."""
-    return send_email_smtp(from_account_id, to, subject, body, attach_paths)
+    """Отправит письмо и вернёт {sent_message_id: str}. Tool wrapper.
+
+    Письмо пересылается не более одного раза; повтор вернёт {sent_message_id: null, skipped: "already forwarded"}.
+    """
+    sent = send_once(forward_key.get(), from_account_id, to, subject, body, attach_paths)
+    return sent if sent is not None else {"sent_message_id": None, "skipped": "already forwarded"}
@@ -1,16 +1,44 @@
 from __future__ import annotations
 
 import shutil
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-from agents import function_tool
+from mail2mail.services.message_cache import get_message_cache
+from mail2mail.services.metrics import traced
+from mail2mail.tools.lazy import function_tool
 
 
-@function_tool
-def cleanup(work_dir: str) -> Dict[str, Any]:
-    """Удалит временный каталог; вернёт {ok: true}."""
+def _imap_uid(message_id: Optional[str]) -> Optional[int]:
+    if not message_id or not message_id.startswith("imap:"):
+        return None
+    try:
+        return int(message_id.split(":", 1)[1])
+    except ValueError:
+        return None
+
+
+@traced("cleanup")
+def cleanup_work_dir(
+    work_dir: Optional[str],
+    account_id: Optional[str] = None,
+    message_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Internal helper behind cleanup: remove `work_dir` and drop this message's cached download.
+
+    Other messages' cache entries are left alone: they may still be in flight on other workers.
+    """
     try:
-        shutil.rmtree(work_dir, ignore_errors=True)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        uid = _imap_uid(message_id)
+        if account_id and uid is not None:
+            get_message_cache().discard(account_id, uid)
         return {"ok": True}
     except Exception:
         return {"ok": False}
+
+
+@function_tool
+def cleanup(work_dir: str, account_id: str = "", message_id: str = "") -> Dict[str, Any]:
+    """Удалит временный каталог и кэш скачанного письма (account_id, message_id); вернёт {ok: true}."""
+    return cleanup_work_dir(work_dir, account_id, message_id)
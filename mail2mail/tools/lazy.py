@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import threading
+from typing import Any, Callable, List, Sequence
+
+
+class LazyTool:
+    """Stands in for `agents.function_tool(fn)` until an agent actually needs the tool.
+
+    Building a FunctionTool imports the agents SDK (and openai). Workers import the tool
+    modules for their plain helpers and may never run a tool-calling agent, so the SDK
+    is loaded on first use instead.
+    """
+
+    def __init__(self, fn: Callable[..., Any]):
+        functools.update_wrapper(self, fn)
+        self.fn = fn
+        self._tool: Any = None
+        self._lock = threading.Lock()
+
+    @property
+    def tool(self) -> Any:
+        if self._tool is None:
+            with self._lock:
+                if self._tool is None:
+                    from agents import function_tool
+
+                    self._tool = function_tool(_in_thread(self.fn))
+        return self._tool
+
+    def __getattr__(self, name: str) -> Any:
+        # FunctionTool attributes (name, params_json_schema, on_invoke_tool, ...)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.tool, name)
+
+
+def _in_thread(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Async twin of a blocking tool, run in a worker thread.
+
+    The SDK calls sync tools directly on its event loop, and agents run on the shared model
+    loop (scheduler.get_model_loop): IMAP fetches or document processing there would stall
+    every other message's model calls.
+    """
+    if inspect.iscoroutinefunction(fn):
+        return fn
+
+    @functools.wraps(fn)
+    async def call(*args: Any, **kwargs: Any) -> Any:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    return call
+
+
+def function_tool(fn: Callable[..., Any]) -> LazyTool:
+    """Drop-in for `agents.function_tool` used as a bare decorator."""
+    return LazyTool(fn)
+
+
+def resolve_tools(tools: Sequence[Any]) -> List[Any]:
+    """Real FunctionTool objects for Agent(tools=...)."""
+    return [t.tool if isinstance(t, LazyTool) else t for t in tools]
@@ -2,8 +2,9 @@ from __future__ import annotations
 
 from typing import Dict, Any
 
-from agents import function_tool
-from mail2mail.settings import get_settings
+from mail2mail.services.metrics import traced
+from mail2mail.services.settings_cache import get_snapshot
+from mail2mail.tools.lazy import function_tool
 
 
 DEFAULT_RULES = {
@@ -15,23 +16,24 @@ DEFAULT_RULES = {
 }
 
 
-@function_tool
-def resolve(category: str) -> Dict[str, Any]:
-    """Вернёт адреса назначения {to[], subject_prefix?} по category.
-
-    Источник правил: settings.yaml -> routing_rules[]. При отсутствии совпадений — пустые списки.
-    """
+@traced("resolve")
+def resolve_route(category: str) -> Dict[str, Any]:
+    """Internal helper behind resolve: routing_rules lookup for `category` (case-insensitive, aliases)."""
     try:
-        settings = get_settings()
-        rules = settings.routing_rules or []
-        for rule in rules:
-            if str(rule.get("category", "")).strip() == str(category).strip():
-                to = rule.get("to") or []
-                subject_prefix = rule.get("subject_prefix") if rule.get("subject_prefix") is not None else None
-                # Normalize to lists of strings
-                to = [str(x).strip() for x in to if str(x).strip()]
-                return {"to": to, "subject_prefix": subject_prefix}
+        route = get_snapshot().route(category)
+        if route is not None:
+            return {"to": list(route.to), "subject_prefix": route.subject_prefix}
     except Exception:
         pass
     # Fallback: no routing
     return {"to": [], "subject_prefix": None}
+
+
+@function_tool
+def resolve(category: str) -> Dict[str, Any]:
+    """Вернёт адреса назначения {to[], subject_prefix?} по category.
+
+    Источник правил: settings.yaml -> routing_rules[] (регистр не важен, учитываются aliases).
+    При отсутствии совпадений — пустые списки.
+    """
+    return resolve_route(category)
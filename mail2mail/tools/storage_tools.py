@@ -1,62 +1,60 @@
 from __future__ import annotations
 
 import os
-import shutil
-from email import policy
-from email.parser import BytesParser
 from typing import Dict, Any, List, Optional
 
-from agents import function_tool
-from imapclient import IMAPClient
+from mail2mail.services.imap_pool import imap_session
+from mail2mail.services.imap_structure import iter_section_chunks, lazy_fetch_enabled
+from mail2mail.services.message_cache import fetch_cached_message, fetch_cached_structure
+from mail2mail.services.metrics import traced
+from mail2mail.services.mime_stream import AttachmentWriter, make_decoder, stream_attachments
+from mail2mail.tools.lazy import function_tool
 
-from mail2mail.settings import get_imap_config
 
+DANGEROUS_EXTS = {".exe", ".bat", ".cmd", ".sh", ".ps1", ".vbs", ".js", ".jar", ".com", ".scr", ".msi", ".dll", ".html", ".htm"}
 
-def _extract_attachments_from_eml(eml_path: str, target_dir: str) -> List[str]:
-    saved: List[str] = []
+
+def _extract_attachments_from_eml(eml_path: str, target_dir: str, writer: Optional[AttachmentWriter] = None) -> List[str]:
+    writer = writer or AttachmentWriter.from_env(target_dir)
     with open(eml_path, "rb") as f:
-        msg = BytesParser(policy=policy.default).parse(f)
-
-    if not os.path.isdir(target_dir):
-        os.makedirs(target_dir, exist_ok=True)
-
-    dangerous_exts = {".exe", ".bat", ".cmd", ".sh", ".ps1", ".vbs", ".js", ".jar", ".com", ".scr", ".msi", ".dll", ".html", ".htm"}
-    for part in msg.walk():
-        if part.get_content_disposition() == "attachment":
-            filename = part.get_filename() or "attachment"
-            try:
-                ext = os.path.splitext(filename)[1].lower()
-                if ext in dangerous_exts:
-                    continue
-            except Exception:
-                pass
-            raw = part.get_payload(decode=True) or b""
-            out_path = os.path.join(target_dir, filename)
-            with open(out_path, "wb") as outf:
-                outf.write(raw)
-            saved.append(out_path)
+        saved = stream_attachments(f, writer, DANGEROUS_EXTS, source_path=os.path.abspath(eml_path))
+    writer.write_manifest()
     return saved
 
 
-@function_tool
-def save_attachments(account_id: str, message_id: str, target_dir: str) -> Dict[str, Any]:
-    """Сохранит вложения письма в target_dir; вернёт {saved_paths: [str]}.
+def _save_imap_parts(client: Any, uid: int, parts: List[Any], writer: AttachmentWriter) -> List[str]:
+    """Stream attachment sections one at a time, as listed by BODYSTRUCTURE."""
+    chunk_size = int(os.getenv("IMAP_FETCH_CHUNK_BYTES", str(1024 * 1024)))
+    for part in parts:
+        if not part.is_attachment:
+            continue
+        filename = part.filename or "attachment"
+        if os.path.splitext(filename)[1].lower() in DANGEROUS_EXTS:
+            continue
+        sink = writer.open(filename)
+        decoder = make_decoder(part.encoding)
+        for chunk in iter_section_chunks(client, uid, part.section, chunk_size):
+            sink.write(decoder.feed(chunk))
+            if sink.aborted:
+                break
+        sink.write(decoder.flush())
+        sink.close()
+    return writer.saved
 
-    В прототипе ожидаем, что message_id — путь к локальному .eml
-    """
+
+@traced("save_attachments")
+def save_message_attachments(account_id: str, message_id: str, target_dir: str) -> Dict[str, Any]:
+    """Internal helper behind save_attachments: stream attachments of a .eml or IMAP message to disk."""
     if message_id.endswith(".eml") and os.path.isfile(message_id):
-        paths = _extract_attachments_from_eml(message_id, target_dir)
-        return {"saved_paths": paths}
+        writer = AttachmentWriter.from_env(target_dir)
+        paths = _extract_attachments_from_eml(message_id, target_dir, writer)
+        return {"saved_paths": paths, "notes": writer.notes}
     # IMAP variant: message_id may be imap:<UID> or imap:latest_unseen
     if message_id.startswith("imap:"):
-        cfg = get_imap_config(account_id)
-        if not cfg:
-            raise ValueError("IMAP config not found for account")
         mode = message_id.split(":", 1)[1]
         uid_to_fetch: Optional[int] = None
-        with IMAPClient(cfg.host, port=cfg.port, ssl=cfg.use_ssl) as client:
-            client.login(cfg.username, cfg.password)
-            client.select_folder(cfg.mailbox)
+        with imap_session(account_id) as session:
+            client = session.client
             if mode == "latest_unseen":
                 uids = client.search(["UNSEEN"]) or client.search(["ALL"])
                 if not uids:
@@ -68,29 +66,47 @@ def save_attachments(account_id: str, message_id: str, target_dir: str) -> Dict[
                 except ValueError:
                     raise ValueError("Unsupported imap message_id for attachments")
 
-            raw = client.fetch([uid_to_fetch], [b'RFC822'])
-            msg_bytes = raw[uid_to_fetch][b'RFC822']
-            msg = BytesParser(policy=policy.default).parsebytes(msg_bytes)
-
-            if not os.path.isdir(target_dir):
-                os.makedirs(target_dir, exist_ok=True)
-
-            saved: List[str] = []
-            dangerous_exts = {".exe", ".bat", ".cmd", ".sh", ".ps1", ".vbs", ".js", ".jar", ".com", ".scr", ".msi", ".dll", ".html", ".htm"}
-            for part in msg.walk():
-                if part.get_content_disposition() == "attachment":
-                    filename = part.get_filename() or "attachment"
-                    try:
-                        ext = os.path.splitext(filename)[1].lower()
-                        if ext in dangerous_exts:
-                            continue
-                    except Exception:
-                        pass
-                    rawbin = part.get_payload(decode=True) or b""
-                    out_path = os.path.join(target_dir, filename)
-                    with open(out_path, "wb") as outf:
-                        outf.write(rawbin)
-                    saved.append(out_path)
-            return {"saved_paths": saved}
+            writer = AttachmentWriter.from_env(target_dir)
+            if lazy_fetch_enabled():
+                cached = fetch_cached_structure(account_id, session, uid_to_fetch)
+                if cached.path is None and cached.parts is not None:
+                    _save_imap_parts(client, uid_to_fetch, cached.parts, writer)
+                    return {"saved_paths": writer.saved, "notes": writer.notes}
+
+            # Reuses the download done by read_message for the same UID, streamed from disk
+            cached = fetch_cached_message(account_id, session, uid_to_fetch)
+            with cached.open() as f:
+                stream_attachments(f, writer, DANGEROUS_EXTS, source_path=cached.path)
+            writer.write_manifest()
+            return {"saved_paths": writer.saved, "notes": writer.notes}
 
     raise NotImplementedError("save_attachments supports local .eml path or imap:")
+
+
+def raw_message_path(account_id: str, message_id: str) -> str:
+    """Path of the original RFC822 file for a message (a local .eml or the fetched-message cache)."""
+    if message_id.endswith(".eml") and os.path.isfile(message_id):
+        return os.path.abspath(message_id)
+    if message_id.startswith("imap:"):
+        mode = message_id.split(":", 1)[1]
+        with imap_session(account_id) as session:
+            if mode == "latest_unseen":
+                uids = session.client.search(["UNSEEN"]) or session.client.search(["ALL"])
+                if not uids:
+                    raise ValueError("No messages found")
+                uid = max(uids)
+            else:
+                uid = int(mode)
+            return str(fetch_cached_message(account_id, session, uid).path)
+    raise NotImplementedError("raw message is available for local .eml path or imap:")
+
+
+@function_tool
+def save_attachments(account_id: str, message_id: str, target_dir: str) -> Dict[str, Any]:
+    """Сохранит вложения письма в target_dir; вернёт {saved_paths: [str], notes: [str]}.
+
+    Вложения декодируются потоково, одинаковые файлы сохраняются один раз.
+
+    В прототипе ожидаем, что message_id — путь к локальному .eml
+    """
+    return save_message_attachments(account_id, message_id, target_dir)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import pytest
+
+from mail2mail.services.decision_cache import DecisionCache, Fingerprint, fingerprint, simhash, subject_template
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DecisionCache(str(tmp_path / "cache.sqlite3"), max_distance=3)
+
+
+def _message(subject: str, body: str, sender: str = "billing@vendor.example") -> dict:
+    return {"headers": {"From": sender, "Subject": subject}, "text_plain": body}
+
+
+BODY = "Your invoice for this month is attached. Please pay within thirty days to the usual account. " * 3
+
+
+def test_subject_template_drops_prefixes_and_numbers():
+    assert subject_template("Re: FWD: Invoice 12345 for order 77") == "invoice # for order #"
+
+
+def test_fingerprint_ignores_counters_in_the_body():
+    a = fingerprint(_message("Invoice 1", BODY + " Order 1001"))
+    b = fingerprint(_message("Invoice 2", BODY + " Order 2002"))
+    assert a.exact == b.exact
+
+
+def test_exact_hit_then_near_duplicate(cache):
+    fp = fingerprint(_message("Invoice 1", BODY))
+    cache.store(fp, "triage", {"category": "invoices"}, "invoices", "v1")
+    hit = cache.lookup(fp, "triage", lambda category: "v1")
+    assert hit == {"payload": {"category": "invoices"}, "category": "invoices", "near": False}
+
+    near = Fingerprint(fp.sender, fp.template, fp.body_hash ^ 0b101)
+    assert cache.lookup(near, "triage", lambda category: "v1")["near"] is True
+    far = Fingerprint(fp.sender, fp.template, fp.body_hash ^ 0b1111)
+    assert cache.lookup(far, "triage", lambda category: "v1") is None
+    assert cache.stats()["exact_hits"] == 1
+    assert cache.stats()["near_hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_other_sender_or_kind_misses(cache):
+    fp = fingerprint(_message("Invoice 1", BODY))
+    cache.store(fp, "triage", {"x": 1}, None, "v1")
+    other = fingerprint(_message("Invoice 1", BODY, sender="someone@else.example"))
+    assert cache.lookup(other, "triage", lambda category: "v1") is None
+    assert cache.lookup(fp, "compose", lambda category: "v1") is None
+
+
+def test_stale_version_is_dropped(cache):
+    fp = fingerprint(_message("Invoice 1", BODY))
+    cache.store(fp, "triage", {"x": 1}, "invoices", "v1")
+    assert cache.lookup(fp, "triage", lambda category: "v2") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_invalidate_by_category(cache):
+    cache.store(fingerprint(_message("Invoice 1", BODY)), "triage", {}, "invoices", "v1")
+    cache.store(fingerprint(_message("Hello", "Meeting on Friday?")), "triage", {}, "meetings", "v1")
+    assert cache.invalidate("invoices") == 1
+    assert cache.stats()["entries"] == 1
+
+
+def test_simhash_of_empty_text():
+    assert simhash("") == 0
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import pytest
+
+from mail2mail.tools import docproc_tools
+
+fitz = pytest.importorskip("fitz")
+
+
+def _pdf(path, text=None):
+    doc = fitz.open()
+    page = doc.new_page()
+    if text:
+        page.insert_text((72, 72), text)
+    else:
+        page.draw_rect(fitz.Rect(50, 50, 200, 200), fill=(0, 0, 0))
+    doc.save(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def full_runs(monkeypatch):
+    calls = []
+
+    def fake(paths, options):
+        calls.extend(paths)
+        return [{"extracted_text": "OCR: invoice 42", "tables": [], "images": [], "notes": []} for _ in paths]
+
+    monkeypatch.setattr(docproc_tools, "_process_paths", fake)
+    return calls
+
+
+def test_preview_streams_text_pdf_without_full_extraction(tmp_path, full_runs):
+    path = _pdf(tmp_path / "text.pdf", "Invoice 42 total 100")
+    out = docproc_tools.preview_paths([path], 1000)
+    assert "Invoice 42" in out["extracted_text"]
+    assert full_runs == []
+    assert out["full_extraction"] == []
+
+
+def test_preview_falls_back_to_full_extraction_for_scans(tmp_path, full_runs):
+    path = _pdf(tmp_path / "scan.pdf")
+    out = docproc_tools.preview_paths([path], 1000)
+    assert full_runs == [path]
+    assert out["full_extraction"] == [path]
+    assert out["sections"] == [{"path": path, "text": "OCR: invoice 42"}]
+
+
+def test_preview_full_extraction_is_cut_to_budget(tmp_path, full_runs):
+    path = _pdf(tmp_path / "scan.pdf")
+    out = docproc_tools.preview_paths([path], 5)
+    assert out["extracted_text"] == "OCR: "
+    assert out["truncated"]
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from mail2mail.services.ledger import MessageLedger
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return MessageLedger(str(tmp_path / "ledger.sqlite3"), max_attempts=2)
+
+
+def _high(ledger: MessageLedger, account: str = "acc", mailbox: str = "INBOX", uidvalidity: int = 7) -> int:
+    high = ledger.sync(account, mailbox, uidvalidity)
+    assert high is not None
+    return high
+
+
+def test_sync_needs_bootstrap_and_resets_on_uidvalidity_change(ledger):
+    assert ledger.sync("acc", "INBOX", 7) is None
+    assert ledger.sync("acc", "INBOX", None) is None
+    ledger.bootstrap("acc", "INBOX", 7, 100)
+    assert ledger.sync("acc", "INBOX", 7) == 100
+    assert ledger.begin("acc", "INBOX", 7, 101, "<a@x>") == "process"
+    # New UIDVALIDITY: old UIDs are meaningless and their pending rows go
+    assert ledger.sync("acc", "INBOX", 8) is None
+    assert ledger.pending("acc", "INBOX", 7) == []
+
+
+def test_high_water_never_passes_a_pending_uid(ledger):
+    ledger.bootstrap("acc", "INBOX", 7, 10)
+    for uid in (11, 12, 13):
+        assert ledger.begin("acc", "INBOX", 7, uid, f"<{uid}@x>") == "process"
+    ledger.complete("acc", "INBOX", 7, 12)
+    ledger.complete("acc", "INBOX", 7, 13)
+    assert _high(ledger) == 10
+    assert ledger.pending("acc", "INBOX", 7) == [11]
+    ledger.complete("acc", "INBOX", 7, 11)
+    assert _high(ledger) == 13
+    assert ledger.pending("acc", "INBOX", 7) == []
+    assert ledger.begin("acc", "INBOX", 7, 12, "<12@x>") == "done"
+
+
+def test_duplicate_message_id_is_skipped_across_uids(ledger):
+    ledger.bootstrap("acc", "INBOX", 7, 0)
+    assert ledger.begin("acc", "INBOX", 7, 1, "<Same@X>") == "process"
+    ledger.complete("acc", "INBOX", 7, 1)
+    assert ledger.begin("acc", "INBOX", 7, 2, " <same@x> ") == "duplicate"
+    assert _high(ledger) == 2
+    # Other mailboxes keep their own history
+    assert ledger.begin("acc", "Archive", 3, 2, "<same@x>") == "process"
+
+
+def test_failing_message_is_given_up_after_max_attempts(ledger):
+    ledger.bootstrap("acc", "INBOX", 7, 0)
+    assert ledger.begin("acc", "INBOX", 7, 1, None) == "process"
+    assert ledger.begin("acc", "INBOX", 7, 1, None) == "process"
+    assert ledger.begin("acc", "INBOX", 7, 1, None) == "failed"
+    assert ledger.pending("acc", "INBOX", 7) == []
+    assert _high(ledger) == 1
+
+
+def test_forward_claim_is_exclusive(ledger):
+    assert ledger.claim_forward("acc/1")
+    assert not ledger.claim_forward("acc/1")
+    ledger.release_forward("acc/1")
+    assert ledger.claim_forward("acc/1")
+    ledger.finish_forward("acc/1", "sent-1")
+    # A sent forward is never released
+    ledger.release_forward("acc/1")
+    assert not ledger.claim_forward("acc/1")
+
+
+def test_forward_claim_is_exclusive_across_threads(ledger):
+    wins = []
+    barrier = threading.Barrier(8)
+
+    def claim() -> None:
+        barrier.wait()
+        wins.append(ledger.claim_forward("acc/race"))
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(wins) == [False] * 7 + [True]
+
+
+def test_recover_forwards_releases_only_stale_claims(ledger):
+    ledger.claim_forward("acc/old")
+    ledger.claim_forward("acc/sent")
+    ledger.finish_forward("acc/sent", "id")
+    time.sleep(0.05)
+    ledger.claim_forward("acc/new")
+
+    assert ledger.recover_forwards(0.03) == ["acc/old"]
+    assert ledger.claim_forward("acc/old")
+    assert not ledger.claim_forward("acc/new")
+    assert not ledger.claim_forward("acc/sent")
+
+
+def test_state_survives_reopen(tmp_path):
+    path = str(tmp_path / "ledger.sqlite3")
+    first = MessageLedger(path)
+    first.bootstrap("acc", "INBOX", 7, 5)
+    first.begin("acc", "INBOX", 7, 6, None)
+    first.claim_forward("acc/6")
+
+    second = MessageLedger(path)
+    assert second.sync("acc", "INBOX", 7) == 5
+    assert second.pending("acc", "INBOX", 7) == [6]
+    assert not second.claim_forward("acc/6")
+
+
+def test_failed_attempt_waits_for_its_retry_delay(ledger, monkeypatch):
+    ledger.bootstrap("acc", "INBOX", 7, 10)
+    assert ledger.begin("acc", "INBOX", 7, 11, "<11@x>") == "process"
+    assert ledger.retry_later("acc", "INBOX", 7, 11) == ledger.retry_base
+    # Held back: neither listed for retry nor started again
+    assert ledger.pending("acc", "INBOX", 7) == []
+    assert ledger.begin("acc", "INBOX", 7, 11, "<11@x>") == "later"
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + ledger.retry_base + 1)
+    assert ledger.pending("acc", "INBOX", 7) == [11]
+    assert ledger.begin("acc", "INBOX", 7, 11, "<11@x>") == "process"
+    # Second failure waits twice as long
+    assert ledger.retry_later("acc", "INBOX", 7, 11) == 2 * ledger.retry_base
+
+
+def test_retry_delay_is_capped(tmp_path):
+    ledger = MessageLedger(str(tmp_path / "ledger.sqlite3"), max_attempts=10, retry_base=60, retry_max=100)
+    ledger.bootstrap("acc", "INBOX", 7, 10)
+    ledger.begin("acc", "INBOX", 7, 11, None)
+    ledger.begin("acc", "INBOX", 7, 11, None)
+    ledger.begin("acc", "INBOX", 7, 11, None)
+    assert ledger.retry_later("acc", "INBOX", 7, 11) == 100
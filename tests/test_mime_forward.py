@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import io
+import os
+import re
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+import pytest
+
+from mail2mail.services.mime_forward import ForwardMessage, iter_span
+from mail2mail.services.mime_stream import AttachmentWriter, stream_attachments
+
+
+def _parse(data: bytes) -> EmailMessage:
+    return BytesParser(policy=policy.default).parsebytes(data)
+
+
+def _text(part: EmailMessage) -> str:
+    return part.get_content().replace("\r\n", "\n")
+
+
+def _attachments(msg: EmailMessage) -> dict:
+    return {part.get_filename(): part for part in msg.iter_attachments()}
+
+
+def test_chunks_round_trip(tmp_path):
+    blob = tmp_path / "report.bin"
+    blob.write_bytes(os.urandom(200_000))
+    msg = ForwardMessage("bot@example.com", ["Ann <ann@example.com>", "bob@example.com"], "Re: report\r\nBcc: x@y", "Hello\n.\nBye\n")
+    msg.attach_file(str(blob))
+
+    data = b"".join(msg.chunks())
+    assert b"\n" not in data.replace(b"\r\n", b"")
+    parsed = _parse(data)
+    assert parsed["Subject"] == "Re: report  Bcc: x@y"
+    assert parsed["Bcc"] is None
+    assert msg.recipients == ["ann@example.com", "bob@example.com"]
+    assert _text(parsed.get_body(("plain",))) == "Hello\n.\nBye\n"
+    part = _attachments(parsed)["report.bin"]
+    assert part["Content-Transfer-Encoding"] == "base64"
+    assert part.get_payload(decode=True) == blob.read_bytes()
+
+
+def test_chunks_start_on_line_boundaries(tmp_path):
+    blob = tmp_path / "a.bin"
+    blob.write_bytes(os.urandom(150_000))
+    msg = ForwardMessage("bot@example.com", ["ann@example.com"], "s", "body")
+    msg.attach_file(str(blob))
+    chunks = list(msg.chunks())
+    for before in chunks[:-1]:
+        assert before.endswith(b"\r\n") or not before
+
+
+def test_chunks_can_be_replayed(tmp_path):
+    blob = tmp_path / "a.txt"
+    blob.write_bytes(b"one\ntwo\n")
+    msg = ForwardMessage("bot@example.com", ["ann@example.com"], "s", "body")
+    msg.attach_file(str(blob))
+    # Each call draws a fresh MIME boundary
+    first, second = (re.sub(rb"=_[0-9a-f]{32}", b"B", b"".join(msg.chunks())) for _ in range(2))
+    assert first == second
+
+
+def test_attach_eml_is_copied_verbatim(tmp_path):
+    original = EmailMessage()
+    original["Subject"] = "Original"
+    original.set_content("Привет\n")
+    eml = tmp_path / "orig.eml"
+    eml.write_bytes(original.as_bytes(policy=policy.SMTP))
+
+    msg = ForwardMessage("bot@example.com", ["ann@example.com"], "Fwd", "see original")
+    msg.attach_eml(str(eml))
+    assert msg.eight_bit
+    parsed = _parse(b"".join(msg.chunks()))
+    inner = _attachments(parsed)["original.eml"].get_content()
+    assert inner["Subject"] == "Original"
+    assert _text(inner) == "Привет\n"
+
+
+def test_original_encoding_is_copied_and_survives_source_removal(tmp_path):
+    source = EmailMessage()
+    source.set_content("scan attached")
+    payload = os.urandom(10_000)
+    source.add_attachment(payload, maintype="application", subtype="pdf", filename="scan.pdf")
+    raw = tmp_path / "message.eml"
+    raw.write_bytes(source.as_bytes(policy=policy.SMTP))
+    writer = AttachmentWriter(str(tmp_path / "work"))
+    with open(raw, "rb") as fp:
+        saved = stream_attachments(fp, writer, source_path=str(raw))
+    writer.write_manifest()
+
+    msg = ForwardMessage("bot@example.com", ["ann@example.com"], "Fwd", "body")
+    msg.attach_file(saved[0])
+    assert msg.copied == 1
+    # The cache may drop both files before the message is streamed
+    os.remove(raw)
+    os.remove(saved[0])
+    parsed = _parse(b"".join(msg.chunks()))
+    msg.close()
+    assert _attachments(parsed)["scan.pdf"].get_payload(decode=True) == payload
+
+
+def test_changed_source_falls_back_to_base64(tmp_path):
+    source = EmailMessage()
+    source.set_content("x")
+    source.add_attachment(b"abc" * 100, maintype="application", subtype="octet-stream", filename="a.bin")
+    raw = tmp_path / "message.eml"
+    raw.write_bytes(source.as_bytes(policy=policy.SMTP))
+    writer = AttachmentWriter(str(tmp_path / "work"))
+    with open(raw, "rb") as fp:
+        saved = stream_attachments(fp, writer, source_path=str(raw))
+    writer.write_manifest()
+    with open(raw, "ab") as f:
+        f.write(b"\r\n")
+
+    msg = ForwardMessage("bot@example.com", ["ann@example.com"], "Fwd", "body")
+    msg.attach_file(saved[0])
+    assert msg.copied == 0
+    parsed = _parse(b"".join(msg.chunks()))
+    assert _attachments(parsed)["a.bin"].get_payload(decode=True) == b"abc" * 100
+
+
+@pytest.mark.parametrize("data", [b"a\nb\n", b"a\r\nb", b"no newline", b"x" * 70_000 + b"\n" + b"y" * 10])
+def test_iter_span_normalizes_line_endings(data):
+    out = b"".join(iter_span(io.BytesIO(data)))
+    assert out.endswith(b"\r\n")
+    assert out.replace(b"\r\n", b"\n").rstrip(b"\n") == data.replace(b"\r\n", b"\n").rstrip(b"\n")
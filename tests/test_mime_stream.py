@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import base64
+import io
+import os
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+from mail2mail.services.mime_stream import MANIFEST_NAME, AttachmentWriter, stream_attachments
+
+
+def _message() -> bytes:
+    msg = EmailMessage()
+    msg["From"] = "sender@example.com"
+    msg["To"] = "inbox@example.com"
+    msg["Subject"] = "Documents"
+    msg.set_content("See attached.\n")
+    msg.add_attachment(os.urandom(5000), maintype="application", subtype="pdf", filename="scan.pdf")
+    msg.add_attachment("name;qty\nbolts;12\n", subtype="csv", filename="order.csv", cte="quoted-printable")
+    msg.add_attachment(b"\x00\x01 binary \xff" * 300, maintype="application", subtype="octet-stream", filename="data.bin")
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def _stdlib_attachments(raw: bytes) -> dict:
+    msg = BytesParser(policy=policy.default).parsebytes(raw)
+    return {
+        part.get_filename(): part.get_payload(decode=True)
+        for part in msg.walk()
+        if part.get_content_disposition() == "attachment" and part.get_filename()
+    }
+
+
+def test_stream_attachments_matches_stdlib_parser(tmp_path):
+    raw = _message()
+    writer = AttachmentWriter(str(tmp_path / "out"))
+    saved = stream_attachments(io.BytesIO(raw), writer)
+
+    expected = _stdlib_attachments(raw)
+    got = {os.path.basename(p): open(p, "rb").read() for p in saved}
+    assert got == expected
+
+
+def test_stream_attachments_skips_extensions(tmp_path):
+    writer = AttachmentWriter(str(tmp_path / "out"))
+    saved = stream_attachments(io.BytesIO(_message()), writer, skip_exts={".pdf", ".bin"})
+    assert [os.path.basename(p) for p in saved] == ["order.csv"]
+
+
+def test_stream_attachments_records_source_spans(tmp_path):
+    raw = _message()
+    source = tmp_path / "message.eml"
+    source.write_bytes(raw)
+    writer = AttachmentWriter(str(tmp_path / "out"))
+    with open(source, "rb") as fp:
+        saved = stream_attachments(fp, writer, source_path=str(source))
+    writer.write_manifest()
+
+    assert (tmp_path / "out" / MANIFEST_NAME).exists()
+    pdf = next(p for p in saved if p.endswith("scan.pdf"))
+    span = writer.sources[pdf]
+    assert span["encoding"] == "base64"
+    encoded = raw[span["offset"] : span["offset"] + span["length"]]
+    assert base64.b64decode(encoded) == open(pdf, "rb").read()
+
+
+def test_stream_attachments_dedupes_identical_content(tmp_path):
+    msg = EmailMessage()
+    msg.set_content("twice")
+    for name in ("a.txt", "b.txt"):
+        msg.add_attachment(b"same bytes", maintype="application", subtype="octet-stream", filename=name)
+    writer = AttachmentWriter(str(tmp_path / "out"))
+    saved = stream_attachments(io.BytesIO(msg.as_bytes()), writer)
+    assert [os.path.basename(p) for p in saved] == ["a.txt"]
+
+
+def test_attachment_budget_is_enforced(tmp_path):
+    writer = AttachmentWriter(str(tmp_path / "out"), max_attachment_bytes=1000)
+    saved = stream_attachments(io.BytesIO(_message()), writer)
+    names = [os.path.basename(p) for p in saved]
+    assert "scan.pdf" not in names
+    assert "order.csv" in names
+    assert writer.notes
+
+
+def test_invalid_base64_is_decoded_leniently_and_noted(tmp_path):
+    raw = (
+        b"Subject: broken\r\n"
+        b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+        b"--b\r\nContent-Type: text/plain\r\n\r\nhi\r\n"
+        b'--b\r\nContent-Type: application/octet-stream\r\nContent-Disposition: attachment; filename="a.bin"\r\n'
+        b"Content-Transfer-Encoding: base64\r\n\r\n"
+        b"SGVsbG8g!!\r\nV29y*bGQ=\r\n"
+        b"--b--\r\n"
+    )
+    writer = AttachmentWriter(str(tmp_path / "out"))
+    saved = stream_attachments(io.BytesIO(raw), writer)
+    assert open(saved[0], "rb").read() == b"Hello World" == _stdlib_attachments(raw)["a.bin"]
+    assert writer.notes == ["invalid base64 (3 characters skipped): a.bin"]
@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from mail2mail.services.page_stream import take_text
+
+
+def test_take_text_never_exceeds_budget_after_separators():
+    text, read, truncated = take_text(iter(["abcdefghi", "XYZ" * 6]), 10)
+    assert (text, read, truncated) == ("abcdefghi", 2, True)
+
+
+def test_take_text_adds_no_empty_part_when_budget_is_spent():
+    text, read, truncated = take_text(iter(["abcdefgh", "XYZ"]), 10)
+    assert (text, read, truncated) == ("abcdefgh", 2, True)
+    assert len(text) <= 10
+
+
+def test_take_text_exact_fit_is_not_truncated():
+    assert take_text(iter(["abcdefghij"]), 10) == ("abcdefghij", 1, False)
+    assert take_text(iter(["abc", "defg"]), 9) == ("abc\n\ndefg", 2, False)
+
+
+def test_take_text_cuts_the_page_that_overflows():
+    text, read, truncated = take_text(iter(["abc", "defghijk", "never read"]), 9)
+    assert (text, read, truncated) == ("abc\n\ndefg", 2, True)
+
+
+def test_take_text_skips_blank_pages():
+    assert take_text(iter(["  ", "\n", "abc"]), 10) == ("abc", 3, False)
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from mail2mail.services.ledger import MessageLedger
+from mail2mail.services.pipeline import _with_forward_key, message_key
+from mail2mail.tools import email_tools
+from mail2mail.tools.email_tools import send_once
+
+
+def _imap(uidvalidity, uid=7, **headers):
+    return {"headers": headers, "imap": {"mailbox": "INBOX", "uidvalidity": uidvalidity, "uid": uid}}
+
+
+def test_message_key_prefers_message_id():
+    message = _imap(1, **{"Message-ID": "<ABC@Example.com>"})
+    assert message_key("acc", "imap:7", message) == "acc/abc@example.com"
+    assert message_key("acc", "imap:7", message) == message_key("acc", "imap:9", _imap(2, 9, **{"message-id": "abc@example.com"}))
+
+
+def test_message_key_without_message_id_survives_uidvalidity_reset():
+    before = message_key("acc", "imap:7", _imap(100))
+    after = message_key("acc", "imap:7", _imap(200))
+    assert before == "acc/imap:INBOX:100:7"
+    assert before != after
+
+
+def test_message_key_without_message_id_or_origin():
+    assert message_key("acc", "/tmp/a.eml", {"headers": {}}) == "acc//tmp/a.eml"
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    ledger = MessageLedger(str(tmp_path / "ledger.sqlite3"))
+    sent = []
+
+    def fake_send(from_account_id, to, subject, body, attach_paths, raw_eml_path=None):
+        sent.append((to, subject))
+        return {"sent_message_id": f"<{len(sent)}@example.com>"}
+
+    monkeypatch.setattr(email_tools, "get_ledger", lambda: ledger)
+    monkeypatch.setattr(email_tools, "send_email_smtp", fake_send)
+    return sent
+
+
+def test_send_once_forwards_a_message_once(outbox):
+    assert send_once("acc/a@x", "acc", ["ann@example.com"], "s", "b", []) == {"sent_message_id": "<1@example.com>"}
+    assert send_once("acc/a@x", "acc", ["ann@example.com"], "s", "b", []) is None
+    assert len(outbox) == 1
+
+
+def test_agent_send_tool_is_guarded_by_the_run_key(outbox):
+    async def agent_run():
+        # The SDK runs sync tools in a worker thread (see tools.lazy)
+        first = await asyncio.to_thread(email_tools.send.fn, "acc", ["ann@example.com"], "s", "b", [])
+        again = await asyncio.to_thread(email_tools.send.fn, "acc", ["ann@example.com"], "s", "b", [])
+        return first, again
+
+    first, again = asyncio.run(_with_forward_key("acc/a@x", agent_run()))
+    assert first["sent_message_id"] == "<1@example.com>"
+    assert again == {"sent_message_id": None, "skipped": "already forwarded"}
+    assert send_once("acc/a@x", "acc", ["ann@example.com"], "s", "b", []) is None
+    assert len(outbox) == 1
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import pytest
+
+from mail2mail.services import prefilter
+from mail2mail.services.prefilter import DEFAULT_PREFILTER, SenderReputation, evaluate
+
+
+@pytest.fixture(autouse=True)
+def _isolated(tmp_path, monkeypatch):
+    reputation = SenderReputation(str(tmp_path / "reputation.sqlite3"))
+    monkeypatch.setattr(prefilter, "get_sender_reputation", lambda: reputation)
+    monkeypatch.setattr(prefilter, "_route_candidates", lambda *a: [])
+    return reputation
+
+
+def _message(text="Hello", sender="Shop <noreply@shop.example>", **headers):
+    return {"headers": {"From": sender, "Subject": "News", **headers}, "text": text, "links": []}
+
+
+RULES = {**DEFAULT_PREFILTER, "spam_keywords": ["sale", "casino"]}
+BULK = {"Auto-Submitted": "auto-generated", "Precedence": "bulk", "List-Unsubscribe": "<mailto:u@shop.example>"}
+
+
+def test_bulk_headers_alone_are_not_spam():
+    result = evaluate(_message(**BULK), RULES)
+    assert result.score >= RULES["spam_threshold"]
+    assert result.verdict == "llm"
+    assert "bulk headers only, no content evidence" in result.reasons
+
+
+def test_bulk_headers_with_keyword_are_spam():
+    result = evaluate(_message("Big casino bonus", **BULK), RULES)
+    assert result.verdict == "spam"
+
+
+def test_keywords_match_whole_words_only():
+    assert evaluate(_message("Wholesale prices attached", **BULK), RULES).verdict == "llm"
+    assert evaluate(_message("Summer sale!", **BULK), RULES).verdict == "spam"
+
+
+def test_spam_list_is_enough_on_its_own():
+    rules = {**RULES, "spam_senders": ["@shop.example"]}
+    assert evaluate(_message(), rules).verdict == "spam"
+
+
+def test_sender_history_counts_as_evidence(_isolated):
+    for _ in range(5):
+        _isolated.record("noreply@shop.example", True)
+    result = evaluate(_message(Precedence="bulk"), RULES)
+    assert result.verdict == "spam"
+
+
+def test_trusted_sender_goes_to_model():
+    rules = {**RULES, "trusted_senders": ["@shop.example"]}
+    assert evaluate(_message("casino sale", **BULK), rules).reasons == ["trusted sender"]
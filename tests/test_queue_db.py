@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import pytest
+
+from mail2mail.services.queue_db import QueueDB
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return QueueDB(str(tmp_path / "queue.sqlite3"))
+
+
+def test_enqueue_is_idempotent_per_mailbox_generation(queue):
+    first = queue.enqueue("acc", "imap:5", mailbox="INBOX", uidvalidity=1)
+    assert queue.enqueue("acc", "imap:5", mailbox="INBOX", uidvalidity=1) == first
+    # Same UID after a UIDVALIDITY reset is a different message
+    assert queue.enqueue("acc", "imap:5", mailbox="INBOX", uidvalidity=2) != first
+    assert queue.get(first)["uid"] == 5
+
+
+def test_claim_is_exclusive_until_ack(queue):
+    item_id = queue.enqueue("acc", "imap:1")
+    [item] = queue.claim("w1")
+    assert item["id"] == item_id
+    assert item["status"] == "processing"
+    assert item["attempts"] == 1
+    assert queue.claim("w2") == []
+    assert queue.ack(item_id, result={"ok": True}, worker="w1")
+    stored = queue.get(item_id)
+    assert stored["status"] == "done"
+    assert stored["claimed_by"] is None
+    assert queue.claim("w2") == []
+
+
+def test_expired_lease_can_be_claimed_and_the_old_worker_cannot_ack(queue):
+    item_id = queue.enqueue("acc", "imap:1")
+    queue.claim("w1", lease_seconds=-1)
+    [item] = queue.claim("w2")
+    assert item["id"] == item_id
+    assert item["attempts"] == 2
+    assert not queue.ack(item_id, worker="w1")
+    assert queue.ack(item_id, worker="w2")
+
+
+def test_nack_requeues_then_fails_after_max_attempts(queue):
+    item_id = queue.enqueue("acc", "imap:1")
+    queue.claim("w1")
+    assert queue.nack(item_id, "boom", max_attempts=2, worker="w1")
+    assert queue.get(item_id)["status"] == "queued"
+    queue.claim("w1")
+    queue.nack(item_id, "boom again", max_attempts=2, worker="w1")
+    stored = queue.get(item_id)
+    assert stored["status"] == "failed"
+    assert stored["error"] == "boom again"
+
+
+def test_claim_by_message_prefers_the_newest_generation(queue):
+    queue.enqueue("acc", "imap:5", mailbox="INBOX", uidvalidity=1)
+    newest = queue.enqueue("acc", "imap:5", mailbox="INBOX", uidvalidity=2)
+    queue.enqueue("acc", "imap:6", mailbox="INBOX", uidvalidity=2)
+    [item] = queue.claim("w1", account_id="acc", message_id="imap:5")
+    assert item["id"] == newest
+
+
+def test_requeue_releases_claims_of_a_dead_process(queue):
+    a = queue.enqueue("acc", "imap:1")
+    b = queue.enqueue("acc", "imap:2")
+    queue.claim("old-run:0")
+    queue.claim("new-run:0")
+    assert queue.requeue("old-run:") == 1
+    assert queue.get(a)["status"] == "queued"
+    assert queue.get(b)["status"] == "processing"
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import os
+import socket
+import time
+from email import policy
+from email.parser import BytesParser
+from typing import List, Tuple
+
+import pytest
+
+from mail2mail.services.mime_forward import AttachmentUnavailable, ForwardMessage
+from mail2mail.services.smtp_pool import SmtpPool, SmtpSpool, _Connection, _stream_data, describe_refused
+
+
+class _RecordingSmtp:
+    """Just enough of smtplib.SMTP for _stream_data; keeps what went on the wire."""
+
+    def __init__(self, refuse: Tuple[str, ...] = ()) -> None:
+        self.sent: List[bytes] = []
+        self.commands: List[str] = []
+        self.refuse = refuse
+
+    def ehlo_or_helo_if_needed(self) -> None:
+        pass
+
+    def has_extn(self, name: str) -> bool:
+        return name == "8bitmime"
+
+    def mail(self, sender, options=()):
+        self.commands.append(f"MAIL {sender} {' '.join(options)}".strip())
+        return 250, b"ok"
+
+    def rcpt(self, rcpt):
+        self.commands.append(f"RCPT {rcpt}")
+        return (550, b"no such user") if rcpt in self.refuse else (250, b"ok")
+
+    def docmd(self, cmd):
+        self.commands.append(cmd)
+        return 354, b"go ahead"
+
+    def send(self, data: bytes) -> None:
+        self.sent.append(data)
+
+    def getreply(self):
+        return 250, b"queued"
+
+    def rset(self) -> None:
+        self.commands.append("RSET")
+
+
+def _unstuff(wire: bytes) -> bytes:
+    assert wire.endswith(b"\r\n.\r\n")
+    lines = wire[: -len(b".\r\n")].split(b"\r\n")
+    return b"\r\n".join(line[1:] if line.startswith(b".") else line for line in lines)
+
+
+def test_stream_data_dot_stuffs_and_round_trips(tmp_path):
+    attached = tmp_path / "notes.txt"
+    attached.write_bytes(b".starts with a dot\n..two dots\nplain\n.\n")
+    msg = ForwardMessage("bot@example.com", ["ann@example.com"], "Dots", ".hidden\nline\n.\nend\n")
+    msg.attach_eml(str(attached), filename="notes.eml")
+    smtp = _RecordingSmtp()
+
+    _stream_data(smtp, msg.mail_from, msg.recipients, msg.chunks(), msg.eight_bit)
+
+    wire = b"".join(smtp.sent)
+    assert b"\r\n.\r\n" not in wire[:-5]
+    assert b"\r\n..hidden\r\n" in wire
+    assert b"\r\n...two dots\r\n" in wire
+    parsed = BytesParser(policy=policy.default).parsebytes(_unstuff(wire))
+    assert parsed.get_body(("plain",)).get_content().replace("\r\n", "\n") == ".hidden\nline\n.\nend\n"
+    assert smtp.commands[:3] == ["MAIL bot@example.com", "RCPT ann@example.com", "DATA"]
+
+
+def test_stream_data_terminates_unterminated_body():
+    smtp = _RecordingSmtp()
+    _stream_data(smtp, "a@example.com", ["b@example.com"], [b"Subject: x\r\n\r\nno newline"], False)
+    assert b"".join(smtp.sent).endswith(b"no newline\r\n.\r\n")
+
+
+def test_stream_data_requests_8bitmime_for_8bit_bodies():
+    smtp = _RecordingSmtp()
+    _stream_data(smtp, "a@example.com", ["b@example.com"], [b"Subject: x\r\n\r\n\xd0\xbf\r\n"], True)
+    assert smtp.commands[0] == "MAIL a@example.com BODY=8BITMIME"
+
+
+def test_stream_data_returns_partial_refusals():
+    smtp = _RecordingSmtp(refuse=("gone@example.com",))
+    refused = _stream_data(smtp, "a@example.com", ["b@example.com", "gone@example.com"], [b"Subject: x\r\n\r\nhi\r\n"], False)
+    assert refused == {"gone@example.com": (550, b"no such user")}
+    assert describe_refused(refused) == {"gone@example.com": "550 no such user"}
+    assert b"".join(smtp.sent).endswith(b"hi\r\n.\r\n")
+
+
+class _ClosingConnection(_Connection):
+    closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_pool_closes_session_when_the_body_fails(monkeypatch):
+    pool = SmtpPool()
+    conn = _ClosingConnection(("h", 25, False, ""), _RecordingSmtp())
+    monkeypatch.setattr(pool, "_checkout", lambda key, cfg: (conn, False))
+    cfg = type("Cfg", (), {"host": "h", "port": 25, "starttls": False, "username": ""})()
+
+    def chunks():
+        yield b"Subject: x\r\n\r\n"
+        raise AttachmentUnavailable("scan.pdf")
+
+    with pytest.raises(AttachmentUnavailable):
+        pool.send_stream(cfg, "a@example.com", ["b@example.com"], chunks)
+    # Left mid-DATA: the session must not go back to the pool
+    assert conn.closed
+    assert pool._idle == {}
+
+
+class _BrokenMessage:
+    mail_from = "bot@example.com"
+    recipients = ["ann@example.com"]
+    eight_bit = False
+
+    def chunks(self):
+        yield b"Subject: x\r\n\r\n"
+        raise AttachmentUnavailable("scan.pdf")
+
+
+def test_spool_put_drops_half_written_entries(tmp_path):
+    spool = SmtpSpool(str(tmp_path / "outbox"))
+    with pytest.raises(AttachmentUnavailable):
+        spool.put("acc", _BrokenMessage())
+    assert spool.stats() == {}
+    assert [n for n in os.listdir(tmp_path / "outbox") if not n.startswith("outbox.sqlite3")] == []
+
+
+def _claim_as(spool: SmtpSpool, owner: str, claimed_at: float) -> int:
+    item_id = spool.put("acc", ForwardMessage("bot@example.com", ["ann@example.com"], "s", "body"))
+    with spool._lock, spool._connect() as conn:
+        conn.execute("UPDATE outbox SET status = 'sending', owner = ?, claimed_at = ? WHERE id = ?", (owner, claimed_at, item_id))
+    return item_id
+
+
+def test_spool_keeps_sends_of_live_processes(tmp_path):
+    root = str(tmp_path / "outbox")
+    live = f"{socket.gethostname()}:{os.getppid()}:other"
+    _claim_as(SmtpSpool(root), live, time.time())
+    assert SmtpSpool(root).stats() == {"sending": 1}
+
+
+def test_spool_requeues_sends_of_gone_processes_and_stale_claims(tmp_path):
+    root = str(tmp_path / "outbox")
+    first = SmtpSpool(root)
+    # Same pid, earlier run: a restarted container
+    _claim_as(first, f"{socket.gethostname()}:{os.getpid()}:earlier", time.time())
+    _claim_as(first, "elsewhere:1:x", time.time() - 7200)
+    assert SmtpSpool(root, lease=3600).stats() == {"queued": 2}
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import json
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from mail2mail.agents.triage_compose import ComposeDecision, ComposeDecisionBatch, IndexedDecision
+from mail2mail.services.triage_batch import OfflineTriage, TriageBatcher, batchable, split_decisions
+
+
+def _decision(reason: str) -> ComposeDecision:
+    return ComposeDecision(is_relevant=False, reason=reason, task_markdown="")
+
+
+def _batch(*pairs) -> ComposeDecisionBatch:
+    return ComposeDecisionBatch(decisions=[IndexedDecision(index=i, decision=_decision(r)) for i, r in pairs])
+
+
+def test_split_decisions_by_index():
+    out = split_decisions(_batch((1, "b"), (0, "a"), (2, "c")), 3)
+    assert [d.reason for d in out] == ["a", "b", "c"]
+
+
+def test_split_decisions_drops_missing_out_of_range_and_repeated():
+    out = split_decisions(_batch((0, "a"), (3, "x"), (-1, "y"), (2, "c1"), (2, "c2"), (2, "c3")), 3)
+    assert out[0].reason == "a"
+    assert out[1] is None
+    assert out[2] is None
+
+
+def test_batchable_excludes_attachments_and_long_text():
+    assert batchable({}, "short", 100)
+    assert not batchable({"attachments_meta": [{"filename": "a.pdf"}]}, "short", 100)
+    assert not batchable({}, "x" * 1000, 100)
+
+
+def _fill(batcher: TriageBatcher, key, texts, since: float) -> None:
+    # Stage a group directly; submit() would also start the dispatch thread
+    batcher._groups[key] = [(text, len(text), Future()) for text in texts]
+    batcher._since[key] = since
+
+
+def test_take_ready_waits_for_a_partial_group():
+    batcher = TriageBatcher(max_items=4, max_tokens=1000, max_wait=0.5)
+    _fill(batcher, ("i", "m", "r"), ["a", "b"], since=10.0)
+    assert batcher._take_ready(10.2) == []
+    ready = batcher._take_ready(10.6)
+    assert [[t for t, _, _ in items] for _, items in ready] == [["a", "b"]]
+    assert batcher._groups == {}
+    assert batcher._since == {}
+
+
+def test_take_ready_sends_full_groups_at_once_and_keeps_the_rest():
+    batcher = TriageBatcher(max_items=2, max_tokens=1000, max_wait=0.5)
+    key = ("i", "m", "r")
+    _fill(batcher, key, ["a", "b", "c", "d", "e"], since=10.0)
+    ready = batcher._take_ready(10.1)
+    assert [[t for t, _, _ in items] for _, items in ready] == [["a", "b"], ["c", "d"]]
+    assert [t for t, _, _ in batcher._groups[key]] == ["e"]
+    assert batcher._since[key] == 10.1
+
+
+def test_take_ready_splits_on_token_budget():
+    batcher = TriageBatcher(max_items=10, max_tokens=5, max_wait=0.5)
+    key = ("i", "m", "r")
+    _fill(batcher, key, ["aaa", "bbb", "cccccc"], since=10.0)
+    ready = batcher._take_ready(10.0)
+    # "cccccc" alone is over budget; it still goes out, on its own
+    assert [[t for t, _, _ in items] for _, items in ready] == [["aaa"], ["bbb"], ["cccccc"]]
+
+
+def test_take_ready_keeps_keys_apart():
+    batcher = TriageBatcher(max_items=2, max_tokens=1000, max_wait=0.5)
+    _fill(batcher, ("i", "small", "r"), ["a"], since=10.0)
+    _fill(batcher, ("i", "large", "r"), ["b"], since=10.0)
+    ready = batcher._take_ready(11.0)
+    assert sorted((key[1], [t for t, _, _ in items]) for key, items in ready) == [("large", ["b"]), ("small", ["a"])]
+
+
+def test_lone_request_resolves_to_none():
+    batcher = TriageBatcher(max_items=4, max_tokens=1000, max_wait=0.01)
+    future = batcher.submit("i", "m", "r", "only one")
+    assert future.result(timeout=5) is None
+
+
+class _FakeBatchClient:
+    """batches.retrieve / files.content of a job that finished with the given output."""
+
+    def __init__(self, output: str):
+        self.batches = self
+        self.files = self
+        self.output = output
+
+    def retrieve(self, batch_id):
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id="file-out")
+
+    def content(self, file_id):
+        return SimpleNamespace(text=self.output)
+
+
+def _offline(tmp_path, answer: ComposeDecision, **kwargs) -> OfflineTriage:
+    line = {
+        "custom_id": "item-1",
+        "response": {"status_code": 200, "body": {"choices": [{"message": {"content": answer.model_dump_json()}}]}},
+    }
+    client = _FakeBatchClient(json.dumps(line))
+    offline = OfflineTriage(str(tmp_path / "triage.sqlite3"), poll_interval=0.0, client_factory=lambda: client, **kwargs)
+    item_id = offline.enqueue("acc", "imap:1", "m", "i", "text", {"saved": []})
+    with offline._lock, offline._connect() as conn:
+        conn.execute("UPDATE items SET status = 'submitted', batch_id = 'b1' WHERE id = ?", (item_id,))
+        conn.execute("INSERT INTO batches (batch_id, status, items, created_at) VALUES ('b1', 'in_progress', 1, 0)")
+    return offline
+
+
+def test_failed_delivery_is_retried_on_a_later_poll(tmp_path):
+    offline = _offline(tmp_path, _decision("answered"))
+    calls = []
+
+    def flaky(item, decision):
+        calls.append(decision.reason)
+        if len(calls) == 1:
+            raise RuntimeError("smtp down")
+
+    assert offline.collect(flaky) == 0
+    assert offline.stats() == {"answered": 1}
+    assert offline.collect(flaky) == 1
+    assert calls == ["answered", "answered"]
+    assert offline.stats() == {"done": 1}
+
+
+def test_delivery_gives_up_after_max_attempts(tmp_path, caplog):
+    offline = _offline(tmp_path, _decision("answered"), max_attempts=2)
+
+    def broken(item, decision):
+        raise RuntimeError("smtp down")
+
+    for _ in range(3):
+        offline.collect(broken)
+    assert offline.stats() == {"failed": 1}
+    assert any(r.levelname == "ERROR" and "giving up" in r.getMessage() for r in caplog.records)
+
+
+def test_failed_delivery_waits_for_its_backoff(tmp_path):
+    offline = _offline(tmp_path, _decision("answered"))
+    offline.poll_interval = 3600.0
+    calls = []
+
+    def broken(item, decision):
+        calls.append(item["id"])
+        raise RuntimeError("smtp down")
+
+    offline.collect(broken)
+    offline.collect(broken)
+    assert calls == [1]